@@ -0,0 +1,92 @@
+"""
+Compare chunk write throughput: per-row INSERT + commit (the old ingestion
+loop) against pipelined INSERTs and binary COPY.
+
+Needs a Postgres with pgvector and the app schema. Rows go to a scratch
+copy of chunks, a regular (WAL-logged) table like the real one, so every
+commit pays its WAL flush; it is dropped again at the end:
+
+    POSTGRES_URL=postgresql://localhost/retrieval python benchmarks/bench_chunk_insert.py --rows 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import psycopg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chunk_store import make_chunk_rows, write_chunks  # noqa: E402
+
+
+async def per_row_loop(conn, rows, table):
+    """The pre-bulk ingestion loop: one INSERT and one commit per chunk."""
+    async with conn.cursor() as cur:
+        for chunk_id, document_id, text, embedding, order, *_ in rows:
+            await cur.execute(f"""
+                INSERT INTO {table} (id, document_id, text, embedding, "order", created_at)
+                VALUES (%s, %s, %s, %s::vector, %s, NOW())
+            """, (chunk_id, document_id, text, str(embedding), order))
+            await conn.commit()
+
+
+def bulk(method, batch_size):
+    async def run(conn, rows, table):
+        for i in range(0, len(rows), batch_size):
+            await write_chunks(conn, rows[i:i + batch_size], method=method, table=table)
+    return run
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    conn = await psycopg.AsyncConnection.connect(os.environ["POSTGRES_URL"].replace("postgres://", "postgresql://"))
+    document_id = str(uuid.uuid4())
+    table = f"bench_chunks_{uuid.uuid4().hex[:8]}"
+    async with conn.cursor() as cur:
+        # Same columns, generated search_vector and indexes (HNSW, GIN, unique position) as chunks,
+        # without touching real data
+        await cur.execute(f"CREATE TABLE {table} (LIKE chunks INCLUDING ALL)")
+    await conn.commit()
+
+    rng = np.random.default_rng(0)
+    texts = [f"Benchmark chunk {i} " + "lorem ipsum " * 80 for i in range(args.rows)]
+    embeddings = rng.standard_normal((args.rows, args.dim), dtype=np.float32).tolist()
+
+    strategies = [
+        ("per-row insert", per_row_loop),
+        ("pipelined insert", bulk("values", args.batch_size)),
+        ("copy binary", bulk("copy", args.batch_size)),
+    ]
+    baseline = None
+    try:
+        for name, run in strategies:
+            rows = make_chunk_rows(document_id, texts, embeddings)
+            start = time.perf_counter()
+            await run(conn, rows, table)
+            elapsed = time.perf_counter() - start
+            rate = len(rows) / elapsed
+            baseline = baseline or rate
+            print(f"{name:>16}: {rate:10.0f} rows/s  ({elapsed:.2f}s, {rate / baseline:.1f}x)")
+            async with conn.cursor() as cur:
+                await cur.execute(f"TRUNCATE {table}")
+            await conn.commit()
+    finally:
+        await conn.rollback()
+        async with conn.cursor() as cur:
+            await cur.execute(f"DROP TABLE IF EXISTS {table}")
+        await conn.commit()
+
+    await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
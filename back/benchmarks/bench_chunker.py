@@ -0,0 +1,85 @@
+"""
+Micro-benchmark the streaming chunker: throughput in MB/s and peak Python
+memory (tracemalloc) on large synthetic documents.
+
+    python benchmarks/bench_chunker.py --sizes 1 10 50
+
+Each size is chunked twice: streamed page by page as ingestion does, and
+as one in-memory string through chunk_text. Throughput is timed on
+pre-generated pages without tracing. Peak memory is measured in a second,
+traced pass where pages are generated on the fly, so the streamed figure
+is the chunker's own footprint.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chunker import StreamingChunker, chunk_text  # noqa: E402
+
+WORDS = ("retrieval latency vector index chunk token embedding document page query score rank "
+         "the a of and to in is for on with as by at from that this").split()
+
+
+def synthetic_pages(megabytes: float, page_chars: int = 3000, seed: int = 0):
+    """Yield pages of prose-like text totalling about the given size."""
+    rng = random.Random(seed)
+    remaining = int(megabytes * 1024 * 1024)
+    while remaining > 0:
+        sentences = []
+        size = 0
+        while size < page_chars:
+            sentence = " ".join(rng.choices(WORDS, k=rng.randint(5, 35))).capitalize() + "."
+            sentences.append(sentence)
+            size += len(sentence) + 1
+        page = " ".join(sentences) + "\n"
+        remaining -= len(page)
+        yield page
+
+
+def run_streamed(pages):
+    chunker = StreamingChunker()
+    chunks = 0
+    for number, page in enumerate(pages, start=1):
+        chunks += len(chunker.feed(page, number))
+    return chunks + len(chunker.finish())
+
+
+def run_whole(pages):
+    return len(chunk_text("".join(pages)))
+
+
+def measure(name, run, megabytes):
+    # Time chunking only, on pages generated up front
+    pages = list(synthetic_pages(megabytes))
+    start = time.perf_counter()
+    chunks = run(pages)
+    elapsed = time.perf_counter() - start
+    del pages
+
+    tracemalloc.start()
+    run(synthetic_pages(megabytes))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:>9} {megabytes:>8.1f} {chunks:>8} {megabytes / elapsed:>8.2f} {peak / 1024 / 1024:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 10, 50])
+    args = parser.parse_args()
+
+    chunk_text("Warm up. Load the tokenizer and sentence model outside the timings.")
+    print(f"{'mode':>9} {'MB':>8} {'chunks':>8} {'MB/s':>8} {'peak MB':>10}")
+    for megabytes in args.sizes:
+        measure("streamed", run_streamed, megabytes)
+        measure("whole", run_whole, megabytes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Compare ColBERT late interaction against the single-vector embedding path
+on a fixed local corpus: recall@k and per-query scoring latency.
+
+The corpus is a directory of .pdf/.md/.txt files, chunked the same way as
+ingestion. Queries are a JSON list of {"query": ..., "answer": ...}; a
+query counts as a hit when one of its top k chunks contains the answer
+text (case-insensitive).
+
+    COLBERT_ENCODER=colbert python benchmarks/bench_colbert.py \
+        --corpus ./corpus --queries ./corpus/queries.json --k 3
+
+The embedding path calls OpenAI for chunk and query embeddings; pass
+--skip-embedding to run offline. Exact MaxSim over float32 vectors is
+reported as the unpruned reference for the compressed indexes.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chunker import chunk_text  # noqa: E402
+from ingest import extract_text  # noqa: E402
+from late_interaction import COLBERT_CANDIDATES, COLBERT_NPROBE, get_encoder  # noqa: E402
+from multivector import MultiVectorIndex  # noqa: E402
+
+
+def load_corpus(path):
+    chunks = []
+    for name in sorted(os.listdir(path)):
+        if not name.lower().endswith((".pdf", ".md", ".txt")):
+            continue
+        with open(os.path.join(path, name), "rb") as f:
+            chunks.extend(chunk.text for chunk in chunk_text(extract_text(f.read(), name)))
+    return chunks
+
+
+def evaluate(name, queries, chunks, rank, k):
+    hits = 0
+    latencies = []
+    for item in queries:
+        start = time.perf_counter()
+        top = rank(item)
+        latencies.append(time.perf_counter() - start)
+        answer = item["answer"].lower()
+        hits += any(answer in chunks[i].lower() for i in top[:k])
+    print(f"{name:>24} {hits / len(queries):>9.3f} {statistics.median(latencies) * 1000:>10.2f} "
+          f"{max(latencies) * 1000:>10.2f}")
+
+
+async def embed_all(chunks, queries):
+    # One event loop for both passes: the shared OpenAI client is bound to
+    # the loop it first ran on
+    from embeddings import EmbeddingBatcher, count_tokens
+    batcher = EmbeddingBatcher(count_tokens=count_tokens)
+    matrix = await batcher.embed(chunks)
+    query_embeddings = await batcher.embed(queries)
+    return np.asarray(matrix, dtype=np.float32), np.asarray(query_embeddings, dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", required=True)
+    parser.add_argument("--queries", required=True)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--nprobe", type=int, default=COLBERT_NPROBE)
+    parser.add_argument("--candidates", type=int, default=COLBERT_CANDIDATES)
+    parser.add_argument("--skip-embedding", action="store_true")
+    args = parser.parse_args()
+
+    chunks = load_corpus(args.corpus)
+    with open(args.queries) as f:
+        queries = json.load(f)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, k={args.k}")
+
+    encoder = get_encoder()
+    start = time.perf_counter()
+    token_vectors = encoder.encode_documents(chunks)
+    print(f"encoded {sum(len(v) for v in token_vectors)} token vectors in {time.perf_counter() - start:.1f}s")
+    for item in queries:
+        item["token_vectors"] = encoder.encode_query(item["query"])
+
+    ids = [str(i) for i in range(len(chunks))]
+    indexes = {}
+    for compression in ("float16", "pq"):
+        start = time.perf_counter()
+        indexes[compression] = MultiVectorIndex.build(ids, token_vectors, compression)
+        print(f"{compression} index: {indexes[compression].nbytes() / 1e6:.1f} MB, "
+              f"built in {time.perf_counter() - start:.1f}s")
+    # float32 copy of the same layout, scored exhaustively
+    reference = MultiVectorIndex.build(ids, token_vectors, "float16")
+    reference.vectors = reference.vectors.astype(np.float32)
+    all_items = np.arange(len(chunks))
+
+    print(f"\n{'path':>24} {'recall@k':>9} {'p50 ms':>10} {'max ms':>10}")
+    if not args.skip_embedding:
+        matrix, query_embeddings = asyncio.run(embed_all(chunks, [item["query"] for item in queries]))
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        for item, embedding in zip(queries, query_embeddings):
+            item["embedding"] = embedding
+        evaluate("embedding (1 vector)", queries, chunks,
+                 lambda item: np.argsort(-(matrix @ item["embedding"]))[:args.k], args.k)
+
+    evaluate("colbert exact float32", queries, chunks,
+             lambda item: np.argsort(-reference.maxsim(item["token_vectors"], all_items))[:args.k], args.k)
+    for compression, index in indexes.items():
+        evaluate(f"colbert pruned {compression}", queries, chunks,
+                 lambda item: [int(i) for i, _ in index.search(item["token_vectors"], args.k, args.nprobe,
+                                                               args.candidates)], args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Load-test a running backend: fire concurrent chat requests at one uvicorn
+worker and report throughput and latency per concurrency level.
+
+Start a single worker, then point the script at it:
+
+    uvicorn main:app --workers 1 --port 8000
+    python benchmarks/bench_concurrency.py --url http://localhost:8000 \
+        --document-id <uuid> --endpoint embedding --concurrency 1 8 32
+
+Run it against a checkout of the old blocking code and the current code to
+compare concurrent requests per worker before and after.
+
+Every request asks a different question (the message plus a request number
+unique to the run), so the query embedding and answer caches never hit and
+each request does the full embed, search and completion.
+"""
+import argparse
+import asyncio
+import itertools
+import uuid
+import statistics
+import time
+
+import httpx
+
+
+async def run_level(client, url, payloads, concurrency, total):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(next(payloads))
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                payload = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": statistics.median(latencies) if latencies else 0.0,
+        "p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--document-id", required=True)
+    parser.add_argument("--endpoint", default="embedding")
+    parser.add_argument("--message", default="What is this document about?")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--requests-per-level", type=int, default=64)
+    args = parser.parse_args()
+
+    url = f"{args.url}/chat/{args.endpoint}"
+    run_id = uuid.uuid4().hex[:8]
+    payloads = ({"message": f"{args.message} (run {run_id}, request {n})", "documentId": args.document_id}
+                for n in itertools.count())
+    async with httpx.AsyncClient(timeout=120) as client:
+        print(f"{'concurrency':>11} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'errors':>7}")
+        for concurrency in args.concurrency:
+            result = await run_level(client, url, payloads, concurrency, max(args.requests_per_level, concurrency))
+            print(f"{result['concurrency']:>11} {result['rps']:>8.2f} {result['p50']:>8.3f} "
+                  f"{result['p95']:>8.3f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
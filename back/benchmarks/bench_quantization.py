@@ -0,0 +1,129 @@
+"""
+Compare float32, halfvec and binary-quantized vector search: index size,
+memory, query latency and recall@k against exact float32 ranking.
+
+Needs a Postgres with pgvector 0.7+, the app schema and the opt-in
+halfvec and binary indexes (sql/vector_precision_indexes.sql). A scratch
+document with synthetic clustered embeddings is inserted and deleted
+again at the end:
+
+    POSTGRES_URL=postgresql://localhost/retrieval python benchmarks/bench_quantization.py --rows 20000 --k 10
+
+The pgvector paths query the HNSW indexes directly, as retrieval does for
+documents above EXACT_SEARCH_THRESHOLD; the memory paths score a cached
+DocumentMatrix, as it does for smaller ones. Index sizes cover the whole
+chunks table, not just the scratch document.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import numpy as np
+import psycopg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chunk_store import make_chunk_rows, write_chunks  # noqa: E402
+from retrieval import (EMBEDDING_DIMENSIONS, HNSW_EF_SEARCH, BINARY_CANDIDATES,  # noqa: E402
+                       ann_search, load_document_matrix, rescore, to_vector_literal)
+
+INDEXES = {
+    "float32": "embeddingIndex",
+    "halfvec": "embedding_halfvec_idx",
+    "binary": "embedding_binary_idx",
+}
+
+
+def synthetic_embeddings(rows: int, queries: int, clusters: int = 200, seed: int = 0):
+    """Unit vectors scattered around random centers, and queries perturbed from random rows."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    matrix = centers[rng.integers(0, clusters, rows)] + rng.standard_normal((rows, EMBEDDING_DIMENSIONS),
+                                                                             dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    query_matrix = matrix[rng.integers(0, rows, queries)] + 0.5 * rng.standard_normal(
+        (queries, EMBEDDING_DIMENSIONS), dtype=np.float32) / np.sqrt(EMBEDDING_DIMENSIONS)
+    return matrix, query_matrix
+
+
+def report(name, latencies, recalls, memory, index_bytes):
+    memory = f"{memory / 1e6:.1f}" if memory is not None else "-"
+    index = f"{index_bytes / 1e6:.1f}" if index_bytes is not None else "-"
+    print(f"{name:>22} {statistics.mean(recalls):>9.3f} {statistics.median(latencies) * 1000:>8.2f} "
+          f"{sorted(latencies)[int(len(latencies) * 0.95)] * 1000:>8.2f} {memory:>10} {index:>9}")
+
+
+async def index_size(conn, name):
+    cursor = await conn.execute("SELECT pg_relation_size(%s::regclass)", (f'"{name}"',))
+    return (await cursor.fetchone())[0]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--ef-search", type=int, default=HNSW_EF_SEARCH)
+    args = parser.parse_args()
+
+    conn = await psycopg.AsyncConnection.connect(os.environ["POSTGRES_URL"].replace("postgres://", "postgresql://"))
+    document_id = str(uuid.uuid4())
+    matrix, query_matrix = synthetic_embeddings(args.rows, args.queries)
+    # Exact float32 ranking every path is measured against
+    truth = [set(np.argsort(-(matrix @ query))[:args.k]) for query in query_matrix]
+
+    await conn.execute("""
+        INSERT INTO documents (id, url, title, status) VALUES (%s, '', 'quantization benchmark', 'completed')
+    """, (document_id,))
+    try:
+        rows = make_chunk_rows(document_id, [f"chunk {i}" for i in range(args.rows)], matrix.tolist())
+        position = {row[0]: i for i, row in enumerate(rows)}
+        start = time.perf_counter()
+        for i in range(0, len(rows), 1000):
+            await write_chunks(conn, rows[i:i + 1000])
+        await conn.execute("ANALYZE chunks")
+        await conn.commit()
+        print(f"inserted {args.rows} chunks in {time.perf_counter() - start:.1f}s, "
+              f"{args.queries} queries, k={args.k}, binary candidates={BINARY_CANDIDATES}\n")
+
+        print(f"{'path':>22} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'memory MB':>10} {'index MB':>9}")
+        for precision, index in INDEXES.items():
+            latencies, recalls = [], []
+            try:
+                for query, expected in zip(query_matrix, truth):
+                    started = time.perf_counter()
+                    hits = await ann_search(conn, document_id, to_vector_literal(query), args.k, args.ef_search,
+                                            precision)
+                    latencies.append(time.perf_counter() - started)
+                    recalls.append(len({position[str(hit["id"])] for hit in hits} & expected) / args.k)
+                report(f"pgvector {precision}", latencies, recalls, None, await index_size(conn, index))
+            except psycopg.Error as e:
+                await conn.rollback()
+                print(f"{'pgvector ' + precision:>22} unavailable: {str(e).splitlines()[0]}")
+
+        for precision in INDEXES:
+            entry = await load_document_matrix(conn, document_id, precision)
+            latencies, recalls = [], []
+            for query, expected in zip(query_matrix, truth):
+                started = time.perf_counter()
+                if precision == "binary":
+                    candidates = entry.hamming_candidates(query, max(args.k, BINARY_CANDIDATES))
+                    hits = await rescore(conn, entry, candidates, query, args.k)
+                else:
+                    hits = entry.top_k(query, args.k)
+                latencies.append(time.perf_counter() - started)
+                recalls.append(len({position[str(hit["id"])] for hit in hits} & expected) / args.k)
+            report(f"memory {precision}", latencies, recalls, entry.nbytes, None)
+    finally:
+        await conn.rollback()
+        await conn.execute("DELETE FROM documents WHERE id = %s", (document_id,))
+        await conn.commit()
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
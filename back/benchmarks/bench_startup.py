@@ -0,0 +1,165 @@
+"""
+Measure cold start: the time to import the app and which of its imports
+dominate that, then the time from launching uvicorn to the first response
+and the latency of the first requests, under each PREWARM mode.
+
+    POSTGRES_URL=postgresql://localhost/retrieval python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --prewarm background off --chat-document <document id>
+
+Without --chat-document the first requests go to /metrics/db, which
+needs no API keys. With it they are embedding chats about that document,
+which do call OpenAI, so the first one shows what a user waits for after
+a redeploy. The prewarm durations are read back from /metrics. --output
+writes the results as JSON for comparing commits.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# main refuses to import without these; only requests that reach the APIs need real ones
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+os.environ.setdefault("VOYAGE_API_KEY", "unused")
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def import_time(runs: int, top: int) -> dict:
+    """Wall-clock seconds of `import main` in a fresh interpreter, and main's slowest direct imports."""
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], cwd=BACK_DIR, check=True)
+        interpreter = time.perf_counter() - started
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                                cwd=BACK_DIR, check=True, capture_output=True, text=True)
+        seconds.append(time.perf_counter() - started - interpreter)
+
+    # Modules imported by main itself are indented one level deeper than main
+    imports = [(match[4], int(match[2]) / 1e6, len(match[3])) for match in IMPORTTIME_LINE.finditer(result.stderr)]
+    main_depth = next(depth for name, _, depth in imports if name == "main")
+    direct = sorted(((name, cumulative) for name, cumulative, depth in imports if depth == main_depth + 2),
+                    key=lambda item: -item[1])
+    return {
+        "p50_s": round(statistics.median(seconds), 3),
+        "max_s": round(max(seconds), 3),
+        "slowest_imports": {name: round(cumulative, 3) for name, cumulative in direct[:top]},
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(url: str, body: dict | None = None) -> tuple[float, int]:
+    """Seconds to a complete response, and its status."""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"} if data else {})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - started, status
+
+
+def prewarm_seconds(url: str) -> dict:
+    with urllib.request.urlopen(f"{url}/metrics", timeout=10) as response:
+        text = response.read().decode()
+    return {step: round(float(value), 3)
+            for step, value in re.findall(r'^startup_prewarm_seconds\{step="([^"]+)"\} (\S+)$', text, re.M)}
+
+
+def serve(prewarm: str, requests: int, chat_document: str | None, settle: float, timeout: float) -> dict:
+    """Launch uvicorn with the given PREWARM mode and time its first responses."""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "PREWARM": prewarm}
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+                              cwd=BACK_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {server.returncode}")
+            try:
+                request(f"{url}/metrics/db")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if time.perf_counter() - started > timeout:
+                    raise RuntimeError(f"no response within {timeout}s")
+                time.sleep(0.01)
+        ready = time.perf_counter() - started
+
+        if chat_document:
+            path, body = "/chat/embedding", {"message": "What is this document about?", "documentId": chat_document}
+        else:
+            path, body = "/metrics/db", None
+        latencies = []
+        for _ in range(requests):
+            seconds, status = request(f"{url}{path}", body)
+            if status != 200:
+                raise RuntimeError(f"{path} returned {status}")
+            latencies.append(round(seconds * 1000, 1))
+
+        # Background prewarming may still be running when the first requests are done
+        time.sleep(settle)
+        return {
+            "prewarm": prewarm,
+            "ready_s": round(ready, 3),
+            "path": path,
+            "request_ms": latencies,
+            "prewarm_s": prewarm_seconds(url),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="interpreter launches to time the import over")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports of main to list")
+    parser.add_argument("--prewarm", nargs="+", default=["background", "startup", "off"],
+                        choices=["background", "startup", "off"])
+    parser.add_argument("--requests", type=int, default=3, help="requests timed after the server responds")
+    parser.add_argument("--chat-document", help="time embedding chats about this document instead of /metrics/db")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait before reading prewarm times")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = {"import": import_time(args.runs, args.top), "serve": []}
+    print(f"import main: p50 {results['import']['p50_s']:.3f}s, max {results['import']['max_s']:.3f}s")
+    for name, seconds in results["import"]["slowest_imports"].items():
+        print(f"  {name:>20} {seconds:.3f}s")
+
+    print(f"\n{'prewarm':>10} {'ready s':>8}  first requests (ms)")
+    for prewarm in args.prewarm:
+        run = serve(prewarm, args.requests, args.chat_document, args.settle, args.timeout)
+        results["serve"].append(run)
+        print(f"{prewarm:>10} {run['ready_s']:>8.3f}  {', '.join(str(ms) for ms in run['request_ms'])}  {run['path']}")
+        if run["prewarm_s"]:
+            print(" " * 21 + ", ".join(f"{step} {seconds}s" for step, seconds in run["prewarm_s"].items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Compare the /chat/* retrieval strategies end to end: latency, throughput
+under concurrency, recall@k and MRR on a fixed synthetic corpus.
+
+Runs offline against a local Postgres with pgvector and the app schema.
+OpenAI embeddings and chat, and the Voyage reranker, are replaced by
+deterministic stand-ins (hashed bag-of-words vectors and word-overlap
+reranking); ColBERT and ColPali use their hashing and stub encoders
+unless COLBERT_ENCODER / COLPALI_EMBEDDER say otherwise. A ColBERT or
+ColPali request that falls back to embeddings aborts the run. Scores measure
+the retrieval pipeline (candidate limits, index pruning, fusion,
+fallbacks), not model quality. --api-latency-ms adds a delay to every
+stubbed API call to stand in for the network.
+
+    POSTGRES_URL=postgresql://localhost/retrieval python benchmarks/bench_strategies.py \
+        --documents 8 --pages 6 --concurrency 1 8 32 --output results.json
+
+Every question is about one fact, stated in exactly one place in the
+corpus; a result is relevant when its text contains the fact's serial
+number. The corpus is inserted as scratch documents, with local ColBERT
+and page indexes, and deleted again at the end. Results are printed as a
+table and written as JSON (to stdout with --output -) for tracking
+regressions across releases.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pymupdf
+
+os.environ.setdefault("OPENAI_API_KEY", "offline")
+os.environ.setdefault("VOYAGE_API_KEY", "offline")
+# The index stores only look indexes up when their strategy is enabled
+os.environ.setdefault("COLBERT_ENABLED", "true")
+os.environ.setdefault("COLPALI_ENABLED", "true")
+os.environ.setdefault("COLBERT_ENCODER", "hashing")
+os.environ.setdefault("COLPALI_EMBEDDER", "stub")
+INDEX_DIR = tempfile.mkdtemp(prefix="bench-strategies-")
+os.environ["MULTIVECTOR_INDEX_DIR"] = INDEX_DIR
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+import retrieval  # noqa: E402
+from cache import TieredCache  # noqa: E402
+from chunk_store import make_chunk_rows, write_chunks  # noqa: E402
+from db import close_pool  # noqa: E402
+from embeddings import EMBEDDING_MODEL, get_openai_client, openai_embed_batch  # noqa: E402
+from ingest import count_pdf_pages, iter_chunks, iter_document_text, shutdown_extract_executor  # noqa: E402
+from late_interaction import build_colbert_index, colbert_indexes  # noqa: E402
+from multivector import MultiVectorIndex  # noqa: E402
+from page_retrieval import (COLPALI_COMPRESSION, COLPALI_DPI, embed_page_batch, page_indexes,  # noqa: E402
+                            shutdown_executor)
+from retrieval import EMBEDDING_DIMENSIONS  # noqa: E402
+
+STRATEGIES = {
+    "embedding": main.chat_embedding,
+    "rerank": main.chat_rerank,
+    "hybrid": main.chat_hybrid,
+    "colbert": main.chat_colbert,
+    "colpali": main.chat_colpali,
+}
+
+CITIES = "Oslo Lima Perth Quito Riga Dakar Hanoi Tunis Cork Split".split()
+PEOPLE = "Ada Bram Cleo Dev Esme Finn Gus Hana Ivo Juno".split()
+PARTS = "relay valve pump gasket rotor sensor bearing flange".split()
+FILLER = ("maintenance log inspection schedule shift report crew equipment output pressure reading "
+          "the a of and to in is for on with as by at from that this was were").split()
+
+
+def words(text: str):
+    return re.findall(r"\w+", text.lower())
+
+
+def hashed_embedding(text: str) -> list:
+    """Bag of words hashed into the embedding dimensions, L2-normalized."""
+    vector = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    for word in words(text):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        vector[int.from_bytes(digest, "little") % EMBEDDING_DIMENSIONS] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def install_stubs(api_latency: float):
+    """Route OpenAI and Voyage calls to local stand-ins."""
+
+    async def embeddings_create(model, input, **kwargs):
+        await asyncio.sleep(api_latency)
+        texts = [input] if isinstance(input, str) else input
+        return SimpleNamespace(data=[SimpleNamespace(embedding=hashed_embedding(text), index=i)
+                                     for i, text in enumerate(texts)])
+
+    async def chat_create(**kwargs):
+        await asyncio.sleep(api_latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Benchmark answer."))])
+
+    async def rerank(query, documents, model, top_k=None, **kwargs):
+        await asyncio.sleep(api_latency)
+        query_words = set(words(query))
+        scores = [len(query_words & set(words(document))) / (len(query_words) or 1) for document in documents]
+        order = sorted(range(len(documents)), key=lambda i: -scores[i])[:top_k]
+        return SimpleNamespace(results=[SimpleNamespace(index=i, relevance_score=scores[i]) for i in order])
+
+    openai_client = get_openai_client()
+    openai_client.embeddings.create = embeddings_create
+    openai_client.chat.completions.create = chat_create
+    main.get_voyage_client().rerank = rerank
+
+
+async def refuse_fallback(request):
+    raise RuntimeError("no index found, the strategy fell back to embeddings")
+
+
+def disable_caches():
+    """Repeated questions would otherwise be answered from the query embedding and answer caches."""
+    main.query_embedding_cache = TieredCache("embedding", 0, 0)
+    main.answer_cache = TieredCache("answer", 0, 0)
+
+
+def synthetic_corpus(documents: int, pages: int, facts_per_page: int, seed: int = 0):
+    """
+    Page texts of each document, and one question per fact.
+
+    Facts share their vocabulary (parts, cities, people) with each other and
+    with the filler, so only the serial number singles out the right passage.
+    """
+    rng = random.Random(seed)
+    serials = rng.sample(range(10000, 99999), documents * pages * facts_per_page)
+    corpus, questions = [], []
+    for _ in range(documents):
+        page_texts = []
+        for _ in range(pages):
+            paragraphs = []
+            for _ in range(facts_per_page):
+                serial = f"SN{serials.pop()}"
+                part, city, person = rng.choice(PARTS), rng.choice(CITIES), rng.choice(PEOPLE)
+                year = rng.randint(1990, 2024)
+                filler = " ".join(" ".join(rng.choices(FILLER, k=rng.randint(8, 16))).capitalize() + "."
+                                  for _ in range(3))
+                paragraphs.append(f"{filler} The {part} {serial} in {city} was calibrated by {person} in {year}.")
+                questions.append({"question": f"Who calibrated the {part} {serial} in {city}?", "answer": serial})
+            page_texts.append("\n".join(paragraphs))
+        corpus.append(page_texts)
+    return corpus, questions
+
+
+def write_pdf(path: str, page_texts):
+    doc = pymupdf.open()
+    for text in page_texts:
+        page = doc.new_page()
+        page.insert_textbox(pymupdf.Rect(50, 50, 545, 792), text, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+async def ingest_document(conn, document_id: str, path: str):
+    """Chunk, embed and index a PDF as ingestion would, keeping indexes on local disk only."""
+    chunks = [chunk async for chunk in iter_chunks(iter_document_text(path, os.path.basename(path)))]
+    embeddings = await openai_embed_batch([chunk.text for chunk in chunks])
+    rows = make_chunk_rows(document_id, chunks, embeddings)
+    await write_chunks(conn, rows)
+
+    colbert = await asyncio.to_thread(build_colbert_index, [row[0] for row in rows], [chunk.text for chunk in chunks])
+    colbert.save(colbert_indexes.local_path(document_id))
+
+    page_count = await asyncio.to_thread(count_pdf_pages, path)
+    pages = await asyncio.to_thread(embed_page_batch, path, list(range(1, page_count + 1)), COLPALI_DPI)
+    index = await asyncio.to_thread(
+        MultiVectorIndex.build, [str(number) for number, _, _ in pages], [vectors for _, _, vectors in pages],
+        COLPALI_COMPRESSION, payloads=[{"text": text} for _, text, _ in pages],
+    )
+    index.save(page_indexes.local_path(document_id))
+    return len(rows)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))] if values else 0.0
+
+
+def ranking_metrics(results, answers, k):
+    """recall@k and MRR of the returned chunks; each question has exactly one relevant passage."""
+    recalls, reciprocal_ranks = [], []
+    for chunks, answer in zip(results, answers):
+        rank = next((i for i, chunk in enumerate(chunks[:k], start=1) if answer in chunk["text"]), None)
+        recalls.append(1.0 if rank else 0.0)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+    return statistics.mean(recalls), statistics.mean(reciprocal_ranks)
+
+
+async def ask(endpoint, scope, question, k):
+    started = time.perf_counter()
+    reply = await endpoint(main.ChatRequest(message=question, topK=k, **scope))
+    return time.perf_counter() - started, reply["chunks"]
+
+
+async def run_level(endpoint, scope, questions, k, concurrency, total):
+    """Answer total questions, round-robin over the set, with concurrency requests in flight."""
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(questions[i % len(questions)]["question"])
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            question = queue.get_nowait()
+            try:
+                latency, _ = await ask(endpoint, scope, question, k)
+                latencies.append(latency)
+            except Exception as e:
+                errors += 1
+                print(f"Benchmark request error: {str(e)}", file=sys.stderr)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "qps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+    }
+
+
+async def run_strategy(name, scope, questions, args):
+    endpoint = STRATEGIES[name]
+    # ColBERT and ColPali answer from embeddings when they find no index; fail instead of
+    # reporting embedding results under their name
+    main.chat_embedding = refuse_fallback if name in ("colbert", "colpali") else STRATEGIES["embedding"]
+    try:
+        # Warm up: matrix cache, index files, worker processes
+        for item in questions[:args.warmup]:
+            await ask(endpoint, scope, item["question"], args.k)
+
+        latencies, results = [], []
+        for item in questions:
+            latency, chunks = await ask(endpoint, scope, item["question"], args.k)
+            latencies.append(latency)
+            results.append(chunks)
+        recall, mrr = ranking_metrics(results, [item["answer"] for item in questions], args.k)
+
+        throughput = [
+            await run_level(endpoint, scope, questions, args.k, concurrency,
+                            max(args.requests_per_level, concurrency))
+            for concurrency in args.concurrency
+        ]
+    finally:
+        main.chat_embedding = STRATEGIES["embedding"]
+    return {
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "mean": round(statistics.mean(latencies) * 1000, 2),
+        },
+        f"recall_at_{args.k}": round(recall, 4),
+        "mrr": round(mrr, 4),
+        "throughput": throughput,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def settings():
+    """Retrieval settings the results depend on."""
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "retrieval_mode": retrieval.RETRIEVAL_MODE,
+        "vector_precision": retrieval.VECTOR_PRECISION,
+        "exact_search_threshold": retrieval.EXACT_SEARCH_THRESHOLD,
+        "hnsw_ef_search": retrieval.HNSW_EF_SEARCH,
+        "hybrid_candidates": retrieval.HYBRID_CANDIDATES,
+        "rerank_candidates": main.RERANK_CANDIDATES,
+        "colbert_encoder": os.environ["COLBERT_ENCODER"],
+        "colpali_embedder": os.environ["COLPALI_EMBEDDER"],
+    }
+
+
+def print_table(report, k):
+    out = sys.stderr
+    print(f"\n{'strategy':>10} {'recall@' + str(k):>9} {'mrr':>6} {'p50 ms':>8} {'p95 ms':>8}  qps by concurrency",
+          file=out)
+    for name, result in report["strategies"].items():
+        qps = "  ".join(f"{level['concurrency']}:{level['qps']}" for level in result["throughput"])
+        print(f"{name:>10} {result[f'recall_at_{k}']:>9.3f} {result['mrr']:>6.3f} "
+              f"{result['latency_ms']['p50']:>8.2f} {result['latency_ms']['p95']:>8.2f}  {qps}", file=out)
+
+
+async def main_async(args):
+    install_stubs(args.api_latency_ms / 1000)
+    if not args.cache:
+        disable_caches()
+
+    corpus, questions = synthetic_corpus(args.documents, args.pages, args.facts_per_page, args.seed)
+    questions = random.Random(args.seed).sample(questions, min(args.questions, len(questions)))
+    collection = f"benchmark-{uuid.uuid4()}"
+    document_ids = [str(uuid.uuid4()) for _ in corpus]
+    # One document is searched on its own; several go through the multi-document paths
+    scope = {"documentId": document_ids[0]} if len(document_ids) == 1 else {"collection": collection}
+
+    chunk_count = 0
+    try:
+        async with main.get_db() as conn:
+            for i, (document_id, page_texts) in enumerate(zip(document_ids, corpus)):
+                path = os.path.join(INDEX_DIR, f"document-{i}.pdf")
+                write_pdf(path, page_texts)
+                await conn.execute("""
+                    INSERT INTO documents (id, url, title, status, collection, created_at)
+                    VALUES (%s, '', %s, 'completed', %s, NOW())
+                """, (document_id, f"strategy benchmark {i}", collection))
+                chunk_count += await ingest_document(conn, document_id, path)
+            await conn.execute("ANALYZE chunks")
+        print(f"{len(corpus)} documents, {chunk_count} chunks, {len(questions)} questions, k={args.k}",
+              file=sys.stderr)
+
+        report = {
+            "generated_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "corpus": {"documents": len(corpus), "pages_per_document": args.pages, "chunks": chunk_count,
+                       "questions": len(questions), "seed": args.seed},
+            "parameters": {"k": args.k, "concurrency": args.concurrency,
+                           "requests_per_level": args.requests_per_level,
+                           "api_latency_ms": args.api_latency_ms, "caches": args.cache},
+            "settings": settings(),
+            "strategies": {},
+        }
+        for name in args.strategies:
+            print(f"running {name}", file=sys.stderr)
+            report["strategies"][name] = await run_strategy(name, scope, questions, args)
+    finally:
+        async with main.get_db() as conn:
+            await conn.execute("DELETE FROM documents WHERE id = ANY(%s::uuid[])", (document_ids,))
+        for document_id in document_ids:
+            main.matrix_cache.invalidate(document_id)
+        await close_pool()
+        shutdown_executor()
+        shutdown_extract_executor()
+        shutil.rmtree(INDEX_DIR, ignore_errors=True)
+
+    print_table(report, args.k)
+    payload = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(payload)
+    else:
+        with open(args.output, "w") as f:
+            f.write(payload + "\n")
+        print(f"\nwrote {args.output}", file=sys.stderr)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=list(STRATEGIES))
+    parser.add_argument("--documents", type=int, default=8)
+    parser.add_argument("--pages", type=int, default=6)
+    parser.add_argument("--facts-per-page", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests-per-level", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="keep the query embedding and answer caches on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="JSON results file, or - for stdout")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
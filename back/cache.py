@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict
+
+from db import get_db
+
+# "memory" keeps entries per process; "disk" adds a SQLite file shared by workers on the node;
+# "postgres" adds the cache_entries table shared by every node
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_DISK_PATH = os.getenv("CACHE_DISK_PATH", "/tmp/retrieval-cache.sqlite3")
+
+# Fraction of writes to a shared backend that also delete expired entries
+CACHE_PURGE_PROBABILITY = 0.01
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "10000"))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "5000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+
+
+def normalize_query(text: str) -> str:
+    """Case- and whitespace-insensitive form of a question, used for cache keys."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def hash_key(*parts: Any) -> str:
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """In-process LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, expires_at: float | None = None):
+        with self._lock:
+            self._entries[key] = (expires_at or time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """Cache entries in a local SQLite file so worker processes on one node share them."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL
+                )
+            """)
+            self._local.conn = conn
+        return conn
+
+    def _get(self, key: str):
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM cache_entries WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _set(self, key: str, value: Any, expires_at: float):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at),
+        )
+        if random.random() < CACHE_PURGE_PROBABILITY:
+            conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        conn.commit()
+
+    async def get(self, key: str):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, expires_at: float):
+        await asyncio.to_thread(self._set, key, value, expires_at)
+
+
+class PostgresBackend:
+    """Cache entries in the cache_entries table, shared by every node."""
+
+    async def get(self, key: str):
+        async with get_db() as conn:
+            cur = await conn.execute("""
+                SELECT value, extract(epoch FROM expires_at)
+                FROM cache_entries
+                WHERE key = %s AND expires_at > NOW()
+            """, (key,))
+            row = await cur.fetchone()
+        return (row[0], float(row[1])) if row else None
+
+    async def set(self, key: str, value: Any, expires_at: float):
+        async with get_db() as conn:
+            await conn.execute("""
+                INSERT INTO cache_entries (key, value, expires_at)
+                VALUES (%s, %s, to_timestamp(%s))
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            """, (key, json.dumps(value), expires_at))
+            if random.random() < CACHE_PURGE_PROBABILITY:
+                await conn.execute("DELETE FROM cache_entries WHERE expires_at <= NOW()")
+
+
+def make_backend(kind: str):
+    if kind == "disk":
+        return SQLiteBackend(CACHE_DISK_PATH)
+    if kind == "postgres":
+        return PostgresBackend()
+    return None
+
+
+class TieredCache:
+    """
+    An in-process LRU in front of an optional shared backend.
+
+    Backend failures are logged and treated as misses so a cache outage
+    never fails a request.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, ttl)
+        self.backend = backend
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        key = f"{self.name}:{key}"
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.backend is not None:
+            try:
+                found = await self.backend.get(key)
+            except Exception as e:
+                print(f"Cache backend error ({self.name}): {str(e)}")
+                found = None
+            if found is not None:
+                value, expires_at = found
+                self.memory.set(key, value, expires_at)
+                self.backend_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        key = f"{self.name}:{key}"
+        expires_at = time.time() + self.ttl
+        self.memory.set(key, value, expires_at)
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, value, expires_at)
+            except Exception as e:
+                print(f"Cache backend error ({self.name}): {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.backend_hits + self.misses
+        return {
+            "entries": len(self.memory),
+            "hits": self.hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.backend_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+_backend = make_backend(CACHE_BACKEND)
+
+# normalized query text -> embedding
+query_embedding_cache = TieredCache("embedding", QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL, _backend)
+
+# (searched documents, strategy, top chunk ids, normalized query) -> final answer
+answer_cache = TieredCache("answer", ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, _backend)
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    return hash_key(model, normalize_query(text))
+
+
+def answer_cache_key(documents, strategy: str, chunk_ids: list, query: str) -> str:
+    """
+    documents is the resolved scope of the request: a document id, a list
+    of them, or None for the whole corpus.
+    """
+    if documents is None:
+        scope = "*"
+    elif isinstance(documents, str):
+        scope = documents
+    else:
+        scope = ",".join(sorted(str(document_id) for document_id in documents))
+    return hash_key(scope, strategy, ",".join(str(chunk_id) for chunk_id in chunk_ids), normalize_query(query))
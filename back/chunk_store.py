@@ -0,0 +1,110 @@
+import io
+import os
+import struct
+import uuid
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from chunker import Chunk
+
+# "copy" streams rows with COPY ... (FORMAT binary); "values" uses pipelined INSERTs
+CHUNK_WRITE_METHOD = os.getenv("CHUNK_WRITE_METHOD", "copy")
+
+# Rows written per transaction during ingestion; each commit makes a batch visible to /status
+CHUNK_COMMIT_BATCH = int(os.getenv("CHUNK_COMMIT_BATCH", "256"))
+
+# (id, document_id, text, embedding, order, start_offset, end_offset, page_start, page_end, token_count)
+ChunkRow = Tuple[str, str, str, list, int, int | None, int | None, int | None, int | None, int | None]
+
+COPY_COLUMNS = '(id, document_id, text, embedding, "order", start_offset, end_offset, page_start, page_end, token_count)'
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+
+
+def make_chunk_rows(document_id: str, chunks: List[Chunk | str], embeddings: List[list], start: int = 0) -> List[ChunkRow]:
+    """Pair chunks (or bare texts, without offsets and pages) with their embeddings, numbering them from start."""
+    rows = []
+    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
+        if isinstance(chunk, Chunk):
+            rows.append((str(uuid.uuid4()), document_id, chunk.text, embedding, start + i,
+                         chunk.start, chunk.end, chunk.page_start, chunk.page_end, chunk.tokens))
+        else:
+            rows.append((str(uuid.uuid4()), document_id, chunk, embedding, start + i, None, None, None, None, None))
+    return rows
+
+
+def _encode_uuid(value: str) -> bytes:
+    return struct.pack("!i", 16) + uuid.UUID(str(value)).bytes
+
+
+def _encode_int(value: int | None) -> bytes:
+    if value is None:
+        return struct.pack("!i", -1)
+    return struct.pack("!ii", 4, value)
+
+
+def _encode_vector(embedding) -> bytes:
+    """pgvector's binary format: int16 dimensions, int16 unused, then big-endian float4s."""
+    if embedding is None:
+        return struct.pack("!i", -1)
+    values = np.asarray(embedding, dtype=">f4")
+    data = struct.pack("!hh", len(values), 0) + values.tobytes()
+    return struct.pack("!i", len(data)) + data
+
+
+def decode_vectors(values: List[bytes]) -> np.ndarray:
+    """Stack pgvector values received in binary format into a float32 matrix, one row per value."""
+    if not values:
+        return np.empty((0, 0), dtype=np.float32)
+    dimensions = struct.unpack("!h", values[0][:2])[0]
+    data = b"".join(value[4:] for value in values)
+    return np.frombuffer(data, dtype=">f4").reshape(len(values), dimensions).astype(np.float32)
+
+
+def encode_copy_binary(rows: Iterable[ChunkRow]) -> bytes:
+    """Encode chunk rows as a PostgreSQL binary COPY stream matching COPY_COLUMNS."""
+    buffer = io.BytesIO()
+    buffer.write(PGCOPY_HEADER)
+    for chunk_id, document_id, text, embedding, order, *positions in rows:
+        text_bytes = text.encode("utf-8")
+        buffer.write(struct.pack("!h", 10))
+        buffer.write(_encode_uuid(chunk_id))
+        buffer.write(_encode_uuid(document_id))
+        buffer.write(struct.pack("!i", len(text_bytes)))
+        buffer.write(text_bytes)
+        buffer.write(_encode_vector(embedding))
+        buffer.write(_encode_int(order))
+        for value in positions:
+            buffer.write(_encode_int(value))
+    buffer.write(PGCOPY_TRAILER)
+    return buffer.getvalue()
+
+
+async def copy_chunks(cur, rows: List[ChunkRow], table: str = "chunks"):
+    """Write rows with a single binary COPY."""
+    async with cur.copy(f"COPY {table} {COPY_COLUMNS} FROM STDIN WITH (FORMAT binary)") as copy:
+        await copy.write(encode_copy_binary(rows))
+
+
+async def insert_chunks_values(cur, rows: List[ChunkRow], table: str = "chunks"):
+    """Write rows with INSERT statements sent in one pipeline."""
+    await cur.executemany(
+        f"INSERT INTO {table} {COPY_COLUMNS} VALUES (%s, %s, %s, %s::vector, %s, %s, %s, %s, %s, %s)",
+        [(chunk_id, document_id, text, "[" + ",".join(map(str, embedding)) + "]", *rest)
+         for chunk_id, document_id, text, embedding, *rest in rows],
+    )
+
+
+async def write_chunks(conn, rows: List[ChunkRow], method: str | None = None, table: str = "chunks"):
+    """Write a batch of chunk rows in one transaction."""
+    if not rows:
+        return
+    method = method or CHUNK_WRITE_METHOD
+    async with conn.cursor() as cur:
+        if method == "copy":
+            await copy_chunks(cur, rows, table)
+        else:
+            await insert_chunks_values(cur, rows, table)
+    await conn.commit()
@@ -0,0 +1,188 @@
+import os
+import threading
+from bisect import bisect_right
+from collections import deque
+from typing import List
+
+from embeddings import get_tokenizer
+
+# Chunk size in embedding-model tokens
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+
+# Trailing sentences of a chunk, up to this many tokens, are repeated at the start of the next one
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+
+# Text without a sentence boundary is cut once this much of it is pending; bounds the buffer
+MAX_PENDING_CHARS = 64 * 1024
+
+# Bundled NLTK data (the Dockerfile downloads punkt_tab here at build time), searched before NLTK's default
+# locations so nothing is fetched at runtime
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nltk_data"))
+
+_punkt = None
+_punkt_lock = threading.Lock()
+
+
+def get_sentence_tokenizer():
+    """The sentence tokenizer; nltk is imported and the punkt_tab data loaded on first use."""
+    global _punkt
+    with _punkt_lock:
+        if _punkt is None:
+            import nltk
+            from nltk.tokenize import PunktTokenizer
+
+            if NLTK_DATA_DIR not in nltk.data.path:
+                nltk.data.path.insert(0, NLTK_DATA_DIR)
+            _punkt = PunktTokenizer("english")
+        return _punkt
+
+
+def sentence_spans(text: str) -> List[tuple[int, int]]:
+    """(start, end) character spans of the sentences in text, without surrounding whitespace."""
+    spans = []
+    for start, end in get_sentence_tokenizer().span_tokenize(text):
+        # Punkt's first span starts at 0 even when the text opens with whitespace
+        sentence = text[start:end]
+        stripped = sentence.lstrip()
+        start += len(sentence) - len(stripped)
+        end = start + len(stripped.rstrip())
+        if end > start:
+            spans.append((start, end))
+    return spans
+
+
+class Chunk:
+    """A piece of a document: its text, [start, end) character offsets in the whole text, pages and token count."""
+
+    __slots__ = ("text", "start", "end", "page_start", "page_end", "tokens")
+
+    def __init__(self, text: str, start: int, end: int, page_start: int | None, page_end: int | None, tokens: int):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.page_start = page_start
+        self.page_end = page_end
+        self.tokens = tokens
+
+
+class StreamingChunker:
+    """
+    Single-pass chunker for text that arrives piece by piece (e.g. page by page).
+
+    Only the unfinished last sentence and the sentences of the chunk being
+    built are held, so memory doesn't grow with the document. Sentences are
+    packed into chunks of at most max_tokens tokens of the embedding
+    model's tokenizer; a sentence longer than that is cut on token
+    boundaries. Each chunk's text is exactly the document text between its
+    offsets.
+    """
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.tokenizer = get_tokenizer()
+        self._buffer = ""
+        self._buffer_start = 0
+        self._page_starts: List[int] = []
+        self._page_numbers: List[int | None] = []
+        # (start, end, whitespace before, text, tokens) of the sentences in the chunk being built
+        self._sentences = deque()
+        self._tokens = 0
+
+    def _page_at(self, offset: int) -> int | None:
+        i = bisect_right(self._page_starts, offset) - 1
+        return self._page_numbers[i] if i >= 0 else None
+
+    def _make_chunk(self, start: int, end: int, text: str, tokens: int) -> Chunk:
+        return Chunk(text, start, end, self._page_at(start), self._page_at(max(start, end - 1)), tokens)
+
+    def _emit(self) -> List[Chunk]:
+        """Close the chunk being built, keeping its trailing sentences that fit the overlap budget."""
+        if not self._sentences:
+            return []
+        sentences = list(self._sentences)
+        text = sentences[0][3] + "".join(gap + sentence for _, _, gap, sentence, _ in sentences[1:])
+        chunk = self._make_chunk(sentences[0][0], sentences[-1][1], text,
+                                 len(self.tokenizer.encode_ordinary(text)))
+
+        kept = 0
+        kept_tokens = 0
+        while kept < len(sentences) and kept_tokens + sentences[-1 - kept][4] <= self.overlap_tokens:
+            kept_tokens += sentences[-1 - kept][4]
+            kept += 1
+        if kept == len(sentences):
+            # Carrying everything over would repeat this chunk in the next one
+            kept = kept_tokens = 0
+        self._sentences = deque(sentences[len(sentences) - kept:])
+        self._tokens = kept_tokens
+        return [chunk]
+
+    def _split_long(self, start: int, text: str) -> List[Chunk]:
+        """Cut a sentence longer than max_tokens into max_tokens pieces."""
+        tokens = self.tokenizer.encode_ordinary(text)
+        _, offsets = self.tokenizer.decode_with_offsets(tokens)
+        chunks = []
+        for i in range(0, len(tokens), self.max_tokens):
+            piece_start = offsets[i]
+            piece_end = offsets[i + self.max_tokens] if i + self.max_tokens < len(tokens) else len(text)
+            chunks.append(self._make_chunk(start + piece_start, start + piece_end, text[piece_start:piece_end],
+                                           min(self.max_tokens, len(tokens) - i)))
+        return chunks
+
+    def _add_sentence(self, start: int, end: int, gap: str, text: str) -> List[Chunk]:
+        tokens = len(self.tokenizer.encode_ordinary(text))
+        if tokens > self.max_tokens:
+            chunks = self._emit()
+            self._sentences.clear()
+            self._tokens = 0
+            return chunks + self._split_long(start, text)
+        chunks = []
+        # One token of slack per sentence for the whitespace joining them
+        if self._sentences and self._tokens + tokens + len(self._sentences) > self.max_tokens:
+            chunks = self._emit()
+        self._sentences.append((start, end, gap, text, tokens))
+        self._tokens += tokens
+        return chunks
+
+    def _consume(self, spans: List[tuple[int, int]]) -> List[Chunk]:
+        """Add the given sentences of the buffer. The buffer starts right after the last consumed sentence."""
+        chunks = []
+        previous_end = 0
+        for start, end in spans:
+            chunks.extend(self._add_sentence(self._buffer_start + start, self._buffer_start + end,
+                                             self._buffer[previous_end:start], self._buffer[start:end]))
+            previous_end = end
+        return chunks
+
+    def feed(self, text: str, page: int | None = None) -> List[Chunk]:
+        """Add the next piece of text (from the given page) and return the chunks it completed."""
+        self._page_starts.append(self._buffer_start + len(self._buffer))
+        self._page_numbers.append(page)
+        self._buffer += text
+        spans = sentence_spans(self._buffer)
+        if not spans:
+            return []
+        # The last sentence may continue in the next piece; hold it back unless too much is pending
+        complete = spans if len(self._buffer) - spans[-1][0] >= MAX_PENDING_CHARS else spans[:-1]
+        chunks = self._consume(complete)
+        if complete:
+            cut = complete[-1][1]
+            self._buffer_start += cut
+            self._buffer = self._buffer[cut:]
+        return chunks
+
+    def finish(self) -> List[Chunk]:
+        """Return the remaining chunks at the end of the document."""
+        chunks = self._consume(sentence_spans(self._buffer))
+        self._buffer_start += len(self._buffer)
+        self._buffer = ""
+        chunks.extend(self._emit())
+        self._sentences.clear()
+        self._tokens = 0
+        return chunks
+
+
+def chunk_text(text: str, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Chunk]:
+    """Chunk a whole text at once."""
+    chunker = StreamingChunker(max_tokens, overlap_tokens)
+    return chunker.feed(text) + chunker.finish()
@@ -0,0 +1,187 @@
+import os
+import re
+import threading
+from typing import Any, Dict, List
+
+import tiktoken
+from tiktoken.model import encoding_name_for_model
+
+from embeddings import EMBEDDING_MODEL, get_tokenizer
+
+# Chat model answering from the retrieved context
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-3.5-turbo")
+
+# Most tokens of retrieved text put in a prompt, counted with the chat model's tokenizer
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))
+
+# A chunk sharing at least this fraction of its word trigrams with a better-ranked one is dropped
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+PASSAGE_SEPARATOR = "\n\n"
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_chat_tokenizer() -> tiktoken.Encoding:
+    """The chat model's tokenizer, shared with the embedding model when they use the same encoding."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            if encoding_name_for_model(CHAT_MODEL) == encoding_name_for_model(EMBEDDING_MODEL):
+                _tokenizer = get_tokenizer()
+            else:
+                _tokenizer = tiktoken.encoding_for_model(CHAT_MODEL)
+        return _tokenizer
+
+
+def count_chat_tokens(text: str) -> int:
+    return len(get_chat_tokenizer().encode_ordinary(text))
+
+
+def shingles(text: str) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def near_duplicate(left: set, right: set, threshold: float) -> bool:
+    """Whether the smaller of two trigram sets mostly appears in the other."""
+    return len(left & right) >= threshold * min(len(left), len(right))
+
+
+def overlap_length(left: str, right: str) -> int:
+    """
+    Length of the longest suffix of left that right starts with, starting
+    on a word boundary: the sentences chunking repeated from one chunk at
+    the start of the next.
+    """
+    if not right:
+        return 0
+    position = left.find(right[0], max(0, len(left) - len(right)))
+    while position != -1:
+        if (position == 0 or left[position - 1].isspace()) and right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(right[0], position + 1)
+    return 0
+
+
+class Passage:
+    """Consecutive chunks of one document, merged into one piece of context."""
+
+    def __init__(self, chunk: Dict[str, Any], rank: int):
+        self.rank = rank
+        self.chunks = [chunk]
+        self.text = chunk["text"]
+
+    def copy(self) -> "Passage":
+        copy = Passage.__new__(Passage)
+        copy.__dict__.update(self.__dict__)
+        copy.chunks = list(self.chunks)
+        return copy
+
+    def follows(self, chunk: Dict[str, Any]) -> bool:
+        """Whether the chunk comes right after this passage in the same document."""
+        return adjacent(self.chunks[-1], chunk)
+
+    def precedes(self, chunk: Dict[str, Any]) -> bool:
+        return adjacent(chunk, self.chunks[0])
+
+    def append(self, chunk: Dict[str, Any], rank: int):
+        self.text = join_adjacent(self.text, chunk["text"])
+        self.rank = min(self.rank, rank)
+        self.chunks.append(chunk)
+
+    def prepend(self, chunk: Dict[str, Any], rank: int):
+        self.text = join_adjacent(chunk["text"], self.text)
+        self.rank = min(self.rank, rank)
+        self.chunks.insert(0, chunk)
+
+    def absorb(self, other: "Passage"):
+        """Append a passage that starts right after this one ends."""
+        self.text = join_adjacent(self.text, other.text)
+        self.rank = min(self.rank, other.rank)
+        self.chunks.extend(other.chunks)
+
+
+def adjacent(chunk: Dict[str, Any], next_chunk: Dict[str, Any]) -> bool:
+    """Whether next_chunk comes right after chunk in the same document."""
+    return (chunk.get("order") is not None and next_chunk.get("order") == chunk["order"] + 1
+            and chunk.get("document") == next_chunk.get("document"))
+
+
+def join_adjacent(left: str, right: str) -> str:
+    """Text of two consecutive chunks, without the overlap they share."""
+    overlap = overlap_length(left, right)
+    return left + right[overlap:] if overlap else f"{left} {right}"
+
+
+class Context:
+    """The packed context of a prompt: its passages, text and token count."""
+
+    def __init__(self, passages: List[Passage], tokens: int):
+        self.passages = passages
+        self.tokens = tokens
+        self.text = PASSAGE_SEPARATOR.join(passage.text for passage in passages)
+
+
+def place(passages: List[Passage], chunk: Dict[str, Any], rank: int) -> List[Passage]:
+    """New passages with the chunk added: merged into its neighbours when they are in, on its own otherwise."""
+    passages = [passage.copy() for passage in passages]
+    before = next((passage for passage in passages if passage.follows(chunk)), None)
+    after = next((passage for passage in passages if passage.precedes(chunk)), None)
+    if before and after:
+        before.append(chunk, rank)
+        before.absorb(after)
+        passages.remove(after)
+    elif before:
+        before.append(chunk, rank)
+    elif after:
+        after.prepend(chunk, rank)
+    else:
+        passages.append(Passage(chunk, rank))
+    return passages
+
+
+def passages_tokens(passages: List[Passage]) -> int:
+    return count_chat_tokens(PASSAGE_SEPARATOR.join(passage.text for passage in passages))
+
+
+def build_context(chunks: List[Dict[str, Any]], max_tokens: int = CONTEXT_MAX_TOKENS,
+                  dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD) -> Context:
+    """
+    Pack ranked chunks (best first) into at most max_tokens of context.
+
+    Chunks are taken in rank order; one that would overflow the budget is
+    skipped in favour of smaller, lower-ranked ones. Near-duplicates of a
+    better-ranked chunk are dropped. Chunks next to each other in the same
+    document (by "order", and "document" when results span several) are
+    merged into one passage, with the text their overlap repeats kept
+    once. Passages are ordered by their best-ranked chunk.
+    """
+    passages: List[Passage] = []
+    tokens = 0
+    kept = []  # (chunk, its word trigrams) of the chunks packed so far
+    for rank, chunk in enumerate(chunks):
+        chunk_shingles = shingles(chunk["text"])
+        if any(near_duplicate(chunk_shingles, other_shingles, dedup_threshold)
+               # Neighbours share their overlap by design; merging removes it instead
+               for other, other_shingles in kept if not adjacent(other, chunk) and not adjacent(chunk, other)):
+            continue
+        candidate = place(passages, chunk, rank)
+        candidate_tokens = passages_tokens(candidate)
+        if candidate_tokens > max_tokens:
+            continue
+        passages, tokens = candidate, candidate_tokens
+        kept.append((chunk, chunk_shingles))
+
+    if not passages and chunks:
+        # Even the best chunk is over budget; keep as much of it as fits
+        tokenizer = get_chat_tokenizer()
+        passage = Passage(chunks[0], 0)
+        passage.text = tokenizer.decode(tokenizer.encode_ordinary(passage.text)[:max_tokens])
+        passages, tokens = [passage], passages_tokens([passage])
+
+    passages.sort(key=lambda passage: passage.rank)
+    return Context(passages, tokens)
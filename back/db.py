@@ -0,0 +1,144 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from fastapi import HTTPException
+
+from metrics import DB_WAIT_SECONDS, add_timing
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
+# Seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Idle connections are pinged this often, and broken ones replaced, in the background
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+# Server-side limit for any single statement, in milliseconds (0 disables it)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+
+def get_postgres_url() -> str:
+    postgres_url = os.getenv('POSTGRES_URL')
+    if not postgres_url:
+        raise HTTPException(
+            status_code=500,
+            detail="POSTGRES_URL not found in environment variables"
+        )
+    # Convert URL to connection string if needed
+    if postgres_url.startswith('postgres://'):
+        postgres_url = postgres_url.replace('postgres://', 'postgresql://')
+    return postgres_url
+
+
+async def _check_connection(conn: psycopg.AsyncConnection):
+    """Reject connections the driver already knows are unusable, without a round trip."""
+    if conn.closed or conn.broken:
+        raise psycopg.OperationalError("connection is closed")
+
+
+_pool: AsyncConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+_health_check_task: asyncio.Task | None = None
+
+
+async def _health_check_loop(db_pool: AsyncConnectionPool):
+    while True:
+        await asyncio.sleep(DB_HEALTH_CHECK_INTERVAL)
+        try:
+            await db_pool.check()
+        except Exception as e:
+            print(f"Database pool health check failed: {str(e)}")
+
+
+async def get_pool() -> AsyncConnectionPool:
+    """Open the shared pool on first use."""
+    global _pool, _health_check_task
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                kwargs = {}
+                if DB_STATEMENT_TIMEOUT_MS:
+                    kwargs["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+                db_pool = AsyncConnectionPool(
+                    get_postgres_url(),
+                    min_size=DB_POOL_MIN,
+                    max_size=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    kwargs=kwargs,
+                    check=_check_connection,
+                    open=False,
+                )
+                try:
+                    await db_pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+                except PoolTimeout as e:
+                    await db_pool.close()
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"Failed to connect to database: {str(e)}"
+                    )
+                _pool = db_pool
+                if DB_HEALTH_CHECK_INTERVAL > 0:
+                    _health_check_task = asyncio.create_task(_health_check_loop(db_pool))
+    return _pool
+
+
+@asynccontextmanager
+async def get_db():
+    """
+    Borrow a connection from the shared pool.
+
+    Commits when the block succeeds, rolls back when it raises, and always
+    returns the connection to the pool.
+
+    Raises:
+        HTTPException: If no connection becomes available
+    """
+    db_pool = await get_pool()
+    started = time.perf_counter()
+    try:
+        async with db_pool.connection() as conn:
+            waited = time.perf_counter() - started
+            DB_WAIT_SECONDS.observe(waited)
+            add_timing("db_wait", waited)
+            yield conn
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Timed out waiting for a database connection")
+
+
+def pool_stats() -> dict:
+    """Connection pool usage and wait times."""
+    if _pool is None:
+        return {"open": False}
+    stats = _pool.get_stats()
+    requests = stats.get("requests_num", 0)
+    wait_ms = stats.get("requests_wait_ms", 0)
+    return {
+        "open": True,
+        "min_size": stats.get("pool_min"),
+        "max_size": stats.get("pool_max"),
+        "size": stats.get("pool_size"),
+        "idle": stats.get("pool_available"),
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+        "checkouts": requests,
+        "queued": stats.get("requests_queued", 0),
+        "timeouts": stats.get("requests_errors", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        "wait_seconds_total": wait_ms / 1000,
+        "wait_seconds_avg": wait_ms / 1000 / requests if requests else 0.0,
+    }
+
+
+async def close_pool():
+    global _pool, _health_check_task
+    if _health_check_task is not None:
+        _health_check_task.cancel()
+        _health_check_task = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
@@ -0,0 +1,75 @@
+import hashlib
+import os
+from typing import Dict, List
+
+from db import get_db
+from embeddings import EMBEDDING_MODEL, EmbeddingBatcher, count_tokens, openai_embed_batch
+from metrics import ingestion_stage
+from retrieval import to_vector_literal
+
+# Look up chunk embeddings by text hash before calling the embeddings API, and keep new ones
+EMBEDDING_STORE_ENABLED = os.getenv("EMBEDDING_STORE_ENABLED", "true").lower() == "true"
+
+
+def text_hash(text: str) -> str:
+    """SHA-256 of a chunk's text; with the model name, the key of its stored embedding."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+async def lookup_embeddings(conn, hashes: List[str], model: str = EMBEDDING_MODEL) -> Dict[str, List[float]]:
+    """Stored embeddings for the given text hashes, by hash. Unknown hashes are left out."""
+    cursor = await conn.execute("""
+        SELECT text_hash, embedding::real[]
+        FROM chunk_embeddings
+        WHERE model = %s AND text_hash = ANY(%s)
+    """, (model, hashes))
+    return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+async def store_embeddings(conn, embeddings: Dict[str, List[float]], model: str = EMBEDDING_MODEL):
+    """Keep embeddings by text hash. A hash stored concurrently by another job is left as is."""
+    async with conn.cursor() as cur:
+        await cur.executemany("""
+            INSERT INTO chunk_embeddings (text_hash, model, embedding)
+            VALUES (%s, %s, %s::vector)
+            ON CONFLICT DO NOTHING
+        """, [(key, model, to_vector_literal(embedding)) for key, embedding in embeddings.items()])
+
+
+async def embed_with_store(texts: List[str]) -> List[List[float]]:
+    """
+    Embed a batch of chunk texts, calling the API only for texts not seen before.
+
+    Identical chunks in other documents, and chunks of a job being retried,
+    reuse the stored vectors.
+    """
+    hashes = [text_hash(text) for text in texts]
+    async with get_db() as conn:
+        known = await lookup_embeddings(conn, hashes)
+
+    missing = {}
+    for key, text in zip(hashes, texts):
+        if key not in known:
+            missing.setdefault(key, text)
+    if missing:
+        new = dict(zip(missing, await openai_embed_batch(list(missing.values()))))
+        async with get_db() as conn:
+            await store_embeddings(conn, new)
+        known.update(new)
+
+    return [known[key] for key in hashes]
+
+
+async def embed_chunks(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of chunk texts for ingestion, through the store when it is enabled."""
+    with ingestion_stage("embed"):
+        if EMBEDDING_STORE_ENABLED:
+            return await embed_with_store(texts)
+        return await openai_embed_batch(texts)
+
+
+# Batcher used by ingestion; queries go through the query embedding cache instead
+chunk_embedding_batcher = EmbeddingBatcher(
+    embed_fn=embed_chunks,
+    count_tokens=count_tokens,
+)
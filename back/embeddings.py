@@ -0,0 +1,191 @@
+import asyncio
+import inspect
+import os
+import random
+import threading
+from collections import deque
+from typing import AsyncIterable, AsyncIterator, Callable, List, Tuple
+
+import tiktoken
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# OpenAI accepts up to 2048 inputs and 300k tokens per embeddings request; stay well under both
+EMBEDDING_BATCH_ITEMS = int(os.getenv("EMBEDDING_BATCH_ITEMS", "256"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+# The first batch of a stream is sent at this size, so the start of a document is embedded and stored early
+EMBEDDING_FIRST_BATCH_ITEMS = int(os.getenv("EMBEDDING_FIRST_BATCH_ITEMS", "16"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """The shared OpenAI client. The openai package is imported on first use, keeping it off the import path."""
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            import openai
+
+            _openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return _openai_client
+
+
+def openai_retryable_errors() -> tuple:
+    """Errors worth retrying: rate limits, timeouts and 5xx responses."""
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token count for English text (about 3 characters per token)."""
+    return len(text) // 3 + 1
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer() -> tiktoken.Encoding:
+    """The embedding model's tokenizer, loaded once per process."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+        return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """Exact token count under the embedding model's tokenizer."""
+    return len(get_tokenizer().encode_ordinary(text))
+
+
+async def openai_embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed several texts with a single OpenAI embeddings request, keeping input order."""
+    response = await get_openai_client().embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=texts
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class EmbeddingBatcher:
+    """
+    Packs texts into multi-input embedding requests and runs them concurrently.
+
+    embed_fn takes a list of texts and returns their embeddings in the same
+    order; it may be sync (run in a worker thread) or async. Swap it for a
+    stub to exercise ingestion without calling OpenAI. retryable_errors
+    defaults to OpenAI's transient errors.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable = openai_embed_batch,
+        max_batch_items: int = EMBEDDING_BATCH_ITEMS,
+        max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+        first_batch_items: int = EMBEDDING_FIRST_BATCH_ITEMS,
+        max_concurrency: int = EMBEDDING_CONCURRENCY,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+        retryable_errors: tuple | None = None,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        self.embed_fn = embed_fn
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.first_batch_items = max(1, min(first_batch_items, max_batch_items))
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.count_tokens = count_tokens
+        self.retryable_errors = retryable_errors
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    async def _call(self, texts: List[str]) -> List[List[float]]:
+        if inspect.iscoroutinefunction(self.embed_fn):
+            return await self.embed_fn(texts)
+        return await asyncio.to_thread(self.embed_fn, texts)
+
+    async def _embed_with_retry(self, texts: List[str]) -> List[List[float]]:
+        attempt = 0
+        while True:
+            try:
+                embeddings = await self._call(texts)
+                if len(embeddings) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+                return embeddings
+            except (self.retryable_errors or openai_retryable_errors()) as e:
+                if attempt >= self.max_retries:
+                    raise
+                # Exponential backoff with jitter so concurrent batches don't retry in lockstep
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                delay += random.uniform(0, self.backoff_base)
+                print(f"Embedding batch failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def iter_stream(self, texts: AsyncIterable[str]) -> AsyncIterator[Tuple[int, List[str], List[List[float]]]]:
+        """
+        Embed texts as they arrive (e.g. chunks of a document still being
+        extracted), yielding (start_index, texts, embeddings) in input order.
+
+        A batch is sent once it fills the item or token budget, or when the
+        input ends; the first one already at first_batch_items. Batches are
+        yielded as soon as they and the ones before them are done. Input is
+        only pulled while fewer than max_concurrency batches are in flight,
+        so a slow embedding API holds back extraction instead of letting
+        chunks pile up in memory.
+        """
+        in_flight = deque()
+        batch = []
+        tokens = 0
+        start = 0
+
+        def send():
+            nonlocal batch, tokens, start
+            in_flight.append((start, batch, asyncio.create_task(self._embed_with_retry(batch))))
+            start += len(batch)
+            batch = []
+            tokens = 0
+
+        try:
+            async for text in texts:
+                text_tokens = self.count_tokens(text)
+                max_items = self.first_batch_items if start == 0 else self.max_batch_items
+                if batch and (len(batch) >= max_items or tokens + text_tokens > self.max_batch_tokens):
+                    send()
+                batch.append(text)
+                tokens += text_tokens
+                # Only wait on the oldest batch when the window is full; hand finished ones back right away
+                while in_flight and (len(in_flight) >= self.max_concurrency or in_flight[0][2].done()):
+                    batch_start, batch_texts, task = in_flight.popleft()
+                    yield batch_start, batch_texts, await task
+            if batch:
+                send()
+            while in_flight:
+                batch_start, batch_texts, task = in_flight.popleft()
+                yield batch_start, batch_texts, await task
+        finally:
+            for _, _, task in in_flight:
+                task.cancel()
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed all texts and return the embeddings in input order."""
+        async def source():
+            for text in texts:
+                yield text
+
+        embeddings = []
+        async for _, _, batch in self.iter_stream(source()):
+            embeddings.extend(batch)
+        return embeddings
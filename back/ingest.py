@@ -0,0 +1,157 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterable, AsyncIterator
+
+from markdown_it import MarkdownIt
+
+from chunker import Chunk, StreamingChunker
+from metrics import INGESTION_STAGE_SECONDS, ingestion_stage, record
+
+# Processes extracting PDF text in parallel
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+
+# Pages extracted per task sent to a worker process
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+
+
+def process_pdf(file_content: bytes) -> str:
+    """Extract text from PDF file using PyMuPDF."""
+    import pymupdf
+
+    doc = pymupdf.open(stream=file_content, filetype="pdf")
+    text = "".join(page.get_text() + "\n" for page in doc)
+    doc.close()
+    return text
+
+def process_markdown(content: str) -> str:
+    """Process markdown content to plain text."""
+    md = MarkdownIt()
+    return md.render(content)
+
+def extract_text(content: bytes, filename: str) -> str:
+    """Extract plain text from an uploaded file based on its type."""
+    if filename.lower().endswith('.pdf'):
+        return process_pdf(content)
+    # Markdown or text
+    return process_markdown(content.decode('utf-8'))
+
+
+def extract_page_range(path: str, start: int, end: int) -> list[str]:
+    """Worker process task: text of pages [start, end) of a PDF file."""
+    import pymupdf
+
+    doc = pymupdf.open(path)
+    try:
+        return [doc[i].get_text() for i in range(start, end)]
+    finally:
+        doc.close()
+
+
+def extract_page_range_timed(path: str, start: int, end: int) -> tuple[float, list[str]]:
+    """Worker process task: extract_page_range, with the seconds it took for the parent's metrics."""
+    started = time.perf_counter()
+    pages = extract_page_range(path, start, end)
+    return time.perf_counter() - started, pages
+
+
+def count_pdf_pages(path: str) -> int:
+    import pymupdf
+
+    doc = pymupdf.open(path)
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_extract_executor() -> ProcessPoolExecutor:
+    """Process pool for PDF extraction, spawned so workers don't inherit the event loop or connections."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def shutdown_extract_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+            _executor = None
+
+
+async def iter_pdf_pages(path: str) -> AsyncIterator[tuple[int, str]]:
+    """
+    Yield (page number, text) for each page of a PDF file, in order.
+
+    Page ranges are extracted in parallel across the process pool, with at
+    most two ranges per worker in flight so memory stays bounded however
+    long the document is.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_extract_executor()
+    page_count = await asyncio.to_thread(count_pdf_pages, path)
+    ranges = deque((start, min(start + PDF_PAGES_PER_TASK, page_count))
+                   for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    in_flight = deque()
+    ranges_done = 0
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < 2 * PDF_EXTRACT_WORKERS:
+                start, end = ranges.popleft()
+                in_flight.append(loop.run_in_executor(executor, extract_page_range_timed, path, start, end))
+            start = ranges_done * PDF_PAGES_PER_TASK
+            seconds, pages = await in_flight.popleft()
+            record("extract", seconds, INGESTION_STAGE_SECONDS)
+            for i, page in enumerate(pages):
+                yield start + i + 1, page + "\n"
+            ranges_done += 1
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+async def iter_document_text(path: str, filename: str) -> AsyncIterator[tuple[int | None, str]]:
+    """
+    Stream the text of an uploaded file as (page number, text): page by page
+    for PDFs, in one piece without a page number otherwise.
+    """
+    if filename.lower().endswith('.pdf'):
+        async for page in iter_pdf_pages(path):
+            yield page
+        return
+    with ingestion_stage("extract"):
+        with open(path, 'rb') as f:
+            content = f.read()
+        text = await asyncio.to_thread(process_markdown, content.decode('utf-8'))
+    yield None, text
+
+
+async def iter_chunks(parts: AsyncIterable[tuple[int | None, str]]) -> AsyncIterator[Chunk]:
+    """
+    Chunk streamed (page number, text) pieces as they arrive.
+
+    The result is deterministic for a given input, which resumed ingestion
+    jobs rely on.
+    """
+    chunker = StreamingChunker()
+    async for page, text in parts:
+        with ingestion_stage("chunk"):
+            chunks = await asyncio.to_thread(chunker.feed, text, page)
+        for chunk in chunks:
+            yield chunk
+    with ingestion_stage("chunk"):
+        chunks = await asyncio.to_thread(chunker.finish)
+    for chunk in chunks:
+        yield chunk
@@ -0,0 +1,345 @@
+import asyncio
+import os
+import socket
+import tempfile
+import time
+import uuid
+from collections import deque
+from enum import Enum
+
+from psycopg.rows import dict_row
+
+from db import get_db
+from embedding_store import chunk_embedding_batcher
+from chunk_store import CHUNK_COMMIT_BATCH, make_chunk_rows, write_chunks
+from ingest import count_pdf_pages, iter_chunks, iter_document_text
+from metrics import INGESTED, INGESTION_JOB_SECONDS, ingestion_stage, maybe_profile
+from progress import Phase, ProgressTracker, notify_progress
+from retrieval import matrix_cache
+from late_interaction import COLBERT_ENABLED, index_document as index_colbert
+from page_retrieval import COLPALI_ENABLED, index_pdf
+from storage import download_to_file
+
+# Jobs processed at the same time by one worker process
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "2"))
+
+# Seconds between polls when the queue is empty
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "1"))
+
+# A processing job whose lock hasn't been refreshed for this long is assumed dead and picked up again
+INGEST_LOCK_TIMEOUT = float(os.getenv("INGEST_LOCK_TIMEOUT", "300"))
+
+# Base delay before retrying a failed job; doubles with every attempt
+INGEST_RETRY_DELAY = float(os.getenv("INGEST_RETRY_DELAY", "10"))
+
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+
+# Error recorded on a job whose last attempt never finished: its worker died or stalled
+STALLED_ERROR = "The worker stopped responding while processing the document"
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LockLost(Exception):
+    """The job's lock went stale and another worker claimed it; this worker must stop writing to it."""
+
+
+class ProcessingStatus(Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+async def enqueue_job(conn, document_id: str, file_key: str, filename: str):
+    """Queue a document for ingestion. Runs in the caller's transaction."""
+    async with conn.cursor() as cur:
+        await cur.execute("""
+            INSERT INTO ingestion_jobs (document_id, file_key, filename, max_attempts)
+            VALUES (%s, %s, %s, %s)
+        """, (document_id, file_key, filename, INGEST_MAX_ATTEMPTS))
+
+
+async def claim_job(worker_id: str = WORKER_ID) -> dict | None:
+    """
+    Lock the oldest runnable job for this worker.
+
+    Runnable means pending and due, or processing with a lock that has gone
+    stale because its worker died. SKIP LOCKED lets any number of workers
+    poll the same table without blocking each other. A stale job that has
+    used up its attempts is failed instead of claimed, so a document that
+    keeps killing its worker (e.g. out of memory) doesn't retry forever.
+
+    The job is locked under the worker id plus a token for this claim, so
+    every later update can check the claim is still the current one, even
+    when the same worker claims the job again.
+    """
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                WITH exhausted AS (
+                    UPDATE ingestion_jobs
+                    SET status = %s, phase = %s, last_error = %s, locked_by = NULL, locked_at = NULL,
+                        updated_at = NOW()
+                    WHERE id IN (
+                        SELECT id FROM ingestion_jobs
+                        WHERE status = 'processing' AND attempts >= max_attempts
+                          AND locked_at < NOW() - make_interval(secs => %s)
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING document_id, attempts
+                )
+                UPDATE documents SET status = %s
+                FROM exhausted
+                WHERE documents.id = exhausted.document_id
+                RETURNING documents.id, exhausted.attempts
+            """, (ProcessingStatus.FAILED.value, Phase.FAILED.value, STALLED_ERROR, INGEST_LOCK_TIMEOUT,
+                  ProcessingStatus.FAILED.value))
+            for failed in await cur.fetchall():
+                print(f"Processing failed for document {failed['id']} (attempt {failed['attempts']}): {STALLED_ERROR}")
+                await notify_progress(conn, failed["id"])
+
+            await cur.execute("""
+                UPDATE ingestion_jobs
+                SET status = 'processing', attempts = attempts + 1, phase = %s, started_at = NOW(),
+                    resumed_from = chunks_done, locked_by = %s, locked_at = NOW(), updated_at = NOW()
+                WHERE id = (
+                    SELECT id FROM ingestion_jobs
+                    WHERE (status = 'pending' AND run_after <= NOW())
+                       OR (status = 'processing' AND attempts < max_attempts
+                           AND locked_at < NOW() - make_interval(secs => %s))
+                    ORDER BY run_after ASC
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, document_id, file_key, filename, attempts, max_attempts, chunks_done, locked_by
+            """, (Phase.DOWNLOADING.value, f"{worker_id}/{uuid.uuid4().hex[:8]}", INGEST_LOCK_TIMEOUT))
+            job = await cur.fetchone()
+            if job:
+                await cur.execute("""
+                    UPDATE documents SET status = %s WHERE id = %s
+                """, (ProcessingStatus.PROCESSING.value, job["document_id"]))
+                await notify_progress(conn, job["document_id"])
+            return job
+
+
+async def _heartbeat(job_id, locked_by: str):
+    """
+    Keep the job's lock fresh while it is being processed.
+
+    A failed refresh is logged and retried on the next beat; the lock only
+    goes stale if refreshes keep failing for INGEST_LOCK_TIMEOUT.
+    """
+    while True:
+        await asyncio.sleep(INGEST_LOCK_TIMEOUT / 3)
+        try:
+            async with get_db() as conn:
+                await conn.execute("""
+                    UPDATE ingestion_jobs SET locked_at = NOW()
+                    WHERE id = %s AND locked_by = %s
+                """, (job_id, locked_by))
+        except Exception as e:
+            print(f"Failed to refresh the lock of ingestion job {job_id}: {str(e)}")
+
+
+async def _finish_job(job: dict, status: ProcessingStatus, error: str | None = None):
+    async with get_db() as conn:
+        cursor = await conn.execute("""
+            UPDATE ingestion_jobs
+            SET status = %s, phase = %s, last_error = %s, locked_by = NULL, locked_at = NULL, updated_at = NOW()
+            WHERE id = %s AND locked_by = %s
+        """, (status.value, status.value, error, job["id"], job["locked_by"]))
+        if cursor.rowcount == 0:
+            raise LockLost(f"ingestion job {job['id']} was claimed by another worker")
+        await conn.execute("""
+            UPDATE documents SET status = %s WHERE id = %s
+        """, (status.value, job["document_id"]))
+        await notify_progress(conn, job["document_id"])
+
+
+async def _retry_job(job: dict, error: str):
+    delay = INGEST_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+    async with get_db() as conn:
+        cursor = await conn.execute("""
+            UPDATE ingestion_jobs
+            SET status = 'pending', phase = %s, last_error = %s, locked_by = NULL, locked_at = NULL,
+                run_after = NOW() + make_interval(secs => %s), updated_at = NOW()
+            WHERE id = %s AND locked_by = %s
+        """, (Phase.QUEUED.value, error, delay, job["id"], job["locked_by"]))
+        if cursor.rowcount == 0:
+            raise LockLost(f"ingestion job {job['id']} was claimed by another worker")
+        await conn.execute("""
+            UPDATE documents SET status = %s WHERE id = %s
+        """, (ProcessingStatus.PENDING.value, job["document_id"]))
+        await notify_progress(conn, job["document_id"])
+
+
+async def process_job(job: dict):
+    """
+    Extract, chunk, embed and store one document.
+
+    The file is spooled to a temporary file and streamed through extraction,
+    chunking and embedding, so the first chunks are searchable while later
+    pages are still being extracted and memory stays bounded for long
+    documents.
+
+    Each batch of chunks is committed together with the job's chunks_done
+    counter, so a retried job resumes after the last committed batch
+    instead of starting over. Chunking is deterministic, which keeps the
+    resumed chunk numbering consistent.
+
+    Progress (phase, pages extracted, chunks embedded and inserted) is
+    kept on the job row for the status endpoints.
+
+    Raises:
+        LockLost: If another worker claimed the job after its lock went stale
+    """
+    document_id = str(job["document_id"])
+    resume_from = done = job["chunks_done"]
+    progress = ProgressTracker(job)
+
+    async def flush(rows):
+        nonlocal done
+        with ingestion_stage("insert"):
+            async with get_db() as conn:
+                cursor = await conn.execute("""
+                    UPDATE ingestion_jobs SET chunks_done = %s, locked_at = NOW(), updated_at = NOW()
+                    WHERE id = %s AND locked_by = %s
+                """, (done + len(rows), job["id"], job["locked_by"]))
+                if cursor.rowcount == 0:
+                    # Rolled back with the rows; the worker now holding the job writes them
+                    raise LockLost(f"ingestion job {job['id']} was claimed by another worker")
+                done += len(rows)
+                await progress.save(conn, force=True)
+                await write_chunks(conn, rows)  # Commits the rows and the progress together
+        INGESTED.labels("chunks").inc(len(rows))
+
+    # Chunks handed to the embedder, waiting for their embeddings
+    embedding = deque()
+
+    async def counted_pages(parts):
+        async for page, text in parts:
+            progress.pages_done += page is not None
+            INGESTED.labels("pages").inc(page is not None)
+            yield page, text
+
+    async def remaining_texts():
+        position = 0
+        async for chunk in iter_chunks(counted_pages(iter_document_text(file.name, job["filename"]))):
+            if position >= resume_from:
+                embedding.append(chunk)
+                yield chunk.text
+            position += 1
+        progress.chunks_total = position
+
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(job["filename"])[1]) as file:
+        with ingestion_stage("download"):
+            await asyncio.to_thread(download_to_file, job["file_key"], file.name)
+        if job["filename"].lower().endswith(".pdf"):
+            progress.pages_total = await asyncio.to_thread(count_pdf_pages, file.name)
+        await progress.set_phase(Phase.EMBEDDING)
+
+        # Embed chunks in batched requests as they are extracted and write them in bulk, one transaction per batch
+        pending_rows = []
+        async for start, texts, embeddings in chunk_embedding_batcher.iter_stream(remaining_texts()):
+            chunks = [embedding.popleft() for _ in texts]
+            pending_rows.extend(make_chunk_rows(document_id, chunks, embeddings, resume_from + start))
+            progress.chunks_embedded = resume_from + start + len(texts)
+            # The first batch is committed on its own, making the document searchable early
+            if len(pending_rows) >= CHUNK_COMMIT_BATCH or done == resume_from:
+                await flush(pending_rows)
+                pending_rows = []
+            else:
+                await progress.save()
+        await flush(pending_rows)
+
+        if COLBERT_ENABLED or COLPALI_ENABLED:
+            await progress.set_phase(Phase.INDEXING)
+
+        if COLBERT_ENABLED:
+            with ingestion_stage("index_colbert"):
+                await index_colbert(document_id)
+
+        if COLPALI_ENABLED and job["filename"].lower().endswith(".pdf"):
+            with ingestion_stage("index_pages"):
+                await index_pdf(document_id, file.name)
+
+    # Drop any matrix cached while the document was still being ingested
+    matrix_cache.invalidate(document_id)
+
+
+async def run_job(job: dict):
+    """Process a claimed job and record the outcome, scheduling a retry on failure."""
+    heartbeat = asyncio.create_task(_heartbeat(job["id"], job["locked_by"]))
+    started = time.perf_counter()
+    try:
+        with maybe_profile(f"ingest-{job['document_id']}"):
+            await process_job(job)
+        await _finish_job(job, ProcessingStatus.COMPLETED)
+        INGESTION_JOB_SECONDS.labels("completed").observe(time.perf_counter() - started)
+    except LockLost as e:
+        # The worker now holding the job records its outcome
+        print(f"Abandoning document {job['document_id']} (attempt {job['attempts']}): {str(e)}")
+        INGESTION_JOB_SECONDS.labels("abandoned").observe(time.perf_counter() - started)
+    except Exception as e:
+        print(f"Processing failed for document {job['document_id']} (attempt {job['attempts']}): {str(e)}")
+        try:
+            if job["attempts"] >= job["max_attempts"]:
+                await _finish_job(job, ProcessingStatus.FAILED, str(e))
+                INGESTION_JOB_SECONDS.labels("failed").observe(time.perf_counter() - started)
+            else:
+                await _retry_job(job, str(e))
+                INGESTION_JOB_SECONDS.labels("retried").observe(time.perf_counter() - started)
+        except LockLost as lost:
+            print(f"Abandoning document {job['document_id']} (attempt {job['attempts']}): {str(lost)}")
+            INGESTION_JOB_SECONDS.labels("abandoned").observe(time.perf_counter() - started)
+    finally:
+        heartbeat.cancel()
+
+
+async def run_worker(concurrency: int = INGEST_CONCURRENCY, stop: asyncio.Event | None = None,
+                     worker_id: str = WORKER_ID):
+    """Claim and run jobs until stop is set, with at most concurrency jobs at a time."""
+    stop = stop or asyncio.Event()
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    print(f"Ingestion worker {worker_id} started with concurrency {concurrency}")
+
+    async def run(job):
+        try:
+            await run_job(job)
+        finally:
+            slots.release()
+
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        while not stop.is_set():
+            # Wait for a free slot, but not past shutdown while every slot is busy
+            acquiring = asyncio.create_task(slots.acquire())
+            await asyncio.wait({acquiring, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not acquiring.done():
+                acquiring.cancel()
+                break
+            if stop.is_set():
+                slots.release()
+                break
+            try:
+                job = await claim_job(worker_id)
+            except Exception as e:
+                print(f"Failed to claim ingestion job: {str(e)}")
+                job = None
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(stop.wait(), INGEST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(run(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        stopping.cancel()
+        # Jobs cut short here keep their lock and are picked up again once it goes stale
+        for task in running:
+            task.cancel()
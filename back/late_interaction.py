@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import List, Dict, Any
+
+import numpy as np
+from psycopg.rows import dict_row
+
+from db import get_db
+from metrics import stage
+from multivector import IndexStore, MultiVectorIndex
+
+# Build a token-level ColBERT index for every ingested document
+COLBERT_ENABLED = os.getenv("COLBERT_ENABLED", "false").lower() == "true"
+
+# "colbert" runs a ColBERT checkpoint on CPU (needs the colbert-ai package);
+# "hashing" is a model-free stand-in for local runs and benchmarks
+COLBERT_ENCODER = os.getenv("COLBERT_ENCODER", "colbert")
+COLBERT_MODEL = os.getenv("COLBERT_MODEL", "colbert-ir/colbertv2.0")
+
+# "float16" stores 2 bytes per dimension; "pq" stores 1 byte per subspace
+COLBERT_COMPRESSION = os.getenv("COLBERT_COMPRESSION", "float16")
+COLBERT_PQ_SUBSPACES = int(os.getenv("COLBERT_PQ_SUBSPACES", "16"))
+
+# Centroids probed per query token, and chunks scored exactly after centroid pruning
+COLBERT_NPROBE = int(os.getenv("COLBERT_NPROBE", "4"))
+COLBERT_CANDIDATES = int(os.getenv("COLBERT_CANDIDATES", "64"))
+
+colbert_indexes = IndexStore("colbert", enabled=COLBERT_ENABLED)
+
+
+class HashingTokenEncoder:
+    """One fixed random unit vector per lowercased word. Captures exact term overlap only."""
+
+    def __init__(self, dim: int = 128):
+        self.dim = dim
+
+    @lru_cache(maxsize=100000)
+    def _vector(self, word: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def _encode(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._vector(word) for word in words])
+
+    def encode_query(self, text: str) -> np.ndarray:
+        return self._encode(text)
+
+    def encode_documents(self, texts: List[str]) -> List[np.ndarray]:
+        return [self._encode(text) for text in texts]
+
+
+class ColBERTEncoder:
+    """A ColBERT checkpoint run on CPU through the colbert-ai package."""
+
+    def __init__(self, model: str = COLBERT_MODEL):
+        from colbert.infra import ColBERTConfig
+        from colbert.modeling.checkpoint import Checkpoint
+
+        self.checkpoint = Checkpoint(model, colbert_config=ColBERTConfig())
+
+    def encode_query(self, text: str) -> np.ndarray:
+        return self.checkpoint.queryFromText([text])[0].float().numpy()
+
+    def encode_documents(self, texts: List[str]) -> List[np.ndarray]:
+        # keep_dims=False drops padding, leaving one (tokens, dim) tensor per text
+        return [d.float().numpy() for d in self.checkpoint.docFromText(texts, bsize=32, keep_dims=False, to_cpu=True)]
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def get_encoder():
+    """Load the configured token encoder once per process."""
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = HashingTokenEncoder() if COLBERT_ENCODER == "hashing" else ColBERTEncoder()
+        return _encoder
+
+
+def build_colbert_index(chunk_ids: List[str], texts: List[str], encoder=None,
+                        compression: str = COLBERT_COMPRESSION) -> MultiVectorIndex:
+    encoder = encoder or get_encoder()
+    return MultiVectorIndex.build(chunk_ids, encoder.encode_documents(texts), compression, COLBERT_PQ_SUBSPACES)
+
+
+async def index_document(document_id: str):
+    """
+    Encode every chunk of a document into token vectors and save its ColBERT index.
+
+    The pooled connection is only held to read the chunks, not through the
+    CPU-bound encoding, which can take minutes for a long document.
+    """
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT id, text FROM chunks
+                WHERE document_id = %s
+                ORDER BY "order" ASC
+            """, (document_id,))
+            chunks = await cur.fetchall()
+    if not chunks:
+        return
+    index = await asyncio.to_thread(build_colbert_index, [chunk["id"] for chunk in chunks],
+                                    [chunk["text"] for chunk in chunks])
+    await asyncio.to_thread(colbert_indexes.save, document_id, index)
+
+
+async def encode_query(query: str) -> np.ndarray:
+    """A query's token vectors, encoded once however many documents it is searched in."""
+    with stage("colbert_encode"):
+        return await asyncio.to_thread(get_encoder().encode_query, query)
+
+
+async def colbert_search(document_id: str, query_vectors: np.ndarray, k: int) -> List[Dict[str, Any]] | None:
+    """
+    Rank a document's chunks by late interaction with an encoded query.
+
+    Scores are MaxSim averaged over query tokens. Returns the ids and scores
+    of the top chunks (see fetch_chunks for their text), or None when the
+    document has no ColBERT index.
+    """
+    with stage("colbert_search"):
+        index = await asyncio.to_thread(colbert_indexes.get, document_id)
+        if index is None:
+            return None
+        if not len(query_vectors):
+            return []
+        hits = await asyncio.to_thread(index.search, query_vectors, k, COLBERT_NPROBE, COLBERT_CANDIDATES)
+    return [{"id": chunk_id, "score": score / len(query_vectors)} for chunk_id, score in hits]
+
+
+async def fetch_chunks(conn, hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Add text, position and document to ranked chunk hits, keeping their order. Chunks deleted since indexing are dropped."""
+    with stage("fetch_chunks"):
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT id, document_id, text, "order" FROM chunks
+                WHERE id = ANY(%s)
+            """, ([hit["id"] for hit in hits],))
+            rows = {str(row["id"]): row for row in await cur.fetchall()}
+    return [{**rows[hit["id"]], **hit} for hit in hits if hit["id"] in rows]
@@ -1,94 +1,166 @@
-import pymupdf
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Request
+import asyncio
+import importlib
+import inspect
+import itertools
+import threading
+import time
+from datetime import datetime
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 
 from fastapi.middleware.cors import CORSMiddleware
-import openai
+from fastapi.responses import Response, StreamingResponse
 import os
-from markdown_it import MarkdownIt
+import json
 from dotenv import load_dotenv
-import boto3
-from datetime import datetime
 import uuid
-from enum import Enum
-import re
-import nltk
-from nltk.tokenize import sent_tokenize
-import psycopg2
-from psycopg2.extras import DictCursor
-from typing import List, Dict, Any
-import numpy as np
+from psycopg.rows import dict_row
+from typing import List, Dict, Any, AsyncIterator, Callable
 from pydantic import BaseModel
-import voyageai
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+from retrieval import (DEFAULT_TOP_K, HYBRID_CANDIDATES, Documents, retrieve_chunks, lexical_search,
+                       reciprocal_rank_fusion, resolve_documents, count_chunks, matrix_cache)
+from rerank import RERANK_CANDIDATES, rerank_chunks
+from late_interaction import (COLBERT_ENABLED, colbert_search, fetch_chunks, get_encoder,
+                              encode_query as encode_colbert_query)
+from page_retrieval import (COLPALI_ENABLED, colpali_search, prewarm_executor, shutdown_executor,
+                            encode_query as encode_colpali_query)
+from ingest import shutdown_extract_executor
+from embeddings import EMBEDDING_MODEL, get_openai_client, get_tokenizer
+from db import get_db, get_pool, close_pool, pool_stats
+from jobs import ProcessingStatus, enqueue_job, run_worker
+from progress import get_progress, progress_listener
+from storage import content_hash, get_s3, upload_to_spaces
+from cache import query_embedding_cache, answer_cache, embedding_cache_key, answer_cache_key
+from metrics import (CONTEXT_TOKENS, PREWARM_SECONDS, REQUEST_SECONDS, STAGE_SECONDS, StatsCollector,
+                     maybe_profile, request_timings, server_timing, stage)
+from context import CHAT_MODEL, build_context, get_chat_tokenizer
+from chunker import get_sentence_tokenizer
 
 load_dotenv()
 
 app = FastAPI()
 
-import ssl
+# Run an ingestion worker inside the web process; turn off when separate `python worker.py` processes are deployed
+INGEST_WORKER_IN_PROCESS = os.getenv("INGEST_WORKER_IN_PROCESS", "true").lower() == "true"
+
+# When to load the database pool, API clients, tokenizers and enabled models: "background" once the
+# server is accepting connections, "startup" before it does, "off" on the first request that needs each
+PREWARM = os.getenv("PREWARM", "background").lower()
+
+ingest_worker_stop = asyncio.Event()
+ingest_worker_task = None
+prewarm_task = None
+
+async def warm_openai():
+    client = await asyncio.to_thread(get_openai_client)
+    # A free request, leaving an open connection in the client's pool for the first chat
+    await client.models.retrieve(CHAT_MODEL)
+
+def prewarm_steps() -> Dict[str, Callable[[], Any]]:
+    steps = {
+        "db_pool": get_pool,
+        "openai": warm_openai,
+        "voyage": get_voyage_client,
+        "tokenizers": lambda: (get_tokenizer(), get_chat_tokenizer()),
+    }
+    if INGEST_WORKER_IN_PROCESS:
+        steps["s3"] = get_s3
+        steps["sentence_tokenizer"] = get_sentence_tokenizer
+        steps["pymupdf"] = lambda: importlib.import_module("pymupdf")
+    if COLBERT_ENABLED:
+        steps["colbert"] = get_encoder
+    if COLPALI_ENABLED:
+        steps["colpali"] = prewarm_executor
+    return steps
+
+async def prewarm_step(name: str, load: Callable[[], Any]):
+    started = time.perf_counter()
+    try:
+        if inspect.iscoroutinefunction(load):
+            await load()
+        else:
+            await asyncio.to_thread(load)
+    except HTTPException as e:
+        print(f"Prewarming {name} failed: {e.detail}")
+        return
+    except Exception as e:
+        # Left to load on first use, where the error reaches the request that needs it
+        print(f"Prewarming {name} failed: {str(e)}")
+        return
+    PREWARM_SECONDS.labels(name).set(time.perf_counter() - started)
+
+async def prewarm():
+    """Load everything the first requests would otherwise wait for, concurrently."""
+    started = time.perf_counter()
+    await asyncio.gather(*(prewarm_step(name, load) for name, load in prewarm_steps().items()))
+    print(f"Prewarmed in {time.perf_counter() - started:.2f}s")
 
 @app.on_event("startup")
 async def startup_event():
-    """Download required NLTK resources on startup"""
-    try:
-        # Print environment variables
-        print("Environment Variables:")
-        for key, value in os.environ.items():
-            print(f"{key}: {value}")
-        
-        # Create unverified SSL context for NLTK downloads
-        ssl._create_default_https_context = ssl._create_unverified_context
-        
-        nltk.data.find('tokenizers/punkt')
-        nltk.data.find('tokenizers/punkt_tab')
-    except LookupError:
-        nltk.download('punkt')
-        nltk.download('punkt_tab')
-
-# Database connection setup
-def get_db():
-    """
-    Get database connection with proper error handling.
-    te
-    Raises:
-        HTTPException: If database connection fails
+    global ingest_worker_task, prewarm_task
+    if PREWARM == "startup":
+        await prewarm()
+    elif PREWARM == "background":
+        # Runs once startup returns and the server starts accepting connections
+        prewarm_task = asyncio.create_task(prewarm())
+
+    if INGEST_WORKER_IN_PROCESS:
+        ingest_worker_task = asyncio.create_task(run_worker(stop=ingest_worker_stop))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if prewarm_task:
+        prewarm_task.cancel()
+    ingest_worker_stop.set()
+    if ingest_worker_task:
+        await ingest_worker_task
+    await progress_listener.close()
+    await close_pool()
+    shutdown_executor()
+    shutdown_extract_executor()
+
+@app.get("/metrics/db")
+async def db_metrics():
+    """Connection pool usage and wait times."""
+    return pool_stats()
+
+def cache_stats() -> Dict[str, Any]:
+    return {
+        "query_embedding": query_embedding_cache.stats(),
+        "answer": answer_cache.stats(),
+        "matrix": matrix_cache.stats(),
+    }
+
+@app.get("/metrics/cache")
+async def cache_metrics():
+    """Hit rates of the query embedding, answer and embedding matrix caches."""
+    return cache_stats()
+
+REGISTRY.register(StatsCollector("db_pool", pool_stats))
+REGISTRY.register(StatsCollector("cache", cache_stats, label="cache"))
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Request, pipeline stage, ingestion, pool and cache metrics in the Prometheus text format."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
     """
-    postgres_url = os.getenv('POSTGRES_URL')
-    if not postgres_url:
-        raise HTTPException(
-            status_code=500,
-            detail="POSTGRES_URL not found in environment variables"
-        )
-    
-    try:
-        # Convert URL to connection string if needed
-        if postgres_url.startswith('postgres://'):
-            postgres_url = postgres_url.replace('postgres://', 'postgresql://')
-        return psycopg2.connect(postgres_url)
-    except psycopg2.Error as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to connect to database: {str(e)}"
-        )
-
-# Initialize S3 client for Digital Ocean Spaces
-s3 = boto3.client('s3',
-    endpoint_url='https://sgp1.digitaloceanspaces.com',
-    aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
-    aws_secret_access_key=os.getenv('S3_SECRET_KEY')
-)
+    Time every request by route and report its pipeline stages in a Server-Timing header.
 
-SPACE_NAME = 'thor'
-SPACE_FOLDER = 'documents'
-
-# In-memory store for processing status and chunks
-processing_status = {}
-document_chunks = {}
-
-class ProcessingStatus(Enum):
-    PENDING = "pending"
-    PROCESSING = "processing"
-    COMPLETED = "completed"
-    FAILED = "failed"
+    For streamed responses the header goes out with the first byte, so it
+    covers retrieval but not generation.
+    """
+    started = time.perf_counter()
+    with request_timings() as timings, maybe_profile(f"{request.method} {request.url.path}"):
+        response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched", response.status_code).observe(elapsed)
+    response.headers["Server-Timing"] = server_timing(timings, elapsed)
+    return response
 
 app.add_middleware(
     CORSMiddleware,
@@ -98,235 +170,139 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-client = openai.OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY")
-)
-
 VOYAGE_API_KEY = os.getenv("VOYAGE_API_KEY")
 if not VOYAGE_API_KEY:
     raise ValueError("Voyage API key not found in environment variables")
 
-voyage_client = voyageai.Client()  # This will use VOYAGE_API_KEY from environment
-
-def get_embedding(text: str) -> list[float]:
-    """Get embedding for text using OpenAI's API."""
+voyage_client = None
+voyage_client_lock = threading.Lock()
+
+def get_voyage_client():
+    """The shared Voyage client, created on first use: importing voyageai is slow."""
+    global voyage_client
+    with voyage_client_lock:
+        if voyage_client is None:
+            import voyageai
+
+            voyage_client = voyageai.AsyncClient()  # This will use VOYAGE_API_KEY from environment
+        return voyage_client
+
+async def get_embedding(text: str) -> list[float]:
+    """Get embedding for text using OpenAI's API, reusing cached embeddings of repeated queries."""
+    cache_key = embedding_cache_key(EMBEDDING_MODEL, text)
+    cached = await query_embedding_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
-        response = openai.embeddings.create(
-            model="text-embedding-ada-002",
-            input=text
-        )
-        return response.data[0].embedding
+        with stage("embed"):
+            response = await get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=text
+            )
+        embedding = response.data[0].embedding
+        await query_embedding_cache.set(cache_key, embedding)
+        return embedding
     except Exception as e:
         print(f"Error getting embedding: {str(e)}")
         raise
 
-def split_into_chunks(text: str, chunk_size: int = 1000, overlap: int = 200) -> list[str]:
+async def find_document_by_hash(sha256: str) -> Dict[str, Any] | None:
     """
-    Split text into chunks with proper sentence boundaries and overlap.
-    
-    Args:
-        text: The text to split
-        chunk_size: Target size of each chunk in characters
-        overlap: Number of characters to overlap between chunks
+    The document already created for a file with this content, if any.
+
+    A document whose ingestion failed is deleted instead, so the upload
+    creates it again and gets a fresh ingestion job.
     """
-    # First, split into sentences
-    sentences = sent_tokenize(text)
-    
-    chunks = []
-    current_chunk = []
-    current_size = 0
-    last_sentence = ""
-    
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
-            continue
-            
-        sentence_size = len(sentence)
-        
-        # If this sentence alone is longer than chunk_size, split it by punctuation or spaces
-        if sentence_size > chunk_size:
-            # Try to split by punctuation first
-            subparts = re.split(r'[,;:]', sentence)
-            if len(subparts) == 1:  # No punctuation found, split by space
-                subparts = sentence.split()
-            
-            current_subpart = []
-            current_subsize = 0
-            
-            for part in subparts:
-                part = part.strip()
-                part_size = len(part)
-                
-                if current_subsize + part_size > chunk_size:
-                    if current_subpart:
-                        chunks.append(' '.join(current_subpart))
-                    current_subpart = [part]
-                    current_subsize = part_size
-                else:
-                    current_subpart.append(part)
-                    current_subsize += part_size + 1  # +1 for space
-            
-            if current_subpart:
-                chunks.append(' '.join(current_subpart))
-            continue
-        
-        # If adding this sentence exceeds chunk_size, start a new chunk
-        if current_size + sentence_size > chunk_size and current_chunk:
-            chunk_text = ' '.join(current_chunk)
-            chunks.append(chunk_text)
-            
-            # Start new chunk with overlap from the last sentence
-            if last_sentence and len(last_sentence) < overlap:
-                current_chunk = [last_sentence, sentence]
-                current_size = len(last_sentence) + sentence_size + 1
-            else:
-                current_chunk = [sentence]
-                current_size = sentence_size
-        else:
-            current_chunk.append(sentence)
-            current_size += sentence_size + 1  # +1 for space
-            
-        last_sentence = sentence
-    
-    # Add the last chunk if there is one
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
-    
-    # Ensure minimum chunk size and merge small chunks if necessary
-    final_chunks = []
-    current_chunk = []
-    current_size = 0
-    min_chunk_size = chunk_size // 2
-    
-    for chunk in chunks:
-        if current_size + len(chunk) < chunk_size:
-            current_chunk.append(chunk)
-            current_size += len(chunk)
-        else:
-            if current_chunk:
-                final_chunks.append(' '.join(current_chunk))
-            current_chunk = [chunk]
-            current_size = len(chunk)
-    
-    if current_chunk:
-        if current_size < min_chunk_size and final_chunks:
-            # Merge small last chunk with the previous one
-            final_chunks[-1] = final_chunks[-1] + ' ' + ' '.join(current_chunk)
-        else:
-            final_chunks.append(' '.join(current_chunk))
-    
-    return final_chunks
-
-def process_pdf(file_content: bytes) -> str:
-    """Extract text from PDF file using PyMuPDF."""
-    doc = pymupdf.open(stream=file_content, filetype="pdf")
-    text = ""
-    for page in doc:
-        text += page.get_text() + "\n"
-    doc.close()
-    return text
-
-def process_markdown(content: str) -> str:
-    """Process markdown content to plain text."""
-    md = MarkdownIt()
-    return md.render(content)
-
-def upload_to_spaces(file_content: bytes, filename: str) -> str:
-    """Upload file to Digital Ocean Spaces and return the URL."""
-    # Generate a unique filename to avoid collisions
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    unique_id = str(uuid.uuid4())[:8]
-    file_extension = os.path.splitext(filename)[1]
-    new_filename = f"{timestamp}_{unique_id}{file_extension}"
-    
-    # If using a folder structure
-    key = f"{SPACE_FOLDER}/{new_filename}" if SPACE_FOLDER else new_filename
-    
-    try:
-        s3.put_object(
-            Bucket=SPACE_NAME,
-            Key=key,
-            Body=file_content,
-            ACL='public-read'
-        )
-        
-        return f"https://{SPACE_NAME}.sgp1.digitaloceanspaces.com/{key}"
-    except Exception as e:
-        print(f"Error uploading to Spaces: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to upload file to storage")
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT id, url, status, collection FROM documents WHERE content_hash = %s
+            """, (sha256,))
+            doc = await cur.fetchone()
+            if doc and doc["status"] == ProcessingStatus.FAILED.value:
+                await cur.execute("DELETE FROM documents WHERE id = %s", (doc["id"],))
+                return None
+            return doc
+
+async def reuse_duplicate(doc: Dict[str, Any], collection: str | None) -> Dict[str, Any]:
+    """
+    The response for an upload whose content matches an existing document.
 
-async def process_document_background(document_id: str, content: bytes, filename: str):
-    """Process document in background, create chunks and embeddings."""
-    try:
-        processing_status[document_id] = ProcessingStatus.PROCESSING
-        
-        # Process content based on file type
-        if filename.lower().endswith('.pdf'):
-            text = process_pdf(content)
-        else:  # Markdown or text
-            text = process_markdown(content.decode('utf-8'))
-        
-        # Split into chunks
-        chunks = split_into_chunks(text)
-        
-        # Get embeddings for each chunk and store in database
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                for i, chunk in enumerate(chunks):
-                    embedding = get_embedding(chunk)
-                    cur.execute("""
-                        INSERT INTO chunks (id, document_id, text, embedding, "order", created_at)
-                        VALUES (%s, %s, %s, %s, %s, NOW())
-                    """, (str(uuid.uuid4()), document_id, chunk, embedding, i))
-                    conn.commit()  # Commit after each chunk so it's immediately available
-        
-        processing_status[document_id] = ProcessingStatus.COMPLETED
-        
-    except Exception as e:
-        print(f"Processing failed for document {document_id}: {str(e)}")
-        processing_status[document_id] = ProcessingStatus.FAILED
+    A document belongs to at most one collection. One without a collection
+    joins the requested one; one already in another collection can't, so
+    the upload is rejected rather than answered with a document that isn't
+    in the collection the client asked for.
+    """
+    if collection is not None and doc["collection"] != collection:
+        async with get_db() as conn:
+            cursor = await conn.execute("""
+                UPDATE documents SET collection = %s WHERE id = %s AND collection IS NULL
+            """, (collection, doc["id"]))
+        if cursor.rowcount == 0:
+            raise HTTPException(
+                status_code=409,
+                detail=f"This file was already uploaded as document {doc['id']} in another collection, "
+                       f"and a document can only belong to one collection"
+            )
+        doc = {**doc, "collection": collection}
+    return {
+        "document_id": str(doc["id"]),
+        "url": doc["url"],
+        "status": doc["status"],
+        "collection": doc["collection"],
+        "duplicate": True
+    }
 
 @app.post("/upload")
 async def upload_document(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    collection: str | None = Form(None)
 ):
     try:
         # Generate document ID
         document_id = str(uuid.uuid4())
         
-        # Read file content
-        content = await file.read()
+        # Starlette has spooled the upload to a temporary file; hash it in blocks rather than reading it into memory
+        sha256 = await asyncio.to_thread(content_hash, file.file)
         
-        # Upload to Digital Ocean Spaces
-        file_url = upload_to_spaces(content, file.filename)
+        # The same bytes were uploaded before: reuse that document, its chunks and embeddings
+        existing = await find_document_by_hash(sha256)
+        if existing:
+            return await reuse_duplicate(existing, collection)
         
-        # Create document in database
+        # Stream it to Digital Ocean Spaces as a multipart upload (boto3 is blocking, so run it in a worker thread)
+        file_url, file_key = await asyncio.to_thread(upload_to_spaces, file.file, file.filename, sha256)
+        
+        # Create document and queue it for ingestion in the same transaction
+        existing = None
         try:
-            with get_db() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        INSERT INTO documents (id, url, title, created_at)
-                        VALUES (%s, %s, %s, NOW())
-                    """, (document_id, file_url, file.filename))
-                conn.commit()
+            async with get_db() as conn:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute("""
+                        INSERT INTO documents (id, url, title, status, collection, content_hash, created_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                        ON CONFLICT (content_hash) DO NOTHING
+                        RETURNING id
+                    """, (document_id, file_url, file.filename, ProcessingStatus.PENDING.value, collection, sha256))
+                    created = await cur.fetchone()
+                    if not created:
+                        # A concurrent upload of the same file got there first
+                        await cur.execute("""
+                            SELECT id, url, status, collection FROM documents WHERE content_hash = %s
+                        """, (sha256,))
+                        existing = await cur.fetchone()
+                if not existing:
+                    await enqueue_job(conn, document_id, file_key, file.filename)
+                    await conn.commit()
         except Exception as e:
             raise HTTPException(
                 status_code=500,
                 detail=f"Database error: {str(e)}"
             )
         
-        # Set initial status
-        processing_status[document_id] = ProcessingStatus.PENDING
-        
-        # Start background processing
-        background_tasks.add_task(
-            process_document_background,
-            document_id,
-            content,
-            file.filename
-        )
+        if existing:
+            return await reuse_duplicate(existing, collection)
         
         return {
             "document_id": document_id,
@@ -342,153 +318,402 @@ async def upload_document(
             detail=f"Upload failed: {str(e)}"
         )
 
+# Seconds a status stream stays quiet before re-reading progress, which also refreshes the ETA
+STATUS_STREAM_REFRESH = float(os.getenv("STATUS_STREAM_REFRESH", "15"))
+
+# Largest page of the chunk listing
+MAX_CHUNK_PAGE = 500
+
+def status_response(progress: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "status": progress["status"],
+        "phase": progress["phase"],
+        "attempts": progress["attempts"],
+        "error": progress["last_error"],
+        "progress": {
+            "pages_total": progress["pages_total"],
+            "pages_done": progress["pages_done"],
+            "chunks_total": progress["chunks_total"],
+            "chunks_embedded": progress["chunks_embedded"],
+            "chunks_inserted": progress["chunks_inserted"],
+            "eta_seconds": progress["eta_seconds"],
+        },
+        "chunks_processed": progress["chunks_inserted"],
+        "updated_at": progress["updated_at"].isoformat() if progress["updated_at"] else None
+    }
+
 @app.get("/status/{document_id}")
 async def get_status(document_id: str):
-    # Get status from memory
-    status = processing_status.get(document_id, ProcessingStatus.FAILED)
-    
-    # Get chunks if any exist
-    with get_db() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT text, embedding, "order"
-                FROM chunks 
-                WHERE document_id = %s
+    """Ingestion status and progress counters, read from the job's progress record."""
+    async with get_db() as conn:
+        progress = await get_progress(conn, document_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return status_response(progress)
+
+@app.get("/status/{document_id}/events")
+async def stream_status(document_id: str):
+    """
+    Server-sent events carrying the same body as /status whenever it changes,
+    until ingestion completes or fails.
+    """
+    async with get_db() as conn:
+        if not await get_progress(conn, document_id):
+            raise HTTPException(status_code=404, detail="Document not found")
+
+    async def events() -> AsyncIterator[str]:
+        with progress_listener.subscribe(document_id) as changed:
+            last = None
+            while True:
+                changed.clear()
+                async with get_db() as conn:
+                    progress = await get_progress(conn, document_id)
+                if not progress:
+                    return
+                status = status_response(progress)
+                if status != last:
+                    yield f"data: {json.dumps(status)}\n\n"
+                    last = status
+                else:
+                    yield ": keep-alive\n\n"
+                if status["status"] in (ProcessingStatus.COMPLETED.value, ProcessingStatus.FAILED.value):
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), STATUS_STREAM_REFRESH)
+                except asyncio.TimeoutError:
+                    pass
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/documents/{document_id}/chunks")
+async def list_chunks(document_id: str, offset: int = 0, limit: int = 100, embeddings: bool = False):
+    """A page of a document's chunks in order. Embeddings are left out unless asked for."""
+    limit = max(1, min(limit, MAX_CHUNK_PAGE))
+    columns = 'id, "order", text, start_offset, end_offset, page_start, page_end, token_count'
+    if embeddings:
+        columns += ", embedding::real[] AS embedding"
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("SELECT 1 FROM documents WHERE id = %s", (document_id,))
+            if not await cur.fetchone():
+                raise HTTPException(status_code=404, detail="Document not found")
+            # Orders are consecutive from 0, so the offset is a range condition rather than a scan-and-skip
+            await cur.execute(f"""
+                SELECT {columns}
+                FROM chunks
+                WHERE document_id = %s AND "order" >= %s
                 ORDER BY "order" ASC
-            """, (document_id,))
-            chunks = cur.fetchall()
-            
-            return {
-                "status": status.value,
-                "chunks": chunks if chunks else None,
-                "chunks_processed": len(chunks)
-            }
+                LIMIT %s
+            """, (document_id, offset, limit))
+            chunks = await cur.fetchall()
+    return {
+        "chunks": chunks,
+        "offset": offset,
+        "limit": limit,
+        "next_offset": offset + len(chunks) if len(chunks) == limit else None
+    }
 
 @app.get("/documents/{document_id}")
 async def get_document(document_id: str):
     """Get document details by ID."""
-    with get_db() as conn:
-        with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT id, url, title, created_at
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT id, url, title, status, created_at
                 FROM documents 
                 WHERE id = %s
             """, (document_id,))
-            doc = cur.fetchone()
+            doc = await cur.fetchone()
             
             if not doc:
                 raise HTTPException(status_code=404, detail="Document not found")
             
-            # Convert to dict and add status
-            doc_dict = dict(doc)
-            doc_dict['status'] = processing_status.get(document_id, ProcessingStatus.FAILED).value
-            return doc_dict
+            return doc
+
+NO_CHUNKS_RESPONSE = "No chunks found for this document. The document might still be processing."
 
-def get_chat_response(message: str, context_chunks: List[Dict[str, Any]]) -> str:
+def build_chat_messages(message: str, context_chunks: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Build the chat prompt from the question and its ranked context chunks, packed into the context token budget."""
+    with stage("build_context"):
+        context = build_context(context_chunks)
+    CONTEXT_TOKENS.observe(context.tokens)
+    return [
+        {"role": "system", "content": "You are a helpful assistant. Answer questions based on the provided context. If you cannot find the answer in the context, say so."},
+        {"role": "user", "content": f"Context:\n{context.text}\n\nQuestion: {message}"}
+    ]
+
+async def get_chat_response(message: str, context_chunks: List[Dict[str, Any]]) -> str:
     """Get chat response from OpenAI using context chunks."""
-    # Prepare context from chunks
-    context = "\n\n".join([chunk["text"] for chunk in context_chunks])
-    
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant. Answer questions based on the provided context. If you cannot find the answer in the context, say so."},
-                {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {message}"}
-            ],
-            temperature=0.7,
-            max_tokens=500
-        )
+        with stage("generate"):
+            response = await get_openai_client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=build_chat_messages(message, context_chunks),
+                temperature=0.7,
+                max_tokens=500
+            )
         return response.choices[0].message.content
         
     except Exception as e:
         print(f"OpenAI API error: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to get chat response")
 
+async def stream_chat_response(message: str, context_chunks: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Yield the chat response from OpenAI piece by piece as it is generated."""
+    stream = await get_openai_client().chat.completions.create(
+        model=CHAT_MODEL,
+        messages=build_chat_messages(message, context_chunks),
+        temperature=0.7,
+        max_tokens=500,
+        stream=True
+    )
+    async for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+
+def sse_event(event: str, data: Any) -> str:
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def chat_event_stream(message: str, top_chunks: List[Dict[str, Any]], cache_key: str,
+                            timings: Dict[str, float] | None = None) -> AsyncIterator[str]:
+    """
+    Server-sent events for a chat answer.
+
+    Sends the retrieved chunks (and retrieval timings, if any) first, then
+    one token event per piece of the answer, then a done event carrying the
+    full response. A cached answer is sent as a single token.
+    """
+    yield sse_event("chunks", top_chunks)
+    if timings:
+        yield sse_event("timings", timings)
+    if not top_chunks:
+        yield sse_event("token", {"text": NO_CHUNKS_RESPONSE})
+        yield sse_event("done", {"response": NO_CHUNKS_RESPONSE})
+        return
+    
+    cached = await answer_cache.get(cache_key)
+    if cached is not None:
+        yield sse_event("token", {"text": cached})
+        yield sse_event("done", {"response": cached})
+        return
+    
+    # The Server-Timing header is already sent, so generation only goes to the stage histograms
+    parts = []
+    started = time.perf_counter()
+    try:
+        async for text in stream_chat_response(message, top_chunks):
+            if not parts:
+                STAGE_SECONDS.labels("first_token").observe(time.perf_counter() - started)
+            parts.append(text)
+            yield sse_event("token", {"text": text})
+    except Exception as e:
+        # Headers are already sent, so failures are reported in-band
+        print(f"OpenAI streaming error: {str(e)}")
+        yield sse_event("error", {"detail": "Failed to get chat response"})
+        return
+    STAGE_SECONDS.labels("generate").observe(time.perf_counter() - started)
+    response = "".join(parts)
+    await answer_cache.set(cache_key, response)
+    yield sse_event("done", {"response": response})
+
+async def chat_reply(request: "ChatRequest", documents: Documents, top_chunks: List[Dict[str, Any]], strategy: str,
+                     timings: Dict[str, float] | None = None):
+    """
+    Answer from the retrieved chunks, as SSE when the request asks to stream or as JSON.
+
+    Answers are cached per searched documents (as resolved from the
+    request's scope), strategy, retrieved chunks and normalized question,
+    so a repeated question skips the LLM call.
+    Per-stage retrieval timings in milliseconds are passed through to the client.
+    """
+    extra = {"timings": timings} if timings else {}
+    cache_key = answer_cache_key(documents, strategy, [chunk["chunk"] for chunk in top_chunks], request.message)
+    if request.stream:
+        return StreamingResponse(
+            chat_event_stream(request.message, top_chunks, cache_key, timings),
+            media_type="text/event-stream",
+            # Stop nginx and other proxies from buffering the stream
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    if not top_chunks:
+        return {
+            "response": NO_CHUNKS_RESPONSE,
+            "chunks": [],
+            **extra
+        }
+    
+    chat_response = await answer_cache.get(cache_key)
+    if chat_response is None:
+        # Get chat response using context
+        chat_response = await get_chat_response(request.message, top_chunks)
+        await answer_cache.set(cache_key, chat_response)
+    
+    return {
+        "response": chat_response,
+        "chunks": top_chunks,
+        **extra
+    }
+
 # Add request model
 class ChatRequest(BaseModel):
     message: str
+    # What to search: one document, several, a collection, or the whole corpus
     documentId: str | None = None
+    documentIds: List[str] | None = None
+    collection: str | None = None
+    corpus: bool = False
+    # Filters on the searched documents
+    titleContains: str | None = None
+    createdAfter: datetime | None = None
+    createdBefore: datetime | None = None
+    topK: int | None = None
+    stream: bool = False  # Server-sent events instead of a single JSON response
+
+    def has_scope(self) -> bool:
+        return bool(self.documentId or self.documentIds or self.collection or self.corpus)
+
+    def single_document(self) -> bool:
+        """Whether the request targets exactly one document, with no other scope or filter."""
+        return bool(self.documentId) and not (
+            self.documentIds or self.collection or self.corpus
+            or self.titleContains or self.createdAfter or self.createdBefore
+        )
+
+MISSING_SCOPE_DETAIL = "Message and a documentId, documentIds, collection or corpus are required"
+
+# ColBERT and ColPali indexes are per document and searched one by one, so only for this many documents
+MAX_INDEXED_DOCUMENTS = int(os.getenv("MAX_INDEXED_DOCUMENTS", "16"))
+
+async def count_document_chunks(document_id: str) -> int:
+    """Verify the document exists and count its embedded chunks in one round trip."""
+    async with get_db() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute("""
+                SELECT id, (
+                    SELECT count(*) FROM chunks
+                    WHERE document_id = documents.id AND embedding IS NOT NULL
+                ) AS chunk_count
+                FROM documents 
+                WHERE id = %s
+            """, (document_id,))
+            doc = await cur.fetchone()
+            
+            if not doc:
+                matrix_cache.invalidate(document_id)
+                raise HTTPException(status_code=404, detail="Document not found")
+            return doc["chunk_count"]
+
+async def resolve_scope(request: ChatRequest) -> tuple[Documents, int | None]:
+    """
+    The documents a chat request searches and their embedded chunk count.
+
+    A lone documentId keeps the single-document paths (matrix cache and
+    per-document indexes). Other scopes resolve to a list of document ids,
+    or to None for the whole corpus, whose chunks are not counted: it is
+    searched through the HNSW index alone.
+    """
+    if request.single_document():
+        return request.documentId, await count_document_chunks(request.documentId)
+    document_ids = list(request.documentIds or []) + ([request.documentId] if request.documentId else [])
+    async with get_db() as conn:
+        documents = await resolve_documents(
+            conn, document_ids or None, request.collection, request.titleContains,
+            request.createdAfter, request.createdBefore
+        )
+        if documents is None:
+            return None, None
+        if not documents:
+            raise HTTPException(status_code=404, detail="No documents match the request")
+        return documents, await count_chunks(conn, documents)
+
+def source(chunk: Dict[str, Any], documents: Documents) -> Dict[str, Any]:
+    """The document a result came from, when the request spans several."""
+    if isinstance(documents, str):
+        return {}
+    return {"document": str(chunk["document_id"])}
+
+async def search_each_document(search, documents: Documents, k: int) -> tuple[List[Dict[str, Any]] | None, List[str]]:
+    """
+    Run a per-document index search over several documents and merge the results by score.
+
+    Also returns the documents that have no index. The merged ranking is
+    None, for the caller to fall back to embeddings, when the scope is too
+    large to search document by document or no document has an index.
+    """
+    if documents is None or len(documents) > MAX_INDEXED_DOCUMENTS:
+        return None, []
+    results = await asyncio.gather(*(search(document_id) for document_id in documents))
+    unindexed = [document_id for document_id, ranked in zip(documents, results) if ranked is None]
+    if len(unindexed) == len(documents):
+        return None, unindexed
+    merged = [
+        {**hit, "document_id": document_id}
+        for document_id, ranked in zip(documents, results) if ranked
+        for hit in ranked
+    ]
+    merged.sort(key=lambda hit: hit["score"], reverse=True)
+    return merged[:k], unindexed
+
+async def add_unindexed(message: str, unindexed: List[str], top_chunks: List[Dict[str, Any]], k: int,
+                        index_name: str) -> List[Dict[str, Any]]:
+    """
+    Add embedding results from the documents of the scope that have no index, rather than answering without them.
+
+    Their cosine scores aren't comparable with MaxSim, so the two rankings
+    are interleaved rank by rank, which is how reciprocal rank fusion orders
+    two rankings over different documents.
+    """
+    if not unindexed:
+        return top_chunks
+    print(f"No {index_name} index for {len(unindexed)} of the requested documents, searching them by embeddings")
+    query_embedding = await get_embedding(message)
+    async with get_db() as conn:
+        ranked = await retrieve_chunks(conn, unindexed, query_embedding, k=k)
+    fallback = [{
+        "text": chunk["text"],
+        "score": round(chunk["score"], 2),
+        "chunk": chunk["id"],
+        "order": chunk["order"],
+        "document": str(chunk["document_id"]),
+        "retrieval": "embedding"
+    } for chunk in ranked]
+    merged = [chunk for pair in itertools.zip_longest(top_chunks, fallback) for chunk in pair if chunk is not None]
+    return merged[:k]
 
 @app.post("/chat/embedding")
 async def chat_embedding(request: ChatRequest):
     """Endpoint for embedding-based retrieval with OpenAI chat."""
     message = request.message
-    document_id = request.documentId
     
-    if not message or not document_id:
-        raise HTTPException(status_code=400, detail="Message and document_id are required")
+    if not message or not request.has_scope():
+        raise HTTPException(status_code=400, detail=MISSING_SCOPE_DETAIL)
         
     try:
-        # First verify document exists
-        with get_db() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT id FROM documents 
-                    WHERE id = %s
-                """, (document_id,))
-                doc = cur.fetchone()
-                
-                if not doc:
-                    raise HTTPException(status_code=404, detail="Document not found")
+        # First verify the documents exist
+        documents, chunk_count = await resolve_scope(request)
         
         # Get query embedding
-        query_embedding = get_embedding(message)
-        
-        # Get chunks from database
-        with get_db() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT id, text, embedding
-                    FROM chunks 
-                    WHERE document_id = %s
-                    ORDER BY created_at ASC
-                """, (document_id,))
-                chunks = cur.fetchall()
+        query_embedding = await get_embedding(message)
+        
+        # Rank chunks in process from the matrix cache or in Postgres using pgvector
+        async with get_db() as conn:
+            ranked = await retrieve_chunks(conn, documents, query_embedding, k=request.topK, total=chunk_count)
                 
-        if not chunks:
-            return {
-                "response": "No chunks found for this document. The document might still be processing.",
-                "chunks": []
-            }
-            
-        # Calculate cosine similarity
-        chunk_scores = []
-        for chunk in chunks:
-            # Convert string representation of embedding to list of floats if needed
-            chunk_embedding = chunk["embedding"]
-            if isinstance(chunk_embedding, str):
-                # Remove brackets and split by commas
-                chunk_embedding = [float(x) for x in chunk_embedding.strip('[]').split(',')]
-            
-            # Calculate cosine similarity
-            dot_product = np.dot(query_embedding, chunk_embedding)
-            query_norm = np.linalg.norm(query_embedding)
-            chunk_norm = np.linalg.norm(chunk_embedding)
-            
-            if query_norm == 0 or chunk_norm == 0:
-                score = 0
-            else:
-                score = dot_product / (query_norm * chunk_norm)
-            
-            chunk_scores.append((score, chunk))
-            
-        # Sort by score and get top 3
-        chunk_scores.sort(key=lambda x: x[0], reverse=True)
         top_chunks = [{
             "text": chunk["text"], 
-            "score": round(float(score), 2),  # Round to 2 decimal places
-            "chunk": chunk["id"]  # Add chunk ID
-        } for score, chunk in chunk_scores[:3]]
+            "score": round(chunk["score"], 2),  # Round to 2 decimal places
+            "chunk": chunk["id"],  # Add chunk ID
+            "order": chunk["order"],
+            **source(chunk, documents)
+        } for chunk in ranked]
         
-        # Get chat response using context
-        chat_response = get_chat_response(message, top_chunks)
-        
-        return {
-            "response": chat_response,
-            "chunks": top_chunks
-        }
+        return await chat_reply(request, documents, top_chunks, "embedding")
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Embedding chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -497,99 +722,158 @@ async def chat_embedding(request: ChatRequest):
 async def chat_rerank(request: ChatRequest):
     """Endpoint for reranking retrieval using Voyage AI."""
     message = request.message
-    document_id = request.documentId
     
-    if not message or not document_id:
-        raise HTTPException(status_code=400, detail="Message and document_id are required")
+    if not message or not request.has_scope():
+        raise HTTPException(status_code=400, detail=MISSING_SCOPE_DETAIL)
         
     try:
-        # First verify document exists and get chunks
-        with get_db() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                # Get document
-                cur.execute("""
-                    SELECT id FROM documents 
-                    WHERE id = %s
-                """, (document_id,))
-                doc = cur.fetchone()
-                
-                if not doc:
-                    raise HTTPException(status_code=404, detail="Document not found")
-                
-                # Get all chunks
-                cur.execute("""
-                    SELECT id, text
-                    FROM chunks 
-                    WHERE document_id = %s
-                    ORDER BY created_at ASC
-                """, (document_id,))
-                chunks = cur.fetchall()
-
-        if not chunks:
-            return {
-                "response": "No chunks found for this document. The document might still be processing.",
-                "chunks": []
-            }
-
-        # Extract texts and keep track of chunk IDs
-        chunk_texts = [chunk["text"] for chunk in chunks]
-        chunk_ids = [chunk["id"] for chunk in chunks]
-
-        # Rerank all chunks using Voyage AI
-        reranking = voyage_client.rerank(
-            query=message,
-            documents=chunk_texts,
-            model="rerank-2",
-            top_k=3  # Get top 3 most relevant chunks
-        )
-
+        timings = {}
+        started = time.perf_counter()
+        
+        # First verify the documents exist
+        documents, chunk_count = await resolve_scope(request)
+        
+        # Get query embedding
+        query_embedding = await get_embedding(message)
+        timings["embed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        # Stage 1: recall candidates with vector search so the reranker never sees the whole document
+        started = time.perf_counter()
+        async with get_db() as conn:
+            candidates = await retrieve_chunks(conn, documents, query_embedding, k=RERANK_CANDIDATES, total=chunk_count)
+        timings["recall_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        if not candidates:
+            return await chat_reply(request, documents, [], "rerank", timings)
+        
+        # Stage 2: rerank only the candidates using Voyage AI
+        started = time.perf_counter()
+        reranked = await rerank_chunks(get_voyage_client(), message, candidates, k=request.topK or DEFAULT_TOP_K)
+        timings["rerank_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        timings["candidates"] = len(candidates)
+        
         # Format reranked chunks
-        top_chunks = [
-            {
-                "text": result.document,
-                "score": round(float(result.relevance_score), 4),
-                "chunk": chunk_ids[i]
-            }
-            for i, result in enumerate(reranking.results)
-        ]
-
-        # Get chat response using reranked context
-        chat_response = get_chat_response(message, top_chunks)
+        top_chunks = [{
+            "text": chunk["text"],
+            "score": round(chunk["score"], 4),
+            "chunk": chunk["id"],
+            "order": chunk["order"],
+            **source(chunk, documents)
+        } for chunk in reranked]
         
-        return {
-            "response": chat_response,
-            "chunks": top_chunks
-        }
+        # Answer using reranked context
+        return await chat_reply(request, documents, top_chunks, "rerank", timings)
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Rerank chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/hybrid")
+async def chat_hybrid(request: ChatRequest):
+    """Endpoint for hybrid retrieval: full-text and vector rankings fused with reciprocal rank fusion."""
+    message = request.message
+    
+    if not message or not request.has_scope():
+        raise HTTPException(status_code=400, detail=MISSING_SCOPE_DETAIL)
+        
+    try:
+        timings = {}
+        
+        # First verify the documents exist
+        documents, chunk_count = await resolve_scope(request)
+        
+        async def vector_leg():
+            started = time.perf_counter()
+            query_embedding = await get_embedding(message)
+            async with get_db() as conn:
+                ranked = await retrieve_chunks(conn, documents, query_embedding, k=HYBRID_CANDIDATES, total=chunk_count)
+            timings["vector_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            return ranked
+        
+        async def lexical_leg():
+            started = time.perf_counter()
+            async with get_db() as conn:
+                ranked = await lexical_search(conn, documents, message, k=HYBRID_CANDIDATES)
+            timings["lexical_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            return ranked
+        
+        # Run both legs at once so hybrid costs about as much as the slower one
+        started = time.perf_counter()
+        vector_ranked, lexical_ranked = await asyncio.gather(vector_leg(), lexical_leg())
+        timings["retrieve_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        fused = reciprocal_rank_fusion({"vector": vector_ranked, "lexical": lexical_ranked}, k=request.topK)
+        top_chunks = [{
+            "text": chunk["text"],
+            "score": round(chunk["score"], 4),
+            "chunk": chunk["id"],
+            "order": chunk["order"],
+            "ranks": chunk["ranks"],
+            **source(chunk, documents)
+        } for chunk in fused]
+        
+        return await chat_reply(request, documents, top_chunks, "hybrid", timings)
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Hybrid chat error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/chat/colpali")
 async def chat_colpali(request: ChatRequest):
     """Endpoint for Colpali retrieval."""
     message = request.message
-    document_id = request.documentId
     
-    if not message or not document_id:
-        raise HTTPException(status_code=400, detail="Message and document_id are required")
+    if not message or not request.has_scope():
+        raise HTTPException(status_code=400, detail=MISSING_SCOPE_DETAIL)
     
     try:
-        # First verify document exists
-        with get_db() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT id FROM documents 
-                    WHERE id = %s
-                """, (document_id,))
-                doc = cur.fetchone()
-                
-                if not doc:
-                    raise HTTPException(status_code=404, detail="Document not found")
-
-        # For now, use embedding-based retrieval
-        return await chat_embedding(request)
+        timings = {}
+        
+        # First verify the documents exist
+        documents, _ = await resolve_scope(request)
+        k = request.topK or DEFAULT_TOP_K
         
+        if not COLPALI_ENABLED:
+            print("Page retrieval is disabled, falling back to embeddings")
+            return await chat_embedding(request)
+        
+        # Embed the query once; every document's page index scores the same vectors
+        started = time.perf_counter()
+        query_vectors = await encode_colpali_query(message)
+        timings["encode_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        # Score pages by MaxSim over their patch embeddings
+        started = time.perf_counter()
+        if isinstance(documents, str):
+            ranked, unindexed = await colpali_search(documents, query_vectors, k=k), []
+        else:
+            ranked, unindexed = await search_each_document(
+                lambda document_id: colpali_search(document_id, query_vectors, k=k), documents, k
+            )
+        timings["retrieve_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        if ranked is None:
+            # Not a PDF, or indexed before page retrieval was enabled
+            print("No page index for the requested documents, falling back to embeddings")
+            return await chat_embedding(request)
+        
+        top_chunks = [{
+            "text": page["text"],
+            "score": round(page["score"], 2),
+            "chunk": f"{page.get('document_id', documents)}:page-{page['page']}",
+            "page": page["page"],
+            **source(page, documents)
+        } for page in ranked]
+        top_chunks = await add_unindexed(message, unindexed, top_chunks, k, "page")
+        
+        return await chat_reply(request, documents, top_chunks, "colpali", timings)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Colpali chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -598,27 +882,60 @@ async def chat_colpali(request: ChatRequest):
 async def chat_colbert(request: ChatRequest):
     """Endpoint for ColBERT retrieval."""
     message = request.message
-    document_id = request.documentId
     
-    if not message or not document_id:
-        raise HTTPException(status_code=400, detail="Message and document_id are required")
+    if not message or not request.has_scope():
+        raise HTTPException(status_code=400, detail=MISSING_SCOPE_DETAIL)
     
     try:
-        # First verify document exists
-        with get_db() as conn:
-            with conn.cursor(cursor_factory=DictCursor) as cur:
-                cur.execute("""
-                    SELECT id FROM documents 
-                    WHERE id = %s
-                """, (document_id,))
-                doc = cur.fetchone()
-                
-                if not doc:
-                    raise HTTPException(status_code=404, detail="Document not found")
-
-        # For now, use embedding-based retrieval
-        return await chat_embedding(request)
+        timings = {}
+        
+        # First verify the documents exist
+        documents, _ = await resolve_scope(request)
+        k = request.topK or DEFAULT_TOP_K
+        
+        if not COLBERT_ENABLED:
+            print("ColBERT retrieval is disabled, falling back to embeddings")
+            return await chat_embedding(request)
         
+        # Encode the query once; every document's index scores the same token vectors
+        started = time.perf_counter()
+        query_vectors = await encode_colbert_query(message)
+        timings["encode_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        # Score chunks by late interaction over their memory-mapped token vectors
+        started = time.perf_counter()
+        if isinstance(documents, str):
+            hits, unindexed = await colbert_search(documents, query_vectors, k=k), []
+        else:
+            hits, unindexed = await search_each_document(
+                lambda document_id: colbert_search(document_id, query_vectors, k=k), documents, k
+            )
+        
+        if hits is None:
+            # Indexed before ColBERT was enabled; answer from the embedding index instead
+            print("No ColBERT index for the requested documents, falling back to embeddings")
+            return await chat_embedding(request)
+        
+        # One connection, held only to read the text of the top chunks
+        ranked = []
+        if hits:
+            async with get_db() as conn:
+                ranked = await fetch_chunks(conn, hits)
+        timings["retrieve_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        
+        top_chunks = [{
+            "text": chunk["text"],
+            "score": round(chunk["score"], 2),
+            "chunk": chunk["id"],
+            "order": chunk["order"],
+            **source(chunk, documents)
+        } for chunk in ranked]
+        top_chunks = await add_unindexed(message, unindexed, top_chunks, k, "ColBERT")
+        
+        return await chat_reply(request, documents, top_chunks, "colbert", timings)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"ColBERT chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
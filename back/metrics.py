@@ -0,0 +1,161 @@
+import os
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# Fraction of requests and ingestion jobs run under the pyinstrument sampling profiler; 0 turns it off
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+# Seconds between profiler samples
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+
+# Directory the HTML profiles are written to
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/retrieval-profiles")
+
+if PROFILE_SAMPLE_RATE > 0:
+    # Optional dependency; fail at startup rather than on the first sampled request
+    import pyinstrument  # noqa: F401
+
+# Seconds, from sub-millisecond scoring to multi-minute ingestion jobs
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to the response headers, by route",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "retrieval_stage_seconds", "Time spent in each retrieval and generation stage of chat requests",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+DB_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled database connection", buckets=LATENCY_BUCKETS,
+)
+INGESTION_STAGE_SECONDS = Histogram(
+    "ingestion_stage_seconds", "Time spent in each ingestion stage, per page range, batch or document",
+    ["stage"], buckets=LATENCY_BUCKETS,
+)
+INGESTION_JOB_SECONDS = Histogram(
+    "ingestion_job_seconds", "Duration of ingestion job attempts, by outcome",
+    ["outcome"], buckets=LATENCY_BUCKETS,
+)
+CONTEXT_TOKENS = Histogram(
+    "chat_context_tokens", "Tokens of retrieved text in chat prompts",
+    buckets=(64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 8192),
+)
+PREWARM_SECONDS = Gauge("startup_prewarm_seconds", "Time taken to load each client, tokenizer or model at startup",
+                        ["step"])
+INGESTED = Counter("ingestion_items", "Pages extracted and chunks stored by ingestion", ["kind"])
+
+# Stage durations of the request being handled, summed by stage name, for the Server-Timing header
+_request_timings: ContextVar[Dict[str, float] | None] = ContextVar("request_timings", default=None)
+
+
+def add_timing(name: str, seconds: float):
+    """Add a duration to the current request's Server-Timing entries, if a request is being handled."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def record(name: str, seconds: float, histogram: Histogram = STAGE_SECONDS):
+    """Observe a stage duration, and add it to the current request's timings."""
+    histogram.labels(name).observe(seconds)
+    add_timing(name, seconds)
+
+
+@contextmanager
+def stage(name: str, histogram: Histogram = STAGE_SECONDS):
+    """Time the enclosed block as a pipeline stage. Works around awaits; failures are timed too."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, histogram)
+
+
+def ingestion_stage(name: str):
+    return stage(name, INGESTION_STAGE_SECONDS)
+
+
+@contextmanager
+def request_timings():
+    """
+    Collect the stage durations recorded while handling a request.
+
+    Tasks and threads started by the request copy the context, and so add
+    to the same dict.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """A Server-Timing header value, durations in milliseconds."""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+@contextmanager
+def maybe_profile(name: str):
+    """
+    Run the enclosed block under the sampling profiler for a PROFILE_SAMPLE_RATE
+    fraction of calls, writing an HTML report to PROFILE_DIR.
+
+    Async mode attributes time spent awaiting to the await, so the report
+    shows where the block's own wall-clock time went.
+    """
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    from pyinstrument import Profiler
+
+    profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        label = re.sub(r"[^\w.-]+", "_", name).strip("_")
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:8]}.html"
+        with open(os.path.join(PROFILE_DIR, filename), "w") as f:
+            f.write(profiler.output_html())
+
+
+class StatsCollector:
+    """
+    Exports a stats dict, as served as JSON under /metrics/*, as one gauge
+    per numeric field. With label set, the dict holds one stats dict per
+    label value (e.g. one per cache).
+    """
+
+    def __init__(self, prefix: str, stats_fn: Callable[[], Dict[str, Any]], label: str | None = None):
+        self.prefix = prefix
+        self.stats_fn = stats_fn
+        self.label = label
+
+    def collect(self):
+        stats = self.stats_fn()
+        groups = stats.items() if self.label else [(None, stats)]
+        families = {}
+        for group, values in groups:
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if key not in families:
+                    families[key] = GaugeMetricFamily(f"{self.prefix}_{key}", f"{self.prefix} {key.replace('_', ' ')}",
+                                                      labels=[self.label] if self.label else [])
+                families[key].add_metric([group] if self.label else [], value)
+        return list(families.values())
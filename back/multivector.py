@@ -0,0 +1,366 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+
+from storage import download_from_spaces, is_missing_object, put_to_spaces
+
+# Local directory holding multi-vector indexes; files are memory-mapped from here
+MULTIVECTOR_INDEX_DIR = os.getenv("MULTIVECTOR_INDEX_DIR", "/tmp/multivector-index")
+
+# Indexes kept open per process; each is a handful of memory maps, so this bounds file handles, not RAM
+MULTIVECTOR_OPEN_INDEXES = int(os.getenv("MULTIVECTOR_OPEN_INDEXES", "64"))
+
+# Seconds a document found to have no index is not looked up in Spaces again. An index built on
+# another node is picked up after at most this long; one built on this node right away
+MULTIVECTOR_MISSING_TTL = float(os.getenv("MULTIVECTOR_MISSING_TTL", "300"))
+
+# Documents remembered as having no index, per kind
+MULTIVECTOR_MISSING_ENTRIES = 10000
+
+# Vectors used to train centroids and PQ codebooks
+KMEANS_SAMPLE = 1 << 16
+
+INDEX_FILES = ("meta.json", "offsets.npy", "vectors.npy", "codebooks.npy", "centroids.npy",
+               "vector_centroids.npy", "ivf_items.npy", "ivf_offsets.npy")
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int = 8, spherical: bool = True, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means on at most KMEANS_SAMPLE rows of x. Spherical k-means keeps centroids unit length."""
+    rng = np.random.default_rng(seed)
+    if len(x) > KMEANS_SAMPLE:
+        x = x[rng.choice(len(x), KMEANS_SAMPLE, replace=False)]
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignments = assign(x, centroids, spherical)
+        counts = np.bincount(assignments, minlength=k)
+        order = np.argsort(assignments, kind="stable")
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(x[order], np.cumsum(counts)[counts > 0] - counts[counts > 0], axis=0)
+        # Empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+def assign(x: np.ndarray, centroids: np.ndarray, spherical: bool = True, block: int = 65536) -> np.ndarray:
+    """Index of the nearest centroid for every row, computed in blocks to bound memory."""
+    half_norms = 0 if spherical else 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), block):
+        scores = np.asarray(x[start:start + block], dtype=np.float32) @ centroids.T - half_norms
+        out[start:start + block] = scores.argmax(axis=1)
+    return out
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into subspaces and stores each part as the index of its
+    nearest of 256 codewords, so a vector costs one byte per subspace.
+    """
+
+    def __init__(self, codebooks: np.ndarray):
+        self.codebooks = codebooks  # (subspaces, 256, dim / subspaces)
+
+    @classmethod
+    def train(cls, x: np.ndarray, subspaces: int) -> "ProductQuantizer":
+        if x.shape[1] % subspaces:
+            raise ValueError(f"Dimension {x.shape[1]} is not divisible into {subspaces} subspaces")
+        parts = np.split(np.asarray(x, dtype=np.float32), subspaces, axis=1)
+        codebooks = np.zeros((subspaces, 256, x.shape[1] // subspaces), dtype=np.float32)
+        for m, part in enumerate(parts):
+            trained = kmeans(part, 256, spherical=False, seed=m)
+            # Fewer training vectors than codewords: repeat them rather than leave zero codewords
+            codebooks[m] = trained[np.arange(256) % len(trained)]
+        return cls(codebooks)
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        parts = np.split(np.asarray(x, dtype=np.float32), len(self.codebooks), axis=1)
+        return np.stack([assign(part, codebook, spherical=False) for part, codebook in zip(parts, self.codebooks)],
+                        axis=1).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        subspaces = np.arange(len(self.codebooks))
+        return self.codebooks[subspaces, np.asarray(codes, dtype=np.intp)].reshape(len(codes), -1)
+
+
+def segment_rows(offsets: np.ndarray, items: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Row indexes covering the given items' contiguous vector ranges, and the
+    start of each item's segment within them (for ufunc.reduceat).
+    """
+    starts = offsets[items]
+    lengths = offsets[items + 1] - starts
+    segments = np.zeros(len(items), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=segments[1:])
+    rows = np.repeat(starts - segments, lengths) + np.arange(lengths.sum())
+    return rows, segments
+
+
+class MultiVectorIndex:
+    """
+    Several unit vectors per item (tokens of a chunk, patches of a page),
+    stored contiguously so each item is one slice of the vector array.
+
+    Vectors are kept as float16 or as product-quantized codes. Every vector
+    is also assigned to a centroid; the inverted lists from centroid to
+    items let a query shortlist items before any full vector is touched.
+    """
+
+    def __init__(self, meta: dict, offsets: np.ndarray, vectors: np.ndarray, centroids: np.ndarray,
+                 vector_centroids: np.ndarray, ivf_items: np.ndarray, ivf_offsets: np.ndarray,
+                 quantizer: ProductQuantizer | None = None):
+        self.meta = meta
+        self.item_ids = meta["item_ids"]
+        self.offsets = offsets
+        self.vectors = vectors
+        self.centroids = centroids
+        self.vector_centroids = vector_centroids
+        self.ivf_items = ivf_items
+        self.ivf_offsets = ivf_offsets
+        self.quantizer = quantizer
+
+    @classmethod
+    def build(cls, item_ids: List[str], item_vectors: List[np.ndarray], compression: str = "float16",
+              pq_subspaces: int = 16, payloads: List[dict] | None = None) -> "MultiVectorIndex":
+        dim = next((len(v[0]) for v in item_vectors if len(v)), 0)
+        if not dim:
+            raise ValueError("No vectors to index")
+        # Items without vectors get a zero vector so every segment is non-empty
+        item_vectors = [np.asarray(v, dtype=np.float32) if len(v) else np.zeros((1, dim), dtype=np.float32)
+                        for v in item_vectors]
+        lengths = np.array([len(v) for v in item_vectors], dtype=np.int64)
+        offsets = np.zeros(len(item_vectors) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.concatenate(item_vectors)
+
+        # Roughly 4 * sqrt(n) centroids, rounded down to a power of two
+        n_centroids = 1 << max(int(np.log2(4 * np.sqrt(len(flat)))), 0)
+        centroids = kmeans(flat, n_centroids)
+        vector_centroids = assign(flat, centroids)
+
+        # Inverted lists: for each centroid, the distinct items with a vector assigned to it
+        item_of_vector = np.repeat(np.arange(len(item_vectors), dtype=np.int32), lengths)
+        pairs = np.unique(np.stack([vector_centroids, item_of_vector], axis=1), axis=0)
+        ivf_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=len(centroids)), out=ivf_offsets[1:])
+
+        quantizer = None
+        if compression == "pq":
+            quantizer = ProductQuantizer.train(flat, pq_subspaces)
+            vectors = quantizer.encode(flat)
+        elif compression == "float16":
+            vectors = flat.astype(np.float16)
+        else:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        meta = {"item_ids": [str(item_id) for item_id in item_ids], "dim": dim, "compression": compression}
+        if payloads is not None:
+            # Small per-item data returned with search hits, e.g. the text of a page
+            meta["payloads"] = payloads
+        return cls(meta, offsets, vectors, centroids, vector_centroids, pairs[:, 1].astype(np.int32), ivf_offsets,
+                   quantizer)
+
+    def save(self, path: str):
+        """Write the index to a directory, replacing any previous version atomically."""
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent)
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        arrays = {
+            "offsets.npy": self.offsets,
+            "vectors.npy": self.vectors,
+            "centroids.npy": self.centroids,
+            "vector_centroids.npy": self.vector_centroids,
+            "ivf_items.npy": self.ivf_items,
+            "ivf_offsets.npy": self.ivf_offsets,
+        }
+        if self.quantizer is not None:
+            arrays["codebooks.npy"] = self.quantizer.codebooks
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, name), array)
+        if os.path.exists(path):
+            retired = tempfile.mkdtemp(dir=parent)
+            os.replace(path, os.path.join(retired, "index"))
+            os.replace(staging, path)
+            shutil.rmtree(retired, ignore_errors=True)
+        else:
+            os.replace(staging, path)
+
+    @classmethod
+    def load(cls, path: str) -> "MultiVectorIndex":
+        """Open a saved index with its large arrays memory-mapped rather than read into RAM."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        def array(name, mmap_mode="r"):
+            return np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+
+        quantizer = ProductQuantizer(array("codebooks.npy", None)) if meta["compression"] == "pq" else None
+        return cls(meta, array("offsets.npy", None), array("vectors.npy"), array("centroids.npy", None),
+                   array("vector_centroids.npy"), array("ivf_items.npy", None), array("ivf_offsets.npy", None),
+                   quantizer)
+
+    def nbytes(self) -> int:
+        return int(self.vectors.nbytes)
+
+    def _decode(self, rows: np.ndarray) -> np.ndarray:
+        stored = self.vectors[rows]
+        if self.quantizer is not None:
+            return self.quantizer.decode(stored)
+        return stored.astype(np.float32)
+
+    def maxsim(self, query: np.ndarray, items: np.ndarray) -> np.ndarray:
+        """Exact late-interaction score of each item: sum over query vectors of the best dot product."""
+        rows, segments = segment_rows(self.offsets, items)
+        similarities = query @ self._decode(rows).T
+        return np.maximum.reduceat(similarities, segments, axis=1).sum(axis=0)
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = 4, candidates: int = 64) -> List[Tuple[str, float]]:
+        """
+        Top k items for a query given as one unit vector per row.
+
+        Each query vector probes its nprobe closest centroids; only items with
+        a vector in those lists are considered. If that leaves more than
+        candidates items, they are ranked by MaxSim over centroid scores
+        (one lookup per stored vector), and only the survivors are decoded
+        and scored exactly.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        centroid_scores = query @ self.centroids.T
+        if nprobe < len(self.centroids):
+            probed = np.unique(np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe])
+        else:
+            probed = np.arange(len(self.centroids))
+        items = np.unique(np.concatenate([self.ivf_items[self.ivf_offsets[c]:self.ivf_offsets[c + 1]]
+                                          for c in probed]))
+        if not len(items):
+            return []
+
+        if len(items) > candidates:
+            rows, segments = segment_rows(self.offsets, items)
+            approximate = centroid_scores[:, self.vector_centroids[rows]]
+            approximate = np.maximum.reduceat(approximate, segments, axis=1).sum(axis=0)
+            items = items[np.argpartition(-approximate, candidates - 1)[:candidates]]
+
+        scores = self.maxsim(query, items)
+        best = np.argsort(-scores)[:k]
+        return [(self.item_ids[items[i]], float(scores[i])) for i in best]
+
+
+class IndexStore:
+    """
+    Saved indexes for one kind of multi-vector retrieval.
+
+    Indexes are written to MULTIVECTOR_INDEX_DIR and copied to Spaces so any
+    node can fetch one on first use; open indexes are kept in a small LRU.
+    Documents without an index are remembered for MULTIVECTOR_MISSING_TTL
+    seconds, so chats about them don't each send a request to Spaces. When
+    the kind of retrieval is disabled nothing is looked up at all.
+    """
+
+    def __init__(self, kind: str, enabled: bool = True, max_open: int = MULTIVECTOR_OPEN_INDEXES,
+                 missing_ttl: float = MULTIVECTOR_MISSING_TTL):
+        self.kind = kind
+        self.enabled = enabled
+        self.max_open = max_open
+        self.missing_ttl = missing_ttl
+        self._open: "OrderedDict[str, MultiVectorIndex]" = OrderedDict()
+        # Document id -> time.monotonic() when it was found to have no index
+        self._missing: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def local_path(self, document_id: str) -> str:
+        return os.path.join(MULTIVECTOR_INDEX_DIR, self.kind, str(document_id))
+
+    def remote_key(self, document_id: str, name: str) -> str:
+        return f"indexes/{self.kind}/{document_id}/{name}"
+
+    def save(self, document_id: str, index: MultiVectorIndex):
+        path = self.local_path(document_id)
+        index.save(path)
+        for name in INDEX_FILES:
+            file_path = os.path.join(path, name)
+            if os.path.exists(file_path):
+                with open(file_path, "rb") as f:
+                    put_to_spaces(self.remote_key(document_id, name), f.read())
+        self.invalidate(document_id)
+
+    def _fetch(self, document_id: str) -> bool:
+        """
+        Copy an index down from Spaces. False if the document has none.
+
+        Errors other than a missing object, such as an outage or bad
+        credentials, are raised rather than taken to mean there is no index.
+        """
+        try:
+            meta = download_from_spaces(self.remote_key(document_id, "meta.json"))
+        except Exception as e:
+            if not is_missing_object(e):
+                raise
+            return False
+        path = self.local_path(document_id)
+        staging = tempfile.mkdtemp(dir=os.path.dirname(path))
+        try:
+            for name in INDEX_FILES:
+                if name == "codebooks.npy" and json.loads(meta)["compression"] != "pq":
+                    continue
+                content = meta if name == "meta.json" else download_from_spaces(self.remote_key(document_id, name))
+                with open(os.path.join(staging, name), "wb") as f:
+                    f.write(content)
+            try:
+                os.replace(staging, path)
+            except OSError:
+                # Fine if another thread or process fetched it first; a failed write is not
+                if not os.path.exists(os.path.join(path, "meta.json")):
+                    raise
+        finally:
+            # Gone once moved into place; otherwise partial or redundant files
+            shutil.rmtree(staging, ignore_errors=True)
+        return True
+
+    def get(self, document_id: str) -> MultiVectorIndex | None:
+        """Open a document's index, fetching it from Spaces if needed. Blocking; call from a thread."""
+        if not self.enabled:
+            return None
+        document_id = str(document_id)
+        with self._lock:
+            index = self._open.get(document_id)
+            if index is not None:
+                self._open.move_to_end(document_id)
+                return index
+            missing_since = self._missing.get(document_id)
+            if missing_since is not None:
+                if time.monotonic() - missing_since < self.missing_ttl:
+                    return None
+                del self._missing[document_id]
+        path = self.local_path(document_id)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not self._fetch(document_id):
+                with self._lock:
+                    self._missing[document_id] = time.monotonic()
+                    while len(self._missing) > MULTIVECTOR_MISSING_ENTRIES:
+                        self._missing.popitem(last=False)
+                return None
+        index = MultiVectorIndex.load(path)
+        with self._lock:
+            self._open[document_id] = index
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        return index
+
+    def invalidate(self, document_id: str):
+        with self._lock:
+            self._open.pop(str(document_id), None)
+            self._missing.pop(str(document_id), None)
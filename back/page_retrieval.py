@@ -0,0 +1,254 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple
+
+import numpy as np
+
+from ingest import count_pdf_pages
+from metrics import stage
+from multivector import IndexStore, MultiVectorIndex
+
+# Build a page-image index for every ingested PDF
+COLPALI_ENABLED = os.getenv("COLPALI_ENABLED", "false").lower() == "true"
+
+# "colpali" runs a ColPali checkpoint on CPU (needs the colpali-engine package);
+# "stub" embeds each page's words instead of its pixels, for local runs and tests
+COLPALI_EMBEDDER = os.getenv("COLPALI_EMBEDDER", "colpali")
+COLPALI_MODEL = os.getenv("COLPALI_MODEL", "vidore/colpali-v1.2")
+
+# Resolution pages are rendered at before embedding
+COLPALI_DPI = int(os.getenv("COLPALI_DPI", "96"))
+
+# Processes rendering and embedding pages. Each loads its own float32 copy of the model (several GB),
+# so only raise this on hosts with the memory for one copy per worker
+COLPALI_WORKERS = int(os.getenv("COLPALI_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+# Processes embedding chat queries. They are kept apart from the ones indexing pages, so a query
+# isn't queued behind every page batch of a large PDF; each loads its own copy of the model too
+COLPALI_QUERY_WORKERS = int(os.getenv("COLPALI_QUERY_WORKERS", "1"))
+
+# Pages rendered and embedded per task sent to a worker process
+COLPALI_BATCH_PAGES = int(os.getenv("COLPALI_BATCH_PAGES", "4"))
+
+# Batches of one PDF submitted to the pool at a time; enough to keep every worker busy
+COLPALI_BATCHES_IN_FLIGHT = int(os.getenv("COLPALI_BATCHES_IN_FLIGHT", str(2 * COLPALI_WORKERS)))
+
+COLPALI_COMPRESSION = os.getenv("COLPALI_COMPRESSION", "float16")
+
+# Centroids probed per query vector, and pages scored exactly after centroid pruning
+COLPALI_NPROBE = int(os.getenv("COLPALI_NPROBE", "4"))
+COLPALI_CANDIDATES = int(os.getenv("COLPALI_CANDIDATES", "32"))
+
+page_indexes = IndexStore("colpali", enabled=COLPALI_ENABLED)
+
+
+class PageImage:
+    """A rendered PDF page and the text layer PyMuPDF found on it."""
+
+    def __init__(self, page_number: int, png: bytes, text: str):
+        self.page_number = page_number
+        self.png = png
+        self.text = text
+
+
+class StubPatchEmbedder:
+    """Embeds a page's words in place of image patches, so retrieval works without a vision model."""
+
+    def __init__(self):
+        from late_interaction import HashingTokenEncoder
+        self.encoder = HashingTokenEncoder()
+
+    def embed_pages(self, pages: List[PageImage]) -> List[np.ndarray]:
+        return self.encoder.encode_documents([page.text for page in pages])
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.encoder.encode_query(text)
+
+
+class ColPaliEmbedder:
+    """A ColPali checkpoint run on CPU through the colpali-engine package."""
+
+    def __init__(self, model: str = COLPALI_MODEL):
+        import torch
+        from colpali_engine.models import ColPali, ColPaliProcessor
+
+        self.torch = torch
+        self.model = ColPali.from_pretrained(model, torch_dtype=torch.float32, device_map="cpu").eval()
+        self.processor = ColPaliProcessor.from_pretrained(model)
+
+    def _embed(self, batch) -> List[np.ndarray]:
+        with self.torch.no_grad():
+            output = self.model(**batch)
+        # Drop padding positions; each row of the result is one patch (or query token) vector
+        return [vectors[mask.bool()].float().numpy() for vectors, mask in zip(output, batch["attention_mask"])]
+
+    def embed_pages(self, pages: List[PageImage]) -> List[np.ndarray]:
+        from PIL import Image
+        images = [Image.open(io.BytesIO(page.png)).convert("RGB") for page in pages]
+        return self._embed(self.processor.process_images(images))
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self._embed(self.processor.process_queries([text]))[0]
+
+
+_embedder = None
+
+
+def get_embedder():
+    """The configured patch embedder, loaded once per worker process."""
+    global _embedder
+    if _embedder is None:
+        _embedder = StubPatchEmbedder() if COLPALI_EMBEDDER == "stub" else ColPaliEmbedder()
+    return _embedder
+
+
+def render_pages(path: str, page_numbers: List[int], dpi: int = COLPALI_DPI) -> List[PageImage]:
+    """Render the given 1-based pages of a PDF file to PNG."""
+    import pymupdf
+
+    doc = pymupdf.open(path)
+    try:
+        return [
+            PageImage(number, doc[number - 1].get_pixmap(dpi=dpi).tobytes("png"), doc[number - 1].get_text())
+            for number in page_numbers
+        ]
+    finally:
+        doc.close()
+
+
+def load_embedder():
+    """Worker process task: load the patch embedder ahead of the first query."""
+    get_embedder()
+
+
+def embed_page_batch(path: str, page_numbers: List[int], dpi: int) -> List[Tuple[int, str, np.ndarray]]:
+    """Worker process task: render and embed a batch of pages."""
+    pages = render_pages(path, page_numbers, dpi)
+    vectors = get_embedder().embed_pages(pages)
+    return [(page.page_number, page.text, page_vectors.astype(np.float32))
+            for page, page_vectors in zip(pages, vectors)]
+
+
+def embed_query(text: str) -> np.ndarray:
+    """Worker process task: embed a query with the same model as the pages."""
+    return np.asarray(get_embedder().embed_query(text), dtype=np.float32)
+
+
+_executor = None
+_query_executor = None
+_executor_lock = threading.Lock()
+
+
+def spawn_executor(workers: int) -> ProcessPoolExecutor:
+    """
+    A process pool for rendering and embedding. Spawned rather than forked
+    so workers don't inherit the event loop, pool connections or threads.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Process pool indexing the pages of ingested PDFs."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = spawn_executor(COLPALI_WORKERS)
+        return _executor
+
+
+def get_query_executor() -> ProcessPoolExecutor:
+    """Process pool embedding chat queries."""
+    global _query_executor
+    with _executor_lock:
+        if _query_executor is None:
+            _query_executor = spawn_executor(COLPALI_QUERY_WORKERS)
+        return _query_executor
+
+
+async def prewarm_executor():
+    """Start the worker processes of both pools and load the patch embedder in each of them."""
+    loop = asyncio.get_running_loop()
+    pools = [(get_executor(), COLPALI_WORKERS), (get_query_executor(), COLPALI_QUERY_WORKERS)]
+    # Loading takes long enough that concurrent tasks land on different workers
+    await asyncio.gather(*(loop.run_in_executor(executor, load_embedder)
+                           for executor, workers in pools for _ in range(workers)))
+
+
+def shutdown_executor():
+    global _executor, _query_executor
+    with _executor_lock:
+        for executor in (_executor, _query_executor):
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        _executor = None
+        _query_executor = None
+
+
+async def index_pdf(document_id: str, path: str, dpi: int = COLPALI_DPI):
+    """
+    Render, embed and index every page of a PDF file, spreading batches of pages across the process pool.
+
+    Only COLPALI_BATCHES_IN_FLIGHT batches are submitted at a time, and
+    finished pages are kept in half precision until the index is built, so
+    a long PDF neither floods the pool nor holds every page in float32.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    page_count = await asyncio.to_thread(count_pdf_pages, path)
+    pending = deque(list(range(start, min(start + COLPALI_BATCH_PAGES, page_count + 1)))
+                    for start in range(1, page_count + 1, COLPALI_BATCH_PAGES))
+    in_flight = deque()
+    pages = []
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < COLPALI_BATCHES_IN_FLIGHT:
+                in_flight.append(loop.run_in_executor(executor, embed_page_batch, path, pending.popleft(), dpi))
+            pages.extend((number, text, vectors.astype(np.float16))
+                         for number, text, vectors in await in_flight.popleft())
+    finally:
+        for future in in_flight:
+            future.cancel()
+    if not pages:
+        return
+
+    index = await asyncio.to_thread(
+        MultiVectorIndex.build,
+        [str(number) for number, _, _ in pages],
+        [vectors for _, _, vectors in pages],
+        COLPALI_COMPRESSION,
+        payloads=[{"text": text} for _, text, _ in pages],
+    )
+    await asyncio.to_thread(page_indexes.save, document_id, index)
+
+
+async def encode_query(query: str) -> np.ndarray:
+    """A query's ColPali vectors, embedded once however many documents it is searched in."""
+    with stage("colpali_encode"):
+        return await asyncio.get_running_loop().run_in_executor(get_query_executor(), embed_query, query)
+
+
+async def colpali_search(document_id: str, query_vectors: np.ndarray, k: int) -> List[Dict[str, Any]] | None:
+    """
+    Rank a document's pages by MaxSim between an embedded query and patch vectors.
+
+    Scores are averaged over query vectors. Returns None when the document
+    has no page index.
+    """
+    with stage("colpali_search"):
+        index = await asyncio.to_thread(page_indexes.get, document_id)
+        if index is None:
+            return None
+        if not len(query_vectors):
+            return []
+        hits = await asyncio.to_thread(index.search, query_vectors, k, COLPALI_NPROBE, COLPALI_CANDIDATES)
+    positions = {item_id: i for i, item_id in enumerate(index.item_ids)}
+    return [{
+        "page": int(page),
+        "text": index.meta["payloads"][positions[page]]["text"],
+        "score": score / len(query_vectors),
+    } for page, score in hits]
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any, Dict, Set
+
+import psycopg
+from psycopg.rows import dict_row
+
+from db import get_db, get_postgres_url
+
+# Minimum seconds between progress writes while a job runs; phase changes are always written
+PROGRESS_SAVE_INTERVAL = float(os.getenv("PROGRESS_SAVE_INTERVAL", "1"))
+
+# Postgres channel carrying the id of a document whose progress changed
+PROGRESS_CHANNEL = "ingestion_progress"
+
+
+class Phase(Enum):
+    QUEUED = "queued"
+    DOWNLOADING = "downloading"
+    EMBEDDING = "embedding"  # Extraction, chunking, embedding and inserts overlap
+    INDEXING = "indexing"  # Building the optional late-interaction and page indexes
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+async def notify_progress(conn, document_id: str):
+    """Tell status streams the document's progress changed. Delivered when the transaction commits."""
+    await conn.execute("SELECT pg_notify(%s, %s)", (PROGRESS_CHANNEL, str(document_id)))
+
+
+class ProgressTracker:
+    """
+    Counters of a running ingestion job, persisted on its ingestion_jobs row.
+
+    Counters change on every page and batch, so writes are throttled to
+    one per PROGRESS_SAVE_INTERVAL unless forced.
+    """
+
+    def __init__(self, job: dict):
+        self.job_id = job["id"]
+        self.document_id = str(job["document_id"])
+        self.phase = Phase.DOWNLOADING
+        self.pages_total: int | None = None
+        self.pages_done = 0
+        self.chunks_embedded = job["chunks_done"]
+        self.chunks_total: int | None = None
+        self._saved_at = 0.0
+
+    async def set_phase(self, phase: Phase):
+        self.phase = phase
+        await self.save(force=True)
+
+    async def save(self, conn=None, force: bool = False):
+        """Write the counters, in conn's transaction when given."""
+        if not force and time.monotonic() - self._saved_at < PROGRESS_SAVE_INTERVAL:
+            return
+        self._saved_at = time.monotonic()
+        if conn is not None:
+            await self._write(conn)
+            return
+        async with get_db() as conn:
+            await self._write(conn)
+
+    async def _write(self, conn):
+        await conn.execute("""
+            UPDATE ingestion_jobs
+            SET phase = %s, pages_total = %s, pages_done = %s, chunks_embedded = %s,
+                chunks_total = COALESCE(%s, chunks_total), updated_at = NOW()
+            WHERE id = %s
+        """, (self.phase.value, self.pages_total, self.pages_done, self.chunks_embedded,
+              self.chunks_total, self.job_id))
+        await notify_progress(conn, self.document_id)
+
+
+def estimate_eta(progress: Dict[str, Any]) -> float | None:
+    """
+    Seconds until the job finishes, extrapolated from the current attempt's rate.
+
+    Only chunks inserted since this attempt resumed count towards the rate;
+    the ones earlier attempts committed took none of its elapsed time.
+    Until chunking ends the total is estimated from the pages extracted so far.
+    """
+    if progress["phase"] != Phase.EMBEDDING.value or not progress["started_at"]:
+        return None
+    total = progress["chunks_total"]
+    if total is None and progress["pages_total"] and progress["pages_done"]:
+        total = progress["chunks_embedded"] * progress["pages_total"] / progress["pages_done"]
+    inserted = progress["chunks_inserted"] - progress["resumed_from"]
+    if not total or inserted <= 0:
+        return None
+    elapsed = (progress["now"] - progress["started_at"]).total_seconds()
+    remaining = max(0.0, total - progress["chunks_inserted"])
+    return round(remaining * elapsed / inserted, 1)
+
+
+async def get_progress(conn, document_id: str) -> Dict[str, Any] | None:
+    """Status and progress counters of a document's latest ingestion job, or None if there is no such document."""
+    async with conn.cursor(row_factory=dict_row) as cur:
+        await cur.execute("""
+            SELECT d.status, j.phase, j.attempts, j.last_error,
+                   j.pages_total, j.pages_done, j.chunks_embedded,
+                   j.chunks_done AS chunks_inserted, j.resumed_from, j.chunks_total,
+                   j.started_at, j.updated_at, NOW()::timestamp AS now
+            FROM documents d
+            LEFT JOIN LATERAL (
+                SELECT * FROM ingestion_jobs
+                WHERE document_id = d.id
+                ORDER BY created_at DESC
+                LIMIT 1
+            ) j ON true
+            WHERE d.id = %s
+        """, (document_id,))
+        progress = await cur.fetchone()
+        if progress is None:
+            return None
+        if progress["phase"] is None:
+            # Ingested before jobs were tracked
+            await cur.execute("SELECT count(*) AS n FROM chunks WHERE document_id = %s", (document_id,))
+            count = (await cur.fetchone())["n"]
+            progress.update(phase=progress["status"], chunks_embedded=count, chunks_inserted=count,
+                            chunks_total=count)
+    progress["eta_seconds"] = estimate_eta(progress)
+    del progress["now"], progress["resumed_from"]
+    return progress
+
+
+class ProgressListener:
+    """
+    Wakes status streams when their document's progress changes.
+
+    One LISTEN connection per process, opened on the first subscription,
+    fans notifications out to every stream watching the notified document.
+    """
+
+    def __init__(self, channel: str = PROGRESS_CHANNEL):
+        self.channel = channel
+        self._subscribers: Dict[str, Set[asyncio.Event]] = {}
+        self._task: asyncio.Task | None = None
+
+    @contextmanager
+    def subscribe(self, document_id: str):
+        """An event set whenever the document's progress may have changed."""
+        event = asyncio.Event()
+        self._subscribers.setdefault(document_id, set()).add(event)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen())
+        try:
+            yield event
+        finally:
+            events = self._subscribers.get(document_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self._subscribers[document_id]
+
+    def _wake_all(self):
+        for events in self._subscribers.values():
+            for event in events:
+                event.set()
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(get_postgres_url(), autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.channel}")
+                    # Changes made while (re)connecting went unnoticed
+                    self._wake_all()
+                    async for notify in conn.notifies():
+                        for event in self._subscribers.get(notify.payload, ()):
+                            event.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Progress listener error: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+progress_listener = ProgressListener()
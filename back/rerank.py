@@ -0,0 +1,45 @@
+import asyncio
+import os
+from typing import List, Dict, Any
+
+from metrics import stage
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "rerank-2")
+
+# Candidates recalled by vector search and passed on to the reranker
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+
+# Documents sent per rerank request; larger candidate sets are split and reranked concurrently
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "100"))
+
+
+async def rerank_chunks(client, query: str, candidates: List[Dict[str, Any]], k: int,
+                        batch_size: int = RERANK_BATCH_SIZE) -> List[Dict[str, Any]]:
+    """
+    Rerank candidate chunks and return the best k.
+
+    Candidates are dicts with at least id and text. Relevance scores are
+    absolute, so results from separate batches can be merged by score.
+    """
+    if not candidates:
+        return []
+
+    async def rerank_batch(start: int):
+        batch = candidates[start:start + batch_size]
+        reranking = await client.rerank(
+            query=query,
+            documents=[chunk["text"] for chunk in batch],
+            model=RERANK_MODEL,
+            top_k=min(k, len(batch))
+        )
+        # result.index points into this batch, not into the candidate list
+        return [
+            {**batch[result.index], "score": float(result.relevance_score)}
+            for result in reranking.results
+        ]
+
+    with stage("rerank"):
+        batches = await asyncio.gather(*(rerank_batch(start) for start in range(0, len(candidates), batch_size)))
+    ranked = [chunk for batch in batches for chunk in batch]
+    ranked.sort(key=lambda chunk: chunk["score"], reverse=True)
+    return ranked[:k]
@@ -0,0 +1,565 @@
+import asyncio
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Dict, Any, Sequence
+
+import numpy as np
+from psycopg.rows import dict_row
+
+from chunk_store import decode_vectors
+from metrics import stage
+
+# Number of chunks returned to the chat endpoints when the request doesn't ask for a specific k
+DEFAULT_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+
+# Size of the HNSW candidate list; higher means better recall and slower queries
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+
+# How filtered HNSW scans continue past ef_search when too few candidates match the filter
+# (pgvector 0.8+): "relaxed_order", "strict_order" or "off"
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+
+# Documents with at most this many chunks are ranked exactly instead of through the HNSW index
+EXACT_SEARCH_THRESHOLD = int(os.getenv("EXACT_SEARCH_THRESHOLD", "2000"))
+
+# "auto" scores small documents in process and large ones in pgvector; "memory" or "pgvector" forces one
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "auto")
+
+# Memory budget for cached per-document embedding matrices
+MATRIX_CACHE_BYTES = int(os.getenv("MATRIX_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+# Chunks taken from each of the vector and full-text rankings before hybrid fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+
+# Reciprocal rank fusion constant; larger values flatten the advantage of top ranks
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+# Text search configuration of the chunks.search_vector column
+FULLTEXT_CONFIG = "english"
+
+# "float32" searches the full vectors. "halfvec" and "binary" search the compact HNSW expression
+# indexes on chunks.embedding and cache compact matrices; binary re-scores its candidates exactly.
+# Those indexes need pgvector 0.7+ and are opt-in: run sql/vector_precision_indexes.sql before switching.
+VECTOR_PRECISION = os.getenv("VECTOR_PRECISION", "float32")
+
+# Candidates ranked by Hamming distance before exact re-scoring, with binary precision
+BINARY_CANDIDATES = int(os.getenv("BINARY_CANDIDATES", "100"))
+
+EMBEDDING_DIMENSIONS = 1536
+
+# Rows of a float16 matrix converted to float32 at a time while scoring
+SCORE_BLOCK_ROWS = 4096
+
+# Set bits in every byte value, for Hamming distances over packed bits
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def to_vector_literal(embedding) -> str:
+    """Format an embedding as a pgvector text literal, e.g. '[0.1,0.2]'."""
+    return "[" + ",".join(str(float(x)) for x in embedding) + "]"
+
+
+# The chunks a query searches: one document id, a list of document ids, or None for the whole corpus
+Documents = str | Sequence[str] | None
+
+
+def chunk_filter(documents: Documents) -> tuple[str, tuple]:
+    """SQL condition on chunks.document_id, and its parameters, for the given documents."""
+    if documents is None:
+        return "TRUE", ()
+    if isinstance(documents, str):
+        return "document_id = %s", (documents,)
+    return "document_id = ANY(%s)", (list(documents),)
+
+
+async def resolve_documents(conn, document_ids: List[str] | None = None, collection: str | None = None,
+                            title: str | None = None, created_after: datetime | None = None,
+                            created_before: datetime | None = None) -> List[str] | None:
+    """
+    Ids of the documents matching every given filter, or None when no
+    filter is given and the whole corpus is searched.
+
+    title matches case-insensitively anywhere in the document title;
+    created_after is inclusive and created_before exclusive.
+    """
+    clauses, params = [], []
+    if document_ids is not None:
+        clauses.append("id = ANY(%s::uuid[])")
+        params.append(list(document_ids))
+    if collection is not None:
+        clauses.append("collection = %s")
+        params.append(collection)
+    if title:
+        clauses.append("title ILIKE %s")
+        params.append("%" + re.sub(r"([\\%_])", r"\\\1", title) + "%")
+    if created_after is not None:
+        clauses.append("created_at >= %s")
+        params.append(created_after)
+    if created_before is not None:
+        clauses.append("created_at < %s")
+        params.append(created_before)
+    if not clauses:
+        return None
+    async with conn.cursor() as cur:
+        await cur.execute(f"SELECT id FROM documents WHERE {' AND '.join(clauses)}", params)
+        return [str(row[0]) for row in await cur.fetchall()]
+
+
+async def count_chunks(conn, documents: Documents) -> int:
+    """Count the embedded chunks of the given documents using the document_idx index."""
+    where, params = chunk_filter(documents)
+    async with conn.cursor() as cur:
+        await cur.execute(f"""
+            SELECT count(*) FROM chunks
+            WHERE {where} AND embedding IS NOT NULL
+        """, params)
+        return (await cur.fetchone())[0]
+
+
+async def exact_search(conn, documents: Documents, query_vector: str, k: int) -> List[Dict[str, Any]]:
+    """
+    Rank every chunk of the given documents by cosine distance.
+
+    The materialized CTE keeps the planner on document_idx, so the HNSW
+    index is never consulted and the result is exact.
+    """
+    where, params = chunk_filter(documents)
+    async with conn.cursor(row_factory=dict_row) as cur:
+        await cur.execute(f"""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, document_id, text, "order", embedding <=> %s::vector AS distance
+                FROM chunks
+                WHERE {where} AND embedding IS NOT NULL
+            )
+            SELECT id, document_id, text, "order", distance
+            FROM candidates
+            ORDER BY distance ASC
+            LIMIT %s
+        """, (query_vector, *params, k))
+        return await cur.fetchall()
+
+
+# Iterative index scans arrived in pgvector 0.8.0
+ITERATIVE_SCAN_MIN_VERSION = (0, 8, 0)
+
+_iterative_scan_supported = False
+
+
+def version_tuple(version: str) -> tuple:
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+async def configure_hnsw(cur, ef_search: int, filtered: bool):
+    """
+    Set the HNSW scan options for the current transaction.
+
+    Filtered scans use pgvector's iterative index scans where available, so
+    a filter matching a small slice of the table keeps scanning the graph
+    instead of coming back short.
+    """
+    global _iterative_scan_supported
+    # SET LOCAL only lasts until the end of the current transaction
+    await cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),))
+    if not filtered or HNSW_ITERATIVE_SCAN == "off":
+        return
+    if not _iterative_scan_supported:
+        # The installed extension version, not the setting: the setting only exists once a vector
+        # operation has loaded the library into this backend. Only a positive answer is kept, so an
+        # extension upgrade is picked up without a restart.
+        await cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = await cur.fetchone()
+        _iterative_scan_supported = row is not None and version_tuple(row["extversion"]) >= ITERATIVE_SCAN_MIN_VERSION
+    if _iterative_scan_supported:
+        await cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,))
+
+
+async def ann_search(conn, documents: Documents, query_vector: str, k: int, ef_search: int,
+                     precision: str = VECTOR_PRECISION) -> List[Dict[str, Any]]:
+    """
+    Rank chunks of the given documents through an HNSW index with the given ef_search.
+
+    float32 uses embeddingIndex. halfvec uses embedding_halfvec_idx, and its
+    distances are computed in half precision. binary takes BINARY_CANDIDATES
+    chunks by Hamming distance through embedding_binary_idx, then re-ranks
+    them by exact cosine distance on the full vectors.
+
+    Iterative scans may return matches slightly out of order, so the index
+    results are sorted again by distance.
+    """
+    where, params = chunk_filter(documents)
+    if precision == "halfvec":
+        index_order = f"embedding::halfvec({EMBEDDING_DIMENSIONS}) <=> %s::halfvec"
+    elif precision == "binary":
+        index_order = f"binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS}) <~> binary_quantize(%s::vector)"
+        ef_search = max(ef_search, BINARY_CANDIDATES)
+    else:
+        index_order = "embedding <=> %s::vector"
+    # Binary distances only pick candidates; the rest score with the index's own distance
+    distance = "embedding <=> %s::vector" if precision == "binary" else index_order
+    limit = max(k, BINARY_CANDIDATES) if precision == "binary" else k
+
+    async with conn.cursor(row_factory=dict_row) as cur:
+        await configure_hnsw(cur, ef_search, documents is not None)
+        await cur.execute(f"""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, document_id, text, "order", embedding
+                FROM chunks
+                WHERE {where}
+                ORDER BY {index_order}
+                LIMIT %s
+            )
+            SELECT id, document_id, text, "order", {distance} AS distance
+            FROM candidates
+            ORDER BY distance
+            LIMIT %s
+        """, (*params, query_vector, limit, query_vector, k))
+        rows = await cur.fetchall()
+    await conn.commit()
+    return rows
+
+
+async def search_chunks(conn, documents: Documents, query_embedding, k: int | None = None,
+                  ef_search: int | None = None, total: int | None = None) -> List[Dict[str, Any]]:
+    """
+    Return the top-k chunks of one or more documents, or of the whole
+    corpus, for a query embedding.
+
+    The whole corpus is searched through the HNSW index alone, so queries
+    stay sub-linear in the size of the chunks table. Small sets of
+    documents are ranked exactly. Larger ones go through the index with a
+    filter; if the filtered scan comes back short, the exact ranking is
+    used instead.
+
+    Returns:
+        List of dicts with id, document_id, text, order and score (cosine
+        similarity), best match first.
+    """
+    k = k or DEFAULT_TOP_K
+    # ef_search smaller than k would cap the number of results
+    ef_search = max(ef_search or HNSW_EF_SEARCH, k)
+    query_vector = to_vector_literal(query_embedding)
+
+    if documents is None:
+        with stage("vector_search"):
+            rows = await ann_search(conn, None, query_vector, k, ef_search)
+    else:
+        if total is None:
+            total = await count_chunks(conn, documents)
+        if total == 0:
+            return []
+
+        with stage("vector_search"):
+            if total <= EXACT_SEARCH_THRESHOLD:
+                rows = await exact_search(conn, documents, query_vector, k)
+            else:
+                rows = await ann_search(conn, documents, query_vector, k, ef_search)
+                if len(rows) < min(k, total):
+                    rows = await exact_search(conn, documents, query_vector, k)
+
+    return [{
+        "id": row["id"],
+        "document_id": str(row["document_id"]),
+        "text": row["text"],
+        "order": row["order"],
+        "score": 1.0 - float(row["distance"]),
+    } for row in rows]
+
+
+class DocumentMatrix:
+    """
+    All embedded chunks of one document, laid out for vectorized scoring.
+
+    With halfvec precision the rows are kept as float16, half the memory of
+    float32. With binary precision only their sign bits are kept, packed 8
+    to a byte, and the matrix can only rank Hamming candidates for the
+    caller to re-score.
+    """
+
+    def __init__(self, ids: list, texts: list, orders: list, matrix: np.ndarray, precision: str = "float32"):
+        self.ids = ids
+        self.texts = texts
+        self.orders = orders
+        self.precision = precision
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.norms = np.linalg.norm(matrix, axis=1)
+        self.matrix = None
+        self.bits = None
+        if precision == "binary":
+            self.bits = np.packbits(matrix > 0, axis=1)
+        elif precision == "halfvec":
+            self.matrix = matrix.astype(np.float16)
+        else:
+            self.matrix = matrix
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        vectors = self.bits.nbytes if self.bits is not None else self.matrix.nbytes
+        return vectors + self.norms.nbytes + sum(len(t) for t in self.texts)
+
+    def _dot(self, query: np.ndarray) -> np.ndarray:
+        if self.matrix.dtype == np.float32:
+            return self.matrix @ query
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), SCORE_BLOCK_ROWS):
+            block = self.matrix[start:start + SCORE_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+    def hamming_candidates(self, query_embedding, n: int) -> np.ndarray:
+        """Row indices of the n rows whose sign bits differ least from the query's, closest first."""
+        query_bits = np.packbits(np.asarray(query_embedding, dtype=np.float32) > 0)
+        distances = POPCOUNT[np.bitwise_xor(self.bits, query_bits)].sum(axis=1)
+        n = min(n, len(self))
+        top = np.argpartition(distances, n - 1)[:n] if n < len(self) else np.arange(len(self))
+        return top[np.argsort(distances[top], kind="stable")]
+
+    def top_k(self, query_embedding, k: int) -> List[Dict[str, Any]]:
+        """Score every row with one matrix-vector product and return the k best."""
+        if len(self) == 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        denominators = self.norms * query_norm
+        scores = self._dot(query)
+        # Zero-norm rows (or a zero query) score 0 instead of dividing by zero
+        np.divide(scores, denominators, out=scores, where=denominators != 0)
+        scores[denominators == 0] = 0
+
+        k = min(k, len(self))
+        if k < len(self):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(self))
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return [{
+            "id": self.ids[i],
+            "text": self.texts[i],
+            "order": self.orders[i],
+            "score": float(scores[i]),
+        } for i in top]
+
+
+class MatrixCache:
+    """LRU cache of DocumentMatrix objects bounded by total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, DocumentMatrix]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, document_id: str, expected_rows: int | None = None) -> DocumentMatrix | None:
+        """
+        Return the cached matrix for a document, or None.
+
+        If expected_rows is given and doesn't match the cached row count the
+        document has changed since it was loaded, so the entry is dropped.
+        """
+        with self._lock:
+            entry = self._entries.get(document_id)
+            if entry is not None and expected_rows is not None and len(entry) != expected_rows:
+                self._remove(document_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(document_id)
+            self.hits += 1
+            return entry
+
+    def put(self, document_id: str, entry: DocumentMatrix):
+        with self._lock:
+            self._remove(document_id)
+            # A document bigger than the whole budget is scored but never cached
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[document_id] = entry
+            self.current_bytes += entry.nbytes
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, document_id: str):
+        with self._lock:
+            self._remove(document_id)
+
+    def _remove(self, document_id: str):
+        entry = self._entries.pop(document_id, None)
+        if entry is not None:
+            self.current_bytes -= entry.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "documents": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+matrix_cache = MatrixCache(MATRIX_CACHE_BYTES)
+
+
+async def load_document_matrix(conn, document_id: str, precision: str = VECTOR_PRECISION) -> DocumentMatrix:
+    """Fetch all embedded chunks of a document into a DocumentMatrix."""
+    # Binary results hand back each vector as its raw bytes, which decode_vectors turns into a
+    # matrix in one numpy call, instead of a list of Python floats per row
+    async with conn.cursor(binary=True) as cur:
+        await cur.execute("""
+            SELECT id, text, "order", embedding
+            FROM chunks
+            WHERE document_id = %s AND embedding IS NOT NULL
+            ORDER BY "order" ASC
+        """, (document_id,))
+        rows = await cur.fetchall()
+
+    if not rows:
+        return DocumentMatrix([], [], [], np.empty((0, 0), dtype=np.float32), precision)
+
+    ids, texts, orders, embeddings = zip(*rows)
+    # Norms and the halfvec / binary conversions still take a few ms per thousand rows
+    return await asyncio.to_thread(DocumentMatrix, list(ids), list(texts), list(orders),
+                                   decode_vectors(embeddings), precision)
+
+
+async def rescore(conn, entry: DocumentMatrix, candidates: np.ndarray, query_embedding,
+                  k: int) -> List[Dict[str, Any]]:
+    """Rank candidate rows of a matrix by exact cosine similarity against their stored vectors."""
+    positions = {entry.ids[i]: i for i in candidates}
+    async with conn.cursor() as cur:
+        await cur.execute("""
+            SELECT id, embedding <=> %s::vector AS distance
+            FROM chunks
+            WHERE id = ANY(%s)
+            ORDER BY distance ASC
+            LIMIT %s
+        """, (to_vector_literal(query_embedding), list(positions), k))
+        rows = await cur.fetchall()
+    return [{
+        "id": entry.ids[positions[chunk_id]],
+        "text": entry.texts[positions[chunk_id]],
+        "order": entry.orders[positions[chunk_id]],
+        "score": 1.0 - float(distance),
+    } for chunk_id, distance in rows]
+
+
+async def score_in_memory(conn, document_id: str, query_embedding, k: int | None = None,
+                    expected_rows: int | None = None) -> List[Dict[str, Any]]:
+    """
+    Exact top-k over a cached copy of the document's embeddings.
+
+    The matrix is loaded once per document and reused until the document's
+    chunk count changes or it is evicted. With binary precision the cached
+    sign bits only pick candidates, which Postgres re-scores on the full
+    vectors.
+    """
+    k = k or DEFAULT_TOP_K
+    entry = matrix_cache.get(document_id, expected_rows)
+    if entry is None:
+        with stage("fetch_chunks"):
+            entry = await load_document_matrix(conn, document_id)
+        if len(entry):
+            matrix_cache.put(document_id, entry)
+    if entry.bits is not None:
+        if len(entry) == 0:
+            return []
+        with stage("score"):
+            candidates = entry.hamming_candidates(query_embedding, max(k, BINARY_CANDIDATES))
+        with stage("rescore"):
+            return await rescore(conn, entry, candidates, query_embedding, k)
+    with stage("score"):
+        return entry.top_k(query_embedding, k)
+
+
+async def retrieve_chunks(conn, document_id: Documents, query_embedding, k: int | None = None,
+                    total: int | None = None) -> List[Dict[str, Any]]:
+    """
+    Top-k chunks for a query, scored in process or in pgvector per RETRIEVAL_MODE.
+
+    total is the document's current chunk count when the caller already has
+    it; it decides the auto mode and keeps the matrix cache fresh. Queries
+    over several documents or the whole corpus always go to pgvector.
+    """
+    if not isinstance(document_id, str):
+        return await search_chunks(conn, document_id, query_embedding, k, total=total)
+    if total is None:
+        total = await count_chunks(conn, document_id)
+    if total == 0:
+        matrix_cache.invalidate(document_id)
+        return []
+
+    use_memory = RETRIEVAL_MODE == "memory" or (
+        RETRIEVAL_MODE == "auto" and total <= EXACT_SEARCH_THRESHOLD
+    )
+    if use_memory:
+        return await score_in_memory(conn, document_id, query_embedding, k, expected_rows=total)
+    return await search_chunks(conn, document_id, query_embedding, k, total=total)
+
+
+def to_any_term_query(query: str) -> str:
+    """
+    Rewrite a question as websearch_to_tsquery input matching any of its terms.
+
+    Terms keep inner hyphens and dots, so part numbers like XJ-9000 become a
+    phrase; quotes and leading minus signs are dropped rather than treated
+    as operators.
+    """
+    return " or ".join(re.findall(r"\w+(?:[.-]\w+)*", query))
+
+
+async def lexical_search(conn, documents: Documents, query: str, k: int) -> List[Dict[str, Any]]:
+    """Rank the chunks of the given documents by full-text match through the chunks_search_idx GIN index."""
+    terms = to_any_term_query(query)
+    if not terms:
+        return []
+    where, params = chunk_filter(documents)
+    with stage("lexical_search"):
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(f"""
+                SELECT id, document_id, text, "order", ts_rank_cd(search_vector, query, 32) AS score
+                FROM chunks, websearch_to_tsquery(%s::regconfig, %s) AS query
+                WHERE {where} AND search_vector @@ query
+                ORDER BY score DESC
+                LIMIT %s
+            """, (FULLTEXT_CONFIG, terms, *params, k))
+            rows = await cur.fetchall()
+    return [{
+        "id": row["id"],
+        "document_id": str(row["document_id"]),
+        "text": row["text"],
+        "order": row["order"],
+        "score": float(row["score"]),
+    } for row in rows]
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, List[Dict[str, Any]]], k: int | None = None,
+                           rrf_k: int = HYBRID_RRF_K) -> List[Dict[str, Any]]:
+    """
+    Merge named rankings by summing 1 / (rrf_k + rank) over the rankings each chunk appears in.
+
+    Only ranks are used, so the legs' scores don't need to be comparable.
+    Each result carries its fused score and its 1-based rank in every leg
+    that returned it.
+    """
+    fused: Dict[Any, Dict[str, Any]] = {}
+    for name, ranking in rankings.items():
+        for rank, chunk in enumerate(ranking, start=1):
+            entry = fused.setdefault(chunk["id"], {
+                "id": chunk["id"], "document_id": chunk.get("document_id"), "text": chunk["text"],
+                "order": chunk["order"], "score": 0.0, "ranks": {}
+            })
+            entry["score"] += 1.0 / (rrf_k + rank)
+            entry["ranks"][name] = rank
+    ranked = sorted(fused.values(), key=lambda entry: entry["score"], reverse=True)
+    return ranked[:k or DEFAULT_TOP_K]
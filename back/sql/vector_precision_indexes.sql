@@ -0,0 +1,29 @@
+-- Opt-in indexes for VECTOR_PRECISION=halfvec or binary (see back/retrieval.py).
+--
+-- They are not part of the migrations: every index on chunks.embedding is
+-- maintained on every ingestion COPY, so deployments searching float32
+-- shouldn't pay for them. Run this once before switching VECTOR_PRECISION:
+--
+--     psql "$POSTGRES_URL" -f back/sql/vector_precision_indexes.sql
+--
+-- Needs the vector extension at version 0.7 or later (halfvec and
+-- binary_quantize); check with
+--
+--     SELECT extversion FROM pg_extension WHERE extname = 'vector';
+--
+-- and upgrade it first if needed (ALTER EXTENSION vector UPDATE, once the
+-- server has the newer pgvector installed). The indexes are built
+-- CONCURRENTLY, so ingestion and search keep running meanwhile; psql must
+-- not wrap the file in a transaction (no --single-transaction). Only the
+-- index for the precision in use is needed.
+--
+-- To go back to float32, drop them:
+--
+--     DROP INDEX CONCURRENTLY IF EXISTS "embedding_halfvec_idx";
+--     DROP INDEX CONCURRENTLY IF EXISTS "embedding_binary_idx";
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "embedding_halfvec_idx"
+    ON "chunks" USING hnsw (("embedding"::halfvec(1536)) halfvec_cosine_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "embedding_binary_idx"
+    ON "chunks" USING hnsw ((binary_quantize("embedding")::bit(1536)) bit_hamming_ops);
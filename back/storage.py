@@ -0,0 +1,113 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import BinaryIO
+
+from fastapi import HTTPException
+
+# Any S3-compatible endpoint works, e.g. a local MinIO or moto server for development
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', 'https://sgp1.digitaloceanspaces.com')
+
+SPACE_NAME = os.getenv('S3_BUCKET', 'thor')
+SPACE_FOLDER = 'documents'
+
+# Base of the public URL of uploaded files
+SPACE_PUBLIC_URL = os.getenv('S3_PUBLIC_URL', f"https://{SPACE_NAME}.sgp1.digitaloceanspaces.com")
+
+# Files larger than one part go up as a multipart upload, this many parts at a time
+S3_PART_SIZE = int(os.getenv('S3_PART_SIZE_MB', '8')) * 1024 * 1024
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', '4'))
+
+# Block size for hashing and copying file objects
+READ_BLOCK_SIZE = 1024 * 1024
+
+_s3 = None
+_s3_lock = threading.Lock()
+
+
+def get_s3():
+    """S3 client for Digital Ocean Spaces. boto3 is imported and the client built on first use."""
+    global _s3
+    with _s3_lock:
+        if _s3 is None:
+            import boto3
+
+            _s3 = boto3.client('s3',
+                endpoint_url=S3_ENDPOINT_URL,
+                aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
+                aws_secret_access_key=os.getenv('S3_SECRET_KEY')
+            )
+        return _s3
+
+
+def content_hash(fileobj: BinaryIO) -> str:
+    """SHA-256 of a file's bytes, used as its storage key. Reads in blocks and rewinds the file."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    while block := fileobj.read(READ_BLOCK_SIZE):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def upload_to_spaces(fileobj: BinaryIO, filename: str, sha256: str | None = None) -> tuple[str, str]:
+    """
+    Upload file to Digital Ocean Spaces and return its URL and object key.
+
+    The file is read in parts and sent as a parallel multipart upload, so
+    it is never held in memory whole. Files are stored under the SHA-256 of
+    their content, so uploading the same bytes twice writes to the same
+    object instead of adding a copy.
+    """
+    file_extension = os.path.splitext(filename)[1].lower()
+    new_filename = f"{sha256 or content_hash(fileobj)}{file_extension}"
+    
+    # If using a folder structure
+    key = f"{SPACE_FOLDER}/{new_filename}" if SPACE_FOLDER else new_filename
+    
+    try:
+        from boto3.s3.transfer import TransferConfig
+
+        fileobj.seek(0)
+        get_s3().upload_fileobj(
+            fileobj,
+            SPACE_NAME,
+            key,
+            ExtraArgs={'ACL': 'public-read'},
+            Config=TransferConfig(
+                multipart_threshold=S3_PART_SIZE,
+                multipart_chunksize=S3_PART_SIZE,
+                max_concurrency=S3_TRANSFER_CONCURRENCY,
+            )
+        )
+        
+        return f"{SPACE_PUBLIC_URL}/{key}", key
+    except Exception as e:
+        print(f"Error uploading to Spaces: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to upload file to storage")
+
+
+def download_from_spaces(key: str) -> bytes:
+    """Fetch an uploaded file back from Digital Ocean Spaces."""
+    response = get_s3().get_object(Bucket=SPACE_NAME, Key=key)
+    return response['Body'].read()
+
+
+def is_missing_object(error: Exception) -> bool:
+    """Whether an error from S3 means the object doesn't exist, as opposed to an outage or denied access."""
+    from botocore.exceptions import ClientError
+
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+
+def download_to_file(key: str, path: str):
+    """Stream an uploaded file from Spaces to a local path without holding it in memory."""
+    response = get_s3().get_object(Bucket=SPACE_NAME, Key=key)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(response['Body'], f, READ_BLOCK_SIZE)
+
+
+def put_to_spaces(key: str, content: bytes):
+    """Store a private object (e.g. a derived index file) under a fixed key."""
+    get_s3().put_object(Bucket=SPACE_NAME, Key=key, Body=content)
@@ -0,0 +1,69 @@
+"""
+Shared setup for the backend tests.
+
+    cd back && pip install -r requirements-dev.txt && python -m pytest
+
+OpenAI, Voyage and Spaces are never called: tests pass stubs in place of
+the clients. Tokenizer and sentence splitter data isn't downloaded either;
+the fixtures below swap in versions that need none. Tests that need Postgres (with pgvector and the app schema
+from web/migrations) run against POSTGRES_URL and are skipped without it.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# main refuses to import without these; no test reaches the real APIs
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("VOYAGE_API_KEY", "test")
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a fresh event loop, closing the connection pool it opened."""
+    from db import close_pool
+
+    def run(coroutine):
+        async def wrapped():
+            try:
+                return await coroutine
+            finally:
+                await close_pool()
+
+        return asyncio.run(wrapped())
+
+    return run
+
+
+@pytest.fixture
+def byte_tokenizer(monkeypatch):
+    """One token per UTF-8 byte, in place of the embedding and chat model tokenizers."""
+    import tiktoken
+
+    import context
+    import embeddings
+
+    tokenizer = tiktoken.Encoding(
+        name="bytes",
+        pat_str=r"""\S+|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+    monkeypatch.setattr(embeddings, "_tokenizer", tokenizer)
+    monkeypatch.setattr(context, "_tokenizer", tokenizer)
+    return tokenizer
+
+
+@pytest.fixture
+def sentence_tokenizer(monkeypatch):
+    """Punkt without trained parameters: splits after ".", "?" and "!" followed by whitespace."""
+    from nltk.tokenize.punkt import PunktSentenceTokenizer
+
+    import chunker
+
+    tokenizer = PunktSentenceTokenizer()
+    monkeypatch.setattr(chunker, "_punkt", tokenizer)
+    return tokenizer
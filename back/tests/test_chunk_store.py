@@ -0,0 +1,71 @@
+import struct
+import uuid
+
+import numpy as np
+
+from chunk_store import PGCOPY_HEADER, PGCOPY_TRAILER, _encode_vector, decode_vectors, encode_copy_binary, make_chunk_rows
+from chunker import Chunk
+
+
+def read_copy_stream(data: bytes):
+    """Parse a binary COPY stream back into rows of raw field bytes (None for NULL)."""
+    assert data.startswith(PGCOPY_HEADER)
+    assert data.endswith(PGCOPY_TRAILER)
+    position = len(PGCOPY_HEADER)
+    rows = []
+    while True:
+        (fields,) = struct.unpack_from("!h", data, position)
+        position += 2
+        if fields == -1:
+            break
+        row = []
+        for _ in range(fields):
+            (length,) = struct.unpack_from("!i", data, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+            else:
+                row.append(data[position:position + length])
+                position += length
+        rows.append(row)
+    assert position == len(data)
+    return rows
+
+
+def test_copy_stream_round_trips_chunk_rows():
+    document_id = str(uuid.uuid4())
+    chunks = [Chunk("Première phrase.", 0, 16, 1, 1, 5), "bare text"]
+    embeddings = [[0.5, -1.25, 3.0], [1.0, 2.0, 4.0]]
+    rows = make_chunk_rows(document_id, chunks, embeddings, start=7)
+
+    decoded = read_copy_stream(encode_copy_binary(rows))
+    assert len(decoded) == 2
+    for row, fields in zip(rows, decoded):
+        chunk_id, row_document_id, text, embedding, order, *positions = row
+        assert len(fields) == 10
+        assert uuid.UUID(bytes=fields[0]) == uuid.UUID(chunk_id)
+        assert uuid.UUID(bytes=fields[1]) == uuid.UUID(document_id)
+        assert fields[2].decode("utf-8") == text
+        dimensions, unused = struct.unpack_from("!hh", fields[3])
+        assert (dimensions, unused) == (3, 0)
+        assert np.frombuffer(fields[3][4:], dtype=">f4").tolist() == embedding
+        assert struct.unpack("!i", fields[4])[0] == order
+        assert [None if value is None else struct.unpack("!i", value)[0] for value in fields[5:]] == positions
+
+    assert [row[4] for row in rows] == [7, 8]
+    assert decoded[0][5:] == [struct.pack("!i", value) for value in (0, 16, 1, 1, 5)]
+    assert decoded[1][5:] == [None] * 5
+
+
+def test_empty_copy_stream():
+    assert read_copy_stream(encode_copy_binary([])) == []
+
+
+def test_decode_vectors_reads_binary_pgvector_values():
+    vectors = [[0.25, -2.0, 8.5, 0.0], [1.0, 1.5, -0.5, 3.25]]
+    # A binary pgvector value is the encoded field without its length prefix
+    values = [_encode_vector(vector)[4:] for vector in vectors]
+    matrix = decode_vectors(values)
+    assert matrix.dtype == np.float32
+    assert matrix.tolist() == vectors
+    assert decode_vectors([]).shape == (0, 0)
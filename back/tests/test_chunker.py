@@ -0,0 +1,55 @@
+import pytest
+
+from chunker import StreamingChunker, chunk_text
+
+pytestmark = pytest.mark.usefixtures("byte_tokenizer", "sentence_tokenizer")
+
+SENTENCES = [f"Sentence number {i} talks about topic {i * 7}." for i in range(40)]
+TEXT = "  " + " ".join(SENTENCES[:20]) + "\n\n" + " ".join(SENTENCES[20:])
+
+
+def assert_offsets_match(chunks, text):
+    for chunk in chunks:
+        assert chunk.text == text[chunk.start:chunk.end]
+        assert chunk.tokens == len(chunk.text.encode("utf-8"))
+
+
+def test_chunk_text_is_the_text_between_offsets():
+    chunks = chunk_text(TEXT, max_tokens=120, overlap_tokens=0)
+    assert len(chunks) > 1
+    assert_offsets_match(chunks, TEXT)
+    assert all(chunk.tokens <= 120 for chunk in chunks)
+    # Without overlap the chunks cover every sentence once, in order
+    assert " ".join(chunk.text for chunk in chunks).split() == TEXT.split()
+
+
+def test_overlap_repeats_trailing_sentences():
+    chunks = chunk_text(TEXT, max_tokens=120, overlap_tokens=50)
+    assert_offsets_match(chunks, TEXT)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.start < previous.end
+        assert previous.text.endswith(TEXT[chunk.start:previous.end])
+
+
+def test_long_sentence_is_cut_on_token_boundaries():
+    text = "Short one. " + "x" * 250 + " tail. Another short one."
+    chunks = chunk_text(text, max_tokens=100, overlap_tokens=0)
+    assert_offsets_match(chunks, text)
+    assert all(chunk.tokens <= 100 for chunk in chunks)
+    assert "".join(chunk.text for chunk in chunks[1:-1]) == "x" * 250 + " tail."
+
+
+def test_streaming_matches_whole_text_and_tracks_pages():
+    pages = [TEXT[:300], TEXT[300:310], TEXT[310:]]
+    chunker = StreamingChunker(max_tokens=120, overlap_tokens=50)
+    chunks = []
+    for page, piece in enumerate(pages, start=1):
+        chunks.extend(chunker.feed(piece, page))
+    chunks.extend(chunker.finish())
+
+    whole = chunk_text(TEXT, max_tokens=120, overlap_tokens=50)
+    assert [(chunk.start, chunk.end) for chunk in chunks] == [(chunk.start, chunk.end) for chunk in whole]
+    assert_offsets_match(chunks, TEXT)
+    for chunk in chunks:
+        assert chunk.page_start == (1 if chunk.start < 300 else 2 if chunk.start < 310 else 3)
+        assert chunk.page_end == (1 if chunk.end <= 300 else 2 if chunk.end <= 310 else 3)
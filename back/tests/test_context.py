@@ -0,0 +1,54 @@
+import pytest
+
+from context import PASSAGE_SEPARATOR, build_context
+
+pytestmark = pytest.mark.usefixtures("byte_tokenizer")
+
+
+def chunk(text, order=None, document="doc"):
+    return {"text": text, "order": order, "document": document}
+
+
+def test_context_stays_within_budget_and_skips_chunks_that_overflow():
+    chunks = [chunk("a" * 40, 0), chunk("b" * 80, 5), chunk("c" * 30, 9)]
+    context = build_context(chunks, max_tokens=75)
+    # The second chunk doesn't fit; the smaller third one still does
+    assert [passage.text for passage in context.passages] == ["a" * 40, "c" * 30]
+    assert context.text == "a" * 40 + PASSAGE_SEPARATOR + "c" * 30
+    assert context.tokens == len(context.text) <= 75
+
+
+def test_near_duplicates_of_better_ranked_chunks_are_dropped():
+    original = "the quick brown fox jumps over the lazy dog near the river bank"
+    chunks = [chunk(original, 0), chunk(original + " today", 8), chunk("an unrelated passage about tides", 20)]
+    context = build_context(chunks, max_tokens=1000)
+    assert [passage.text for passage in context.passages] == [original, "an unrelated passage about tides"]
+
+
+def test_adjacent_chunks_merge_with_their_overlap_kept_once():
+    chunks = [
+        chunk("Third part. Shared tail.", 2),
+        chunk("First part. Second part.", 0),
+        chunk("Second part. Third part.", 1),
+        chunk("Elsewhere entirely.", 1, document="other"),
+    ]
+    context = build_context(chunks, max_tokens=1000)
+    assert [passage.text for passage in context.passages] == [
+        "First part. Second part. Third part. Shared tail.",
+        "Elsewhere entirely.",
+    ]
+    assert context.passages[0].rank == 0
+
+
+def test_passages_are_ordered_by_best_rank():
+    chunks = [chunk("alpha beta gamma", 3), chunk("delta epsilon zeta", 10), chunk("eta theta iota", 4)]
+    context = build_context(chunks, max_tokens=1000)
+    # The third chunk joins the first passage, which keeps rank 0
+    assert [passage.text for passage in context.passages] == ["alpha beta gamma eta theta iota", "delta epsilon zeta"]
+
+
+def test_best_chunk_is_truncated_when_nothing_fits():
+    context = build_context([chunk("z" * 500), chunk("y" * 400)], max_tokens=100)
+    assert context.text == "z" * 100
+    assert context.tokens == 100
+    assert build_context([], max_tokens=100).passages == []
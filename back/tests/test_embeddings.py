@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from embeddings import EmbeddingBatcher
+
+
+class Transient(Exception):
+    pass
+
+
+def fake_embedding(text):
+    return [float(len(text)), float(sum(map(ord, text)))]
+
+
+def make_batcher(embed_fn, **options):
+    options = {"max_batch_items": 3, "first_batch_items": 2, "max_concurrency": 2, "retryable_errors": (Transient,),
+               "backoff_base": 0.0, "count_tokens": len, **options}
+    return EmbeddingBatcher(embed_fn, **options)
+
+
+def test_embeddings_come_back_in_input_order():
+    texts = [f"text {i}" * (i % 4 + 1) for i in range(20)]
+    batches = []
+
+    async def embed(batch):
+        batches.append(batch)
+        # Later batches finish first
+        await asyncio.sleep(0.01 * (5 - len(batches) % 5))
+        return [fake_embedding(text) for text in batch]
+
+    embeddings = asyncio.run(make_batcher(embed).embed(texts))
+    assert embeddings == [fake_embedding(text) for text in texts]
+    assert [len(batch) for batch in batches] == [2, 3, 3, 3, 3, 3, 3]
+
+
+def test_batches_respect_token_budget():
+    batches = []
+
+    def embed(batch):
+        batches.append(batch)
+        return [fake_embedding(text) for text in batch]
+
+    texts = ["aaaa", "bbbb", "cc", "d" * 20, "ee"]
+    embeddings = asyncio.run(make_batcher(embed, max_batch_tokens=8, first_batch_items=3).embed(texts))
+    assert embeddings == [fake_embedding(text) for text in texts]
+    # A text over the budget is sent on its own
+    assert batches == [["aaaa", "bbbb"], ["cc"], ["d" * 20], ["ee"]]
+
+
+def test_concurrent_batches_are_capped():
+    running = 0
+    peak = 0
+
+    async def embed(batch):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return [fake_embedding(text) for text in batch]
+
+    asyncio.run(make_batcher(embed, max_concurrency=3).embed([str(i) for i in range(40)]))
+    assert peak == 3
+
+
+def test_stream_pulls_input_only_while_a_slot_is_free():
+    pulled = 0
+    backlog = []
+
+    async def texts():
+        nonlocal pulled
+        for i in range(30):
+            pulled += 1
+            yield str(i)
+
+    async def embed(batch):
+        await asyncio.sleep(0.01)
+        return [fake_embedding(text) for text in batch]
+
+    async def consume():
+        async for start, batch, _ in make_batcher(embed).iter_stream(texts()):
+            backlog.append(pulled - start - len(batch))
+
+    asyncio.run(consume())
+    # At most the batch still in flight and the one being filled have been read ahead
+    assert max(backlog) <= 2 * 3
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def embed(batch):
+        calls.append(batch)
+        if len(calls) < 3:
+            raise Transient()
+        return [fake_embedding(text) for text in batch]
+
+    assert asyncio.run(make_batcher(embed).embed(["a", "b"])) == [fake_embedding("a"), fake_embedding("b")]
+    assert len(calls) == 3
+
+
+def test_retries_give_up_after_max_retries():
+    calls = 0
+
+    def embed(batch):
+        nonlocal calls
+        calls += 1
+        raise Transient()
+
+    with pytest.raises(Transient):
+        asyncio.run(make_batcher(embed, max_retries=2).embed(["a"]))
+    assert calls == 3
+
+
+def test_other_errors_are_not_retried():
+    calls = 0
+
+    def embed(batch):
+        nonlocal calls
+        calls += 1
+        raise KeyError("bad input")
+
+    with pytest.raises(KeyError):
+        asyncio.run(make_batcher(embed).embed(["a"]))
+    assert calls == 1
+
+
+def test_short_response_is_an_error():
+    def embed(batch):
+        return [fake_embedding(batch[0])]
+
+    with pytest.raises(ValueError):
+        asyncio.run(make_batcher(embed, retryable_errors=(ValueError,), max_retries=0).embed(["a", "b"]))
@@ -0,0 +1,27 @@
+import asyncio
+
+import main
+
+
+def test_search_each_document_merges_by_score_and_reports_unindexed():
+    rankings = {
+        "a": [{"id": "a1", "score": 0.9}, {"id": "a2", "score": 0.4}],
+        "b": None,
+        "c": [{"id": "c1", "score": 0.7}],
+    }
+
+    async def search(document_id):
+        return rankings[document_id]
+
+    ranked, unindexed = asyncio.run(main.search_each_document(search, ["a", "b", "c"], k=2))
+    assert [(hit["id"], hit["document_id"]) for hit in ranked] == [("a1", "a"), ("c1", "c")]
+    assert unindexed == ["b"]
+
+
+def test_search_each_document_falls_back_when_nothing_is_indexed():
+    async def search(document_id):
+        return None
+
+    ranked, unindexed = asyncio.run(main.search_each_document(search, ["a", "b"], k=5))
+    assert ranked is None
+    assert unindexed == ["a", "b"]
@@ -0,0 +1,37 @@
+import pytest
+
+from retrieval import reciprocal_rank_fusion
+
+
+def chunk(chunk_id, order=0):
+    return {"id": chunk_id, "document_id": "doc", "text": f"text of {chunk_id}", "order": order, "score": 0.0}
+
+
+def test_rrf_sums_reciprocal_ranks_across_legs():
+    fused = reciprocal_rank_fusion({
+        "vector": [chunk("a"), chunk("b"), chunk("c")],
+        "lexical": [chunk("c"), chunk("d")],
+    }, k=4, rrf_k=60)
+
+    scores = {entry["id"]: entry["score"] for entry in fused}
+    assert scores["a"] == pytest.approx(1 / 61)
+    assert scores["c"] == pytest.approx(1 / 63 + 1 / 61)
+    assert scores["d"] == pytest.approx(1 / 62)
+    assert [entry["id"] for entry in fused] == ["c", "a", "b", "d"]
+    assert fused[0]["ranks"] == {"vector": 3, "lexical": 1}
+    assert fused[1]["ranks"] == {"vector": 1}
+
+
+def test_rrf_ignores_leg_scores_and_keeps_chunk_fields():
+    high = dict(chunk("x", order=4), score=100.0)
+    fused = reciprocal_rank_fusion({"vector": [chunk("y")], "lexical": [high]}, k=2)
+    assert {entry["id"] for entry in fused} == {"x", "y"}
+    assert fused[0]["score"] == fused[1]["score"]
+    x = next(entry for entry in fused if entry["id"] == "x")
+    assert (x["document_id"], x["text"], x["order"]) == ("doc", "text of x", 4)
+
+
+def test_rrf_truncates_to_k():
+    fused = reciprocal_rank_fusion({"vector": [chunk(str(i)) for i in range(10)]}, k=3)
+    assert [entry["id"] for entry in fused] == ["0", "1", "2"]
+    assert reciprocal_rank_fusion({}, k=3) == []
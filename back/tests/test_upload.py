@@ -0,0 +1,73 @@
+import os
+import uuid
+
+import httpx
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(not os.getenv("POSTGRES_URL"), reason="needs POSTGRES_URL")
+
+
+@pytest.fixture
+def uploads(monkeypatch, run):
+    """Upload files through the app with Spaces stubbed out; the documents are deleted afterwards."""
+    monkeypatch.setattr(main, "upload_to_spaces",
+                        lambda fileobj, filename, sha256: (f"https://spaces.test/{sha256}", f"documents/{sha256}"))
+    created = []
+
+    async def upload(content: bytes, collection: str | None = None):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/upload", files={"file": ("notes.md", content)},
+                                         data={"collection": collection} if collection else {})
+        if response.status_code == 200:
+            created.append(response.json()["document_id"])
+        return response
+
+    yield upload
+
+    async def cleanup():
+        async with main.get_db() as conn:
+            await conn.execute("DELETE FROM documents WHERE id = ANY(%s::uuid[])", (created,))
+
+    run(cleanup())
+
+
+async def collection_of(document_id):
+    async with main.get_db() as conn:
+        cursor = await conn.execute("SELECT collection FROM documents WHERE id = %s", (document_id,))
+        return (await cursor.fetchone())[0]
+
+
+def test_duplicate_upload_joins_requested_collection(uploads, run):
+    content = f"A file uploaded twice {uuid.uuid4()}".encode()
+
+    async def scenario():
+        first = (await uploads(content)).json()
+        second = await uploads(content, collection="manuals")
+        return first, second, await collection_of(first["document_id"])
+
+    first, second, collection = run(scenario())
+    assert second.status_code == 200
+    assert second.json()["duplicate"] is True
+    assert second.json()["document_id"] == first["document_id"]
+    assert second.json()["collection"] == "manuals"
+    assert collection == "manuals"
+
+
+def test_duplicate_upload_into_other_collection_is_rejected(uploads, run):
+    content = f"A file uploaded into two collections {uuid.uuid4()}".encode()
+
+    async def scenario():
+        first = (await uploads(content, collection="manuals")).json()
+        second = await uploads(content, collection="invoices")
+        same = await uploads(content, collection="manuals")
+        return first, second, same, await collection_of(first["document_id"])
+
+    first, second, same, collection = run(scenario())
+    assert second.status_code == 409
+    assert first["document_id"] in second.json()["detail"]
+    assert collection == "manuals"
+    assert same.status_code == 200
+    assert same.json()["document_id"] == first["document_id"]
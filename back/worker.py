@@ -0,0 +1,46 @@
+"""
+Standalone ingestion worker.
+
+    python worker.py
+
+Run as many of these as needed, on any node that can reach Postgres and
+Spaces; they share the ingestion_jobs queue. Set METRICS_PORT to serve
+the worker's Prometheus metrics.
+"""
+import asyncio
+import os
+import signal
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+load_dotenv()
+
+# Port of the worker's /metrics endpoint; unset to not serve metrics
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+from db import get_pool, close_pool  # noqa: E402
+from jobs import run_worker  # noqa: E402
+from page_retrieval import shutdown_executor  # noqa: E402
+from ingest import shutdown_extract_executor  # noqa: E402
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+    await get_pool()
+    try:
+        await run_worker(stop=stop)
+    finally:
+        await close_pool()
+        shutdown_executor()
+        shutdown_extract_executor()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,7 +5,7 @@ import { Button } from "@/components/ui/button";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
 import { useState } from "react";
 
-type Method = "embedding" | "rerank" | "colpali" | "colbert";
+type Method = "embedding" | "rerank" | "hybrid" | "colpali" | "colbert";
 
 interface ClientProps {
   document: {
@@ -37,7 +37,7 @@ export function Client({ document }: ClientProps) {
       <Card>
         <CardHeader>
           <CardTitle className="mb-4">Select Chat Method</CardTitle>
-          <div className="grid grid-cols-2 sm:grid-cols-4 gap-2">
+          <div className="grid grid-cols-2 sm:grid-cols-5 gap-2">
             <Button 
               variant={selectedMethod === "embedding" ? "default" : "outline"}
               onClick={() => setSelectedMethod("embedding")}
@@ -52,6 +52,13 @@ export function Client({ document }: ClientProps) {
             >
               Rerank
             </Button>
+            <Button 
+              variant={selectedMethod === "hybrid" ? "default" : "outline"}
+              onClick={() => setSelectedMethod("hybrid")}
+              className="w-full"
+            >
+              Hybrid
+            </Button>
             <Button 
               variant={selectedMethod === "colpali" ? "default" : "outline"}
               onClick={() => setSelectedMethod("colpali")}
@@ -11,14 +11,14 @@ export async function POST(
   const { method } = await params
   
   try {
-    const { message, documentId } = await request.json()
+    const { message, documentId, stream } = await request.json()
     
     const response = await fetch(`${BACKEND_URL}/chat/${method}`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ message, documentId }),
+      body: JSON.stringify({ message, documentId, stream: Boolean(stream) }),
     })
 
     if (!response.ok) {
@@ -35,6 +35,16 @@ export async function POST(
       )
     }
 
+    // Pass server-sent events straight through instead of buffering them
+    if (stream) {
+      return new Response(response.body, {
+        headers: {
+          'Content-Type': 'text/event-stream',
+          'Cache-Control': 'no-cache',
+        },
+      })
+    }
+
     const data = await response.json()
     return NextResponse.json(data)
   } catch (error) {
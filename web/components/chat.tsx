@@ -31,7 +31,7 @@ type Message = {
 
 interface ChatProps {
   documentId: string;
-  method: "embedding" | "rerank" | "colpali" | "colbert";
+  method: "embedding" | "rerank" | "hybrid" | "colpali" | "colbert";
 }
 
 export function Chat({ documentId, method }: ChatProps) {
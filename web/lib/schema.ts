@@ -1,15 +1,27 @@
-import { pgTable, text, uuid, timestamp, index, vector, integer } from "drizzle-orm/pg-core";
+import { pgTable, text, uuid, timestamp, index, uniqueIndex, primaryKey, vector, integer, jsonb, customType } from "drizzle-orm/pg-core";
 import { sql } from "drizzle-orm";
 import { db } from "./db";
 
+const tsvector = customType<{ data: string }>({
+  dataType() {
+    return "tsvector";
+  },
+});
+
 export const documents = pgTable("documents", {
   id: uuid("id").primaryKey().defaultRandom(),
   url: text("url").notNull(),
   title: text("title").notNull(),
   status: text("status").notNull().default('pending'),
+  // Optional group of documents that chat requests can search together
+  collection: text("collection"),
   createdAt: timestamp("created_at").defaultNow().notNull(),
+  // SHA-256 of the uploaded bytes; re-uploading the same file returns the existing document
+  contentHash: text("content_hash"),
 }, (table) => [
     index("url_idx").on(table.url),
+    index("documents_collection_idx").on(table.collection, table.createdAt),
+    uniqueIndex("documents_content_hash_idx").on(table.contentHash),
 ]);
 
 export const chunks = pgTable("chunks", {
@@ -19,9 +31,71 @@ export const chunks = pgTable("chunks", {
   embedding: vector('embedding', { dimensions: 1536 }),
   order: integer("order").notNull(),
   createdAt: timestamp("created_at").defaultNow().notNull(),
+  // Character range of the chunk in the extracted document text, and the pages it spans
+  startOffset: integer("start_offset"),
+  endOffset: integer("end_offset"),
+  pageStart: integer("page_start"),
+  pageEnd: integer("page_end"),
+  tokenCount: integer("token_count"),
+  // Full-text index over the chunk text for the backend's hybrid search
+  searchVector: tsvector("search_vector").generatedAlwaysAs(sql`to_tsvector('english', "text")`),
 }, (table) => [
     index("document_idx").on(table.documentId),
+    // One row per chunk position, so a resumed or duplicated ingestion job cannot insert a chunk twice
+    uniqueIndex("chunks_document_order_idx").on(table.documentId, table.order),
     index('embeddingIndex').using('hnsw', table.embedding.op('vector_cosine_ops')),
+    // The compact halfvec and binary indexes searched when VECTOR_PRECISION is halfvec or binary are opt-in,
+    // created by back/sql/vector_precision_indexes.sql rather than migrated
+    index("chunks_search_idx").using("gin", table.searchVector),
+]);
+
+export const ingestionJobs = pgTable("ingestion_jobs", {
+  id: uuid("id").primaryKey().defaultRandom(),
+  documentId: uuid("document_id").notNull().references(() => documents.id, { onDelete: 'cascade' }),
+  fileKey: text("file_key").notNull(),
+  filename: text("filename").notNull(),
+  status: text("status").notNull().default('pending'),
+  attempts: integer("attempts").notNull().default(0),
+  maxAttempts: integer("max_attempts").notNull().default(3),
+  chunksTotal: integer("chunks_total"),
+  chunksDone: integer("chunks_done").notNull().default(0),
+  // Progress of the current attempt, reported by the backend's /status endpoints
+  phase: text("phase").notNull().default('queued'),
+  pagesTotal: integer("pages_total"),
+  pagesDone: integer("pages_done").notNull().default(0),
+  chunksEmbedded: integer("chunks_embedded").notNull().default(0),
+  // chunks_done when the current attempt started, so its rate isn't inflated by earlier attempts
+  resumedFrom: integer("resumed_from").notNull().default(0),
+  startedAt: timestamp("started_at"),
+  lastError: text("last_error"),
+  lockedBy: text("locked_by"),
+  lockedAt: timestamp("locked_at"),
+  runAfter: timestamp("run_after").defaultNow().notNull(),
+  createdAt: timestamp("created_at").defaultNow().notNull(),
+  updatedAt: timestamp("updated_at").defaultNow().notNull(),
+}, (table) => [
+    index("ingestion_jobs_status_idx").on(table.status, table.runAfter),
+    index("ingestion_jobs_document_idx").on(table.documentId),
+]);
+
+// Embeddings of chunk texts by SHA-256 of the text, reused when the same text is ingested again
+export const chunkEmbeddings = pgTable("chunk_embeddings", {
+  textHash: text("text_hash").notNull(),
+  model: text("model").notNull(),
+  embedding: vector('embedding', { dimensions: 1536 }).notNull(),
+  createdAt: timestamp("created_at").defaultNow().notNull(),
+}, (table) => [
+    primaryKey({ columns: [table.textHash, table.model] }),
+]);
+
+// Shared backing store for the backend's query embedding and answer caches
+export const cacheEntries = pgTable("cache_entries", {
+  key: text("key").primaryKey(),
+  value: jsonb("value").notNull(),
+  // With time zone, so the backend's epoch seconds round-trip whatever the session's TimeZone
+  expiresAt: timestamp("expires_at", { withTimezone: true }).notNull(),
+}, (table) => [
+    index("cache_entries_expires_idx").on(table.expiresAt),
 ]);
 
 export type Document = typeof documents.$inferSelect;
@@ -30,6 +104,9 @@ export type NewDocument = typeof documents.$inferInsert;
 export type Chunk = typeof chunks.$inferSelect;
 export type NewChunk = typeof chunks.$inferInsert;
 
+export type IngestionJob = typeof ingestionJobs.$inferSelect;
+export type NewIngestionJob = typeof ingestionJobs.$inferInsert;
+
 export async function getTotalDocuments(): Promise<number> {
   try {
     const result = await db.select({ count: sql`count(*)` }).from(documents);
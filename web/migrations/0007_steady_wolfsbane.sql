@@ -0,0 +1,23 @@
+CREATE TABLE "ingestion_jobs" (
+	"id" uuid PRIMARY KEY DEFAULT gen_random_uuid() NOT NULL,
+	"document_id" uuid NOT NULL,
+	"file_key" text NOT NULL,
+	"filename" text NOT NULL,
+	"status" text DEFAULT 'pending' NOT NULL,
+	"attempts" integer DEFAULT 0 NOT NULL,
+	"max_attempts" integer DEFAULT 3 NOT NULL,
+	"chunks_total" integer,
+	"chunks_done" integer DEFAULT 0 NOT NULL,
+	"last_error" text,
+	"locked_by" text,
+	"locked_at" timestamp,
+	"run_after" timestamp DEFAULT now() NOT NULL,
+	"created_at" timestamp DEFAULT now() NOT NULL,
+	"updated_at" timestamp DEFAULT now() NOT NULL
+);
+--> statement-breakpoint
+ALTER TABLE "ingestion_jobs" ADD CONSTRAINT "ingestion_jobs_document_id_documents_id_fk" FOREIGN KEY ("document_id") REFERENCES "public"."documents"("id") ON DELETE cascade ON UPDATE no action;--> statement-breakpoint
+CREATE INDEX "ingestion_jobs_status_idx" ON "ingestion_jobs" USING btree ("status","run_after");--> statement-breakpoint
+CREATE INDEX "ingestion_jobs_document_idx" ON "ingestion_jobs" USING btree ("document_id");--> statement-breakpoint
+-- Documents ingested before status was persisted still carry the column default
+UPDATE "documents" SET "status" = 'completed' WHERE "status" = 'pending' AND EXISTS (SELECT 1 FROM "chunks" WHERE "chunks"."document_id" = "documents"."id");
\ No newline at end of file
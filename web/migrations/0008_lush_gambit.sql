@@ -0,0 +1,7 @@
+CREATE TABLE "cache_entries" (
+	"key" text PRIMARY KEY NOT NULL,
+	"value" jsonb NOT NULL,
+	"expires_at" timestamp NOT NULL
+);
+--> statement-breakpoint
+CREATE INDEX "cache_entries_expires_idx" ON "cache_entries" USING btree ("expires_at");
\ No newline at end of file
@@ -0,0 +1,2 @@
+ALTER TABLE "chunks" ADD COLUMN "search_vector" tsvector GENERATED ALWAYS AS (to_tsvector('english', "text")) STORED;--> statement-breakpoint
+CREATE INDEX "chunks_search_idx" ON "chunks" USING gin ("search_vector");
\ No newline at end of file
@@ -0,0 +1,5 @@
+ALTER TABLE "chunks" ADD COLUMN "start_offset" integer;--> statement-breakpoint
+ALTER TABLE "chunks" ADD COLUMN "end_offset" integer;--> statement-breakpoint
+ALTER TABLE "chunks" ADD COLUMN "page_start" integer;--> statement-breakpoint
+ALTER TABLE "chunks" ADD COLUMN "page_end" integer;--> statement-breakpoint
+ALTER TABLE "chunks" ADD COLUMN "token_count" integer;
\ No newline at end of file
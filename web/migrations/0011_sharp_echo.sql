@@ -0,0 +1,15 @@
+CREATE TABLE "chunk_embeddings" (
+	"text_hash" text NOT NULL,
+	"model" text NOT NULL,
+	"embedding" vector(1536) NOT NULL,
+	"created_at" timestamp DEFAULT now() NOT NULL,
+	CONSTRAINT "chunk_embeddings_text_hash_model_pk" PRIMARY KEY("text_hash","model")
+);
+--> statement-breakpoint
+ALTER TABLE "documents" ADD COLUMN "content_hash" text;--> statement-breakpoint
+CREATE UNIQUE INDEX "documents_content_hash_idx" ON "documents" USING btree ("content_hash");--> statement-breakpoint
+INSERT INTO "chunk_embeddings" ("text_hash", "model", "embedding")
+SELECT DISTINCT ON (1) encode(sha256(convert_to("text", 'UTF8')), 'hex'), 'text-embedding-ada-002', "embedding"
+FROM "chunks"
+WHERE "embedding" IS NOT NULL
+ON CONFLICT DO NOTHING;
\ No newline at end of file
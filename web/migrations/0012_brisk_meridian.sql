@@ -0,0 +1,6 @@
+ALTER TABLE "ingestion_jobs" ADD COLUMN "phase" text DEFAULT 'queued' NOT NULL;--> statement-breakpoint
+ALTER TABLE "ingestion_jobs" ADD COLUMN "pages_total" integer;--> statement-breakpoint
+ALTER TABLE "ingestion_jobs" ADD COLUMN "pages_done" integer DEFAULT 0 NOT NULL;--> statement-breakpoint
+ALTER TABLE "ingestion_jobs" ADD COLUMN "chunks_embedded" integer DEFAULT 0 NOT NULL;--> statement-breakpoint
+ALTER TABLE "ingestion_jobs" ADD COLUMN "started_at" timestamp;--> statement-breakpoint
+UPDATE "ingestion_jobs" SET "phase" = "status", "chunks_embedded" = "chunks_done" WHERE "status" IN ('completed', 'failed');
\ No newline at end of file
@@ -0,0 +1,2 @@
+ALTER TABLE "documents" ADD COLUMN "collection" text;--> statement-breakpoint
+CREATE INDEX "documents_collection_idx" ON "documents" USING btree ("collection","created_at");
\ No newline at end of file
@@ -0,0 +1,3 @@
+-- Keep one row per chunk position before enforcing it
+DELETE FROM "chunks" a USING "chunks" b WHERE a."document_id" = b."document_id" AND a."order" = b."order" AND a."id" > b."id";--> statement-breakpoint
+CREATE UNIQUE INDEX "chunks_document_order_idx" ON "chunks" USING btree ("document_id","order");
\ No newline at end of file
@@ -0,0 +1 @@
+ALTER TABLE "ingestion_jobs" ADD COLUMN "resumed_from" integer DEFAULT 0 NOT NULL;
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- Existing values were written as local time of the session's TimeZone; read them back in the same one
+ALTER TABLE "cache_entries" ALTER COLUMN "expires_at" SET DATA TYPE timestamp with time zone USING "expires_at" AT TIME ZONE current_setting('TimeZone');
\ No newline at end of file